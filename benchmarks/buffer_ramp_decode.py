@@ -0,0 +1,86 @@
+"""Benchmark the decoding of DAC-ADC buffer ramp data.
+
+Compares dac_adc.decodeBuffer with the per-sample loop buffer_ramp used
+before, on random data for a 4 channel, 100k step ramp, and checks that
+both give the same voltages, including the zero padding of a ramp that
+was stopped early.
+
+Run from the repository root:  python benchmarks/buffer_ramp_decode.py
+"""
+
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from dac_adc import decodeBuffer
+
+
+def twoByteToInt(DB1,DB2): # This gives a 16 bit integer (between +/- 2^16)
+  return 256*DB1 + DB2
+
+def map2(x, in_min, in_max, out_min, out_max):
+  return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min;
+
+
+def decode_loop(data, adcN, steps):
+    """The decoding buffer_ramp used to do, kept for comparison."""
+    voltages = []
+    channels = [[] for x in range(adcN)]
+    data = list(data)
+    for x in range(0, len(data), 2):
+        decimal = twoByteToInt(data[x], data[x + 1])
+        voltages.append(map2(decimal, 0, 65536, -10.0, 10.0))
+    for x in range(0, steps * adcN, adcN):
+        for y in range(adcN):
+            try:
+                channels[y].append(voltages[x + y])
+            except IndexError:
+                channels[y].append(0)
+    return channels
+
+
+def receive_concat(chunks):
+    data = b''
+    for tmp in chunks:
+        data = data + tmp
+    return data
+
+
+def receive_prealloc(chunks, totalbytes):
+    buf = bytearray(totalbytes)
+    view = memoryview(buf)
+    nbytes = 0
+    for tmp in chunks:
+        view[nbytes:nbytes + len(tmp)] = tmp
+        nbytes += len(tmp)
+    return view[:nbytes]
+
+
+def main(adcN=4, steps=100000, chunk=64, repeat=3):
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 256, size=adcN * steps * 2).astype(np.uint8).tobytes()
+    partial = data[:len(data) // 3 + 1] # stopped early, odd number of bytes
+    chunks = [data[i:i + chunk] for i in range(0, len(data), chunk)]
+
+    assert np.array_equal(decode_loop(data, adcN, steps), decodeBuffer(data, adcN, steps))
+    assert np.array_equal(decode_loop(partial[:-1], adcN, steps),
+                          decodeBuffer(partial, adcN, steps))
+    assert bytes(receive_prealloc(chunks, len(data))) == receive_concat(chunks)
+
+    def best(f):
+        return min(timeit.repeat(f, number=1, repeat=repeat))
+
+    print('{} channels x {} steps, {} byte reads'.format(adcN, steps, chunk))
+    for name, old, new in [
+            ('receive', lambda: receive_concat(chunks), lambda: receive_prealloc(chunks, len(data))),
+            ('decode', lambda: decode_loop(data, adcN, steps), lambda: decodeBuffer(data, adcN, steps))]:
+        t_old, t_new = best(old), best(new)
+        print('{:8s} old {:8.4f} s   new {:8.4f} s   {:6.1f}x'.format(
+            name, t_old, t_new, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
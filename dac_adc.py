@@ -35,21 +35,52 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet import reactor, defer
 # import labrad.units as units
 from labrad.types import Value
-# import numpy as np
-import time
+import numpy as np
 # from exceptions import IndexError
 
 TIMEOUT = Value(5,'s')
 BAUD    = 115200
-
-def twoByteToInt(DB1,DB2): # This gives a 16 bit integer (between +/- 2^16)
-  return 256*DB1 + DB2
-
-def map2(x, in_min, in_max, out_min, out_max):
-  return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min;
+# Longest wait of each serial read during a buffer ramp.  stop_ramp waits
+# for the read in progress, since requests in the serial context run in order.
+READ_WINDOW = Value(0.5,'s')
+
+def decodeBuffer(data, nChannels, nSamples):
+  """Decode the bytes sent back by a buffer ramp into one list of voltages per channel.
+
+  The box sends big-endian 16 bit ADC codes, interleaved by channel, which
+  are scaled from [0, 65536) to [-10, 10) V.  Samples that never arrived
+  (the ramp was stopped) are 0, as is a trailing odd byte.
+  """
+  return decodeFrames(data, nChannels, nSamples).tolist()
+
+def bufferRampCommand(dacPorts, adcPorts, ivoltages, fvoltages, steps, delay, nReadings):
+  """Format the BUFFER_RAMP command, as buffer_ramp sends it."""
+  return "BUFFER_RAMP,%s,%s,%s,%s,%i,%i,%i\r" % (
+    "".join(str(port) for port in dacPorts),
+    "".join(str(port) for port in adcPorts),
+    ",".join(str(v) for v in ivoltages),
+    ",".join(str(v) for v in fvoltages),
+    steps, delay, nReadings)
+
+def decodeFrames(data, nChannels, nSamples):
+  """Decode buffer ramp bytes into a (nChannels, nSamples) array of voltages, see decodeBuffer."""
+  codes = np.frombuffer(data, dtype='>u2', count=min(len(data) // 2, nChannels * nSamples))
+  voltages = np.zeros(nChannels * nSamples)
+  voltages[:len(codes)] = codes * (20.0 / 65536) - 10.0
+  return voltages.reshape(nSamples, nChannels).T.copy()
 
 
 class DAC_ADCWrapper(DeviceWrapper):
+    """Serial connection to one DAC-ADC box.
+
+    Commands that are answered with lines of text go through command(),
+    which queues them in order for the device.  Commands queued in the same
+    reactor turn are sent together in one serial server packet, each write
+    followed by reads of its reply lines, and packets are sent without
+    waiting for earlier replies: the serial server handles requests in one
+    context in order, so replies always pair up with their commands.
+    While a buffer ramp holds the port (see hold), queued commands wait.
+    """
     channels = [0,1,2,3]
 
     @inlineCallbacks
@@ -60,6 +91,9 @@ class DAC_ADCWrapper(DeviceWrapper):
         self.ctx = server.context()
         self.port = port
         self.ramping = False
+        self._pending = []  # (code, replies, Deferred) not sent yet
+        self._sendCall = None
+        self._holds = 0
         p = self.packet()
         p.open(port)
         p.baudrate(BAUD)
@@ -79,9 +113,58 @@ class DAC_ADCWrapper(DeviceWrapper):
     def setramping(self, state):
         self.ramping = state
 
+    def command(self, code, replies=1):
+        """Write code and read its reply lines, in order with other commands.
+
+        If code is None, nothing is written and only lines are read.
+        Returns a Deferred that fires with the reply line, or with a list of
+        lines if replies is not 1.
+        """
+        d = defer.Deferred()
+        self._pending.append((code, replies, d))
+        if self._sendCall is None and not self._holds:
+            self._sendCall = reactor.callLater(0, self._sendPending)
+        return d
+
+    def _sendPending(self):
+        self._sendCall = None
+        if self._holds or not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        p = self.packet()
+        for n, (code, replies, _) in enumerate(batch):
+            if code is not None:
+                p.write(code)
+            for i in range(replies):
+                p.read_line(key='%d.%d' % (n, i))
+
+        def received(ans):
+            for n, (code, replies, d) in enumerate(batch):
+                lines = [ans['%d.%d' % (n, i)] for i in range(replies)]
+                d.callback(lines[0] if replies == 1 else lines)
+
+        def failed(failure):
+            for code, replies, d in batch:
+                d.errback(failure)
+
+        p.send().addCallbacks(received, failed)
+
+    def hold(self):
+        """Keep queued commands from being sent, while raw data is read from the port."""
+        self._holds += 1
+
+    def resume(self):
+        """Undo one hold, sending commands queued meanwhile once no holds remain."""
+        self._holds -= 1
+        if not self._holds and self._pending and self._sendCall is None:
+            self._sendCall = reactor.callLater(0, self._sendPending)
+
     def isramping(self):
         return self.ramping
 
+    # write, read and the raw reads below bypass the command queue, so they
+    # are only used while holding it (see hold), e.g. by the buffer ramps
+
     @inlineCallbacks
     def write(self, code):
         """Write a data value to the heat switch."""
@@ -101,6 +184,48 @@ class DAC_ADCWrapper(DeviceWrapper):
         ans=yield p.send()
         returnValue(ans.readbyte)
 
+    @inlineCallbacks
+    def readExactly(self, count, timeout):
+        """Read count bytes, or as many as arrive within timeout, in one request."""
+        p = self.packet()
+        p.read_exactly(count, timeout)
+        ans = yield p.send()
+        returnValue(ans.read_exactly)
+
+    @inlineCallbacks
+    def readBuffer(self, totalbytes):
+        """Read totalbytes bytes, or fewer if ramping is stopped meanwhile."""
+        buf = bytearray(totalbytes)
+        view = memoryview(buf)
+        nbytes = 0
+        while self.isramping() and (nbytes < totalbytes):
+            tmp = yield self.readExactly(totalbytes - nbytes, READ_WINDOW)
+            view[nbytes:nbytes + len(tmp)] = tmp
+            nbytes = nbytes + len(tmp)
+        returnValue(view[:nbytes])
+
+    @inlineCallbacks
+    def streamBuffer(self, totalbytes, frameBytes, onFrames):
+        """Read totalbytes bytes like readBuffer, passing on whole frames as they arrive.
+
+        onFrames(data, n) is called with the bytes of each group of complete
+        frames and the number of frames before them.  Only an incomplete
+        frame is kept between reads.  Returns the number of frames read.
+        """
+        pending = bytearray()
+        nbytes = 0
+        frames = 0
+        while self.isramping() and (nbytes < totalbytes):
+            tmp = yield self.readExactly(totalbytes - nbytes, READ_WINDOW)
+            nbytes = nbytes + len(tmp)
+            pending += tmp
+            complete = len(pending) - len(pending) % frameBytes
+            if complete:
+                onFrames(bytes(pending[:complete]), frames)
+                frames = frames + complete // frameBytes
+                del pending[:complete]
+        returnValue(frames)
+
     @inlineCallbacks
     def in_waiting(self):
         p = self.packet()
@@ -119,15 +244,6 @@ class DAC_ADCWrapper(DeviceWrapper):
     def timeout(self, time):
         yield self.packet().timeout(time).send()
 
-    @inlineCallbacks
-    def query(self, code):
-        """ Write, then read. """
-        p = self.packet()
-        p.write_line(code)
-        p.read_line()
-        ans = yield p.send()
-        returnValue(ans.read_line)
-
 
 
 class DAC_ADCServer(DeviceServer):
@@ -144,6 +260,7 @@ class DAC_ADCServer(DeviceServer):
     sigRamp2Started      = Signal(sPrefix+3,'signal__ramp_2_started'     , '*s') #
     sigConvTimeSet       = Signal(sPrefix+4,'signal__conversion_time_set', '*s') #
     sigBufferRampStarted = Signal(sPrefix+5,'signal__buffer_ramp_started', '*s') #
+    sigBufferRampData    = Signal(sPrefix+6,'signal__buffer_ramp_data'   , '(sw*2v)') # device, first step, voltages[channel][step]
 
     @inlineCallbacks
     def initServer(self):
@@ -208,8 +325,7 @@ class DAC_ADCServer(DeviceServer):
             returnValue("Error: invalid voltage. It must be between -10 and 10.")
             return
         dev=self.selectedDevice(c)
-        yield dev.write("SET,%i,%f\r"%(port,voltage))
-        ans = yield dev.read()
+        ans = yield dev.command("SET,%i,%f\r"%(port,voltage))
         voltage=ans.lower().partition(' to ')[2][:-1]
         self.sigOutputSet([str(port),voltage])
         returnValue(ans)
@@ -224,8 +340,7 @@ class DAC_ADCServer(DeviceServer):
         if not (port in range(8)):
             returnValue("Error: invalid port number.")
             return
-        yield dev.write("GET_ADC,%i\r"%port)
-        ans = yield dev.read()
+        ans = yield dev.command("GET_ADC,%i\r"%port)
         self.sigInputRead([str(port),str(ans)])
         returnValue(float(ans))
 
@@ -236,9 +351,9 @@ class DAC_ADCServer(DeviceServer):
         When the execution finishes, it returns "RAMP_FINISHED".
         """
         dev=self.selectedDevice(c)
-        yield dev.write("RAMP1,%i,%f,%f,%i,%i\r"%(port,ivoltage,fvoltage,steps,delay))
+        finished = dev.command("RAMP1,%i,%f,%f,%i,%i\r"%(port,ivoltage,fvoltage,steps,delay))
         self.sigRamp1Started([str(port),str(ivoltage),str(fvoltage),str(steps),str(delay)])
-        ans = yield dev.read()
+        ans = yield finished
         returnValue(ans)
 
     @setting(106,port1='i',port2='i',ivoltage1='v',ivoltage2='v',fvoltage1='v',fvoltage2='v',steps='i',delay='i',returns='s')
@@ -248,9 +363,9 @@ class DAC_ADCServer(DeviceServer):
         When the execution finishes, it returns "RAMP_FINISHED".
         """
         dev=self.selectedDevice(c)
-        yield dev.write("RAMP2,%i,%i,%f,%f,%f,%f,%i,%i\r"%(port1,port2,ivoltage1,ivoltage2,fvoltage1,fvoltage2,steps,delay))
+        finished = dev.command("RAMP2,%i,%i,%f,%f,%f,%f,%i,%i\r"%(port1,port2,ivoltage1,ivoltage2,fvoltage1,fvoltage2,steps,delay))
         self.sigRamp2Started([str(port1),str(port2),str(ivoltage1),str(ivoltage2),str(fvoltage1),str(fvoltage2),str(steps),str(delay)])
-        ans = yield dev.read()
+        ans = yield finished
         returnValue(ans)
 
     @setting(107,dacPorts='*i', adcPorts='*i', ivoltages='*v[]', fvoltages='*v[]', steps='i',delay='v[]',nReadings='i',returns='**v[]')#(*v[],*v[])')
@@ -279,59 +394,28 @@ class DAC_ADCServer(DeviceServer):
             sadcPorts = sadcPorts + str(adcPorts[x])
 
         dev = self.selectedDevice(c)
-        yield dev.write("BUFFER_RAMP,%s,%s,%s,%s,%i,%i,%i\r" % (sdacPorts, sadcPorts, sivoltages, sfvoltages, steps, delay, nReadings))
-        self.sigBufferRampStarted([dacPorts, adcPorts, ivoltages, fvoltages, str(steps), str(delay), str(nReadings)])
+        dev.hold()
+        try:
+            yield dev.write("BUFFER_RAMP,%s,%s,%s,%s,%i,%i,%i\r" % (sdacPorts, sadcPorts, sivoltages, sfvoltages, steps, delay, nReadings))
+            self.sigBufferRampStarted([dacPorts, adcPorts, ivoltages, fvoltages, str(steps), str(delay), str(nReadings)])
 
-        voltages = []
-        channels = []
-        data = b''
+            channels = [[] for x in range(adcN)]
 
-        dev.setramping(True)
-        try:
-            nbytes = 0
-            totalbytes = steps * adcN * 2
-            while dev.isramping() and (nbytes < totalbytes):
-                bytestoread = yield dev.in_waiting()
-                if bytestoread > 0:
-                    if nbytes + bytestoread > totalbytes:
-                        tmp = yield dev.readByte(totalbytes - nbytes)
-                        data = data + tmp
-                        nbytes = totalbytes
-                    else:
-                        tmp = yield dev.readByte(bytestoread)
-                        data = data + tmp
-                        nbytes = nbytes + bytestoread
-
-            dev.setramping(False)
-
-            data = list(data)
-
-            for x in range(adcN):
-                channels.append([])
-
-            for x in range(0, len(data), 2):
-                # The python 2 way
-                # b1 = int(data[x].encode('hex'), 16)
-                # b2 = int(data[x + 1].encode('hex'), 16)
-                # decimal = twoByteToInt(b1, b2)
-                decimal = twoByteToInt(data[x], data[x + 1])
-                voltage = map2(decimal, 0, 65536, -10.0, 10.0)
-                voltages.append(voltage)
-
-            for x in range(0, steps * adcN, adcN):
-                for y in range(adcN):
-                    try:
-                        channels[y].append(voltages[x + y])
-                    except IndexError:
-                        channels[y].append(0)
+            dev.setramping(True)
+            try:
+                data = yield dev.readBuffer(steps * adcN * 2)
+                dev.setramping(False)
+                channels = decodeBuffer(data, adcN, steps)
 
-        except KeyboardInterrupt:
-            print('Stopped')
+            except KeyboardInterrupt:
+                print('Stopped')
 
-        try:
-            yield dev.read()
-        except:
-            print("Error clearing teh serial buffer after buffer_ramp")
+            try:
+                yield dev.read()
+            except:
+                print("Error clearing teh serial buffer after buffer_ramp")
+        finally:
+            dev.resume()
 
         returnValue(channels)
 
@@ -365,59 +449,139 @@ class DAC_ADCServer(DeviceServer):
             sadcPorts = sadcPorts + str(adcPorts[x])
 
         dev = self.selectedDevice(c)
-        yield dev.write("BUFFER_RAMP_DIS,%s,%s,%s,%s,%i,%i,%i,%i\r" % (sdacPorts, sadcPorts, sivoltages, sfvoltages, steps, delay, nReadings, adcSteps))
-        #self.sigBufferRampStarted([dacPorts, adcPorts, ivoltages, fvoltages, str(steps), str(delay), str(nReadings)])
-
-        voltages = []
-        channels = []
-        data = b''
-        dev.setramping(True)
+        dev.hold()
         try:
-            nbytes = 0
-            totalbytes = adcSteps * adcN * 2
-            while dev.isramping() and (nbytes < totalbytes):
-                bytestoread = yield dev.in_waiting()
-                if bytestoread > 0:
-                    if nbytes + bytestoread > totalbytes:
-                        tmp = yield dev.readByte(totalbytes - nbytes)
-                        data = data + tmp
-                        nbytes = totalbytes
-                    else:
-                        tmp = yield dev.readByte(bytestoread)
-                        data = data + tmp
-                        nbytes = nbytes + bytestoread
-
-            dev.setramping(False)
-
-            data = list(data)
-
-            for x in range(adcN):
-                channels.append([])
-
-            for x in range(0, len(data), 2):
-                # The python 2 way
-                # b1 = int(data[x].encode('hex'), 16)
-                # b2 = int(data[x + 1].encode('hex'), 16)
-                # decimal = twoByteToInt(b1, b2)
-                decimal = twoByteToInt(data[x], data[x + 1])
-                voltage = map2(decimal, 0, 65536, -10.0, 10.0)
-                voltages.append(voltage)
-
-            for x in range(0, totalbytes//2, adcN):
-                for y in range(adcN):
-                    try:
-                        channels[y].append(voltages[x + y])
-                    except IndexError:
-                        channels[y].append(0)
+            yield dev.write("BUFFER_RAMP_DIS,%s,%s,%s,%s,%i,%i,%i,%i\r" % (sdacPorts, sadcPorts, sivoltages, sfvoltages, steps, delay, nReadings, adcSteps))
+            #self.sigBufferRampStarted([dacPorts, adcPorts, ivoltages, fvoltages, str(steps), str(delay), str(nReadings)])
+
+            channels = [[] for x in range(adcN)]
+            dev.setramping(True)
+            try:
+                data = yield dev.readBuffer(adcSteps * adcN * 2)
+                dev.setramping(False)
+                channels = decodeBuffer(data, adcN, adcSteps)
+
+            except KeyboardInterrupt:
+                print('Stopped')
+
+            #Reads BUFFER_RAMP_FINISHED
+            try:
+                yield dev.read()
+            except:
+                print("Error clearing the serial buffer after buffer_ramp")
+        finally:
+            dev.resume()
 
-        except KeyboardInterrupt:
-            print('Stopped')
+        returnValue(channels)
 
-        #Reads BUFFER_RAMP_FINISHED
+    @setting(126,dacPorts='*i', adcPorts='*i', ivoltages='*v[]', fvoltages='*v[]', steps='i',delay='v[]',nReadings='i',returns='i')
+    def buffer_ramp_stream(self,c,dacPorts,adcPorts,ivoltages,fvoltages,steps,delay,nReadings=1):
+        """
+        BUFFER_RAMP_STREAM runs the same ramp as buffer_ramp, but sends the readings in signal__buffer_ramp_data while the ramp is running instead of returning them at the end.
+        Each signal holds (device name, index of the first step, voltages[channel][step]) for all the steps that arrived since the last one, so listeners can plot or save the data as it comes in.
+        Returns the number of steps read, which is less than steps if the ramp is stopped with stop_ramp.
+        """
+        adcN = len(adcPorts)
+
+        dev = self.selectedDevice(c)
+        dev.hold()
+        try:
+            yield dev.write(bufferRampCommand(dacPorts, adcPorts, ivoltages, fvoltages, steps, delay, nReadings))
+            self.sigBufferRampStarted([str(dacPorts), str(adcPorts), str(ivoltages), str(fvoltages), str(steps), str(delay), str(nReadings)])
+
+            def sendFrames(data, start):
+                n = len(data) // (2 * adcN)
+                self.sigBufferRampData((dev.name, start, decodeFrames(data, adcN, n)))
+
+            received = 0
+            dev.setramping(True)
+            try:
+                received = yield dev.streamBuffer(steps * adcN * 2, adcN * 2, sendFrames)
+                dev.setramping(False)
+            except KeyboardInterrupt:
+                print('Stopped')
+
+            try:
+                yield dev.read()
+            except:
+                print("Error clearing the serial buffer after buffer_ramp_stream")
+        finally:
+            dev.resume()
+
+        returnValue(received)
+
+    @setting(127,slowPorts='*i', slowVoltages='*2v[]', dacPorts='*i', adcPorts='*i', ivoltages='*v[]', fvoltages='*v[]', steps='i',delay='v[]',nReadings='i',snake='b',returns='*3v[]')
+    def buffer_ramp_2d(self,c,slowPorts,slowVoltages,dacPorts,adcPorts,ivoltages,fvoltages,steps,delay,nReadings=1,snake=False):
+        """
+        BUFFER_RAMP_2D measures a whole 2D map in one call: for each row of slowVoltages it sets the slowPorts outputs to that row and runs buffer_ramp with the other arguments.
+        With snake, every other line is ramped from fvoltages back to ivoltages; its readings are reversed, so all lines run from ivoltages to fvoltages in the result.
+        Setting the next line and starting its ramp takes one request, sent as soon as the previous ramp finishes.
+        Each line is also sent in signal__buffer_ramp_data as (device name, line * steps, voltages[channel][step]).
+        Returns voltages[channel][line][step].  stop_ramp ends the map; lines that were not measured are 0.
+        """
+        slowVoltages = np.atleast_2d(np.asarray(slowVoltages, dtype=float))
+        if slowVoltages.shape[1] != len(slowPorts):
+            raise ValueError('slowVoltages must have one column per slow port.')
+        if np.any(np.abs(slowVoltages) > 10):
+            raise ValueError('slowVoltages must be between -10 and 10.')
+
+        lines = len(slowVoltages)
+        adcN = len(adcPorts)
+        channels = np.zeros((adcN, lines, steps))
+        forward = bufferRampCommand(dacPorts, adcPorts, ivoltages, fvoltages, steps, delay, nReadings)
+        backward = bufferRampCommand(dacPorts, adcPorts, fvoltages, ivoltages, steps, delay, nReadings)
+
+        dev = self.selectedDevice(c)
+        dev.hold()
         try:
-            yield dev.read()
-        except:
-            print("Error clearing the serial buffer after buffer_ramp")
+            self.sigBufferRampStarted([str(dacPorts), str(adcPorts), str(ivoltages), str(fvoltages), str(steps), str(delay), str(nReadings)])
+            dev.setramping(True)
+            try:
+                for line in range(lines):
+                    reverse = snake and line % 2 == 1
+                    p = dev.packet()
+                    if line > 0:
+                        p.read_line(key='finished')
+                    for n, (port, voltage) in enumerate(zip(slowPorts, slowVoltages[line])):
+                        p.write("SET,%i,%f\r" % (port, voltage))
+                        p.read_line(key='set%d' % n)
+                    p.write(backward if reverse else forward)
+                    ans = yield p.send()
+
+                    # the ramp was started with the SET commands, so it is
+                    # stopped if the device did not acknowledge them
+                    error = None
+                    if line > 0 and 'BUFFER_RAMP_FINISHED' not in ans['finished'].upper():
+                        error = "line %i did not finish: %r" % (line - 1, ans['finished'])
+                    for n, port in enumerate(slowPorts):
+                        reply = ans['set%d' % n]
+                        if ' to ' not in reply.lower():
+                            error = error or "SET of port %i for line %i failed: %r" % (port, line, reply)
+                        else:
+                            self.sigOutputSet([str(port), reply.lower().partition(' to ')[2][:-1]])
+                    if error is not None:
+                        yield self.stopRamp(dev)
+                        raise Exception("Error: buffer_ramp_2d " + error)
+
+                    data = yield dev.readBuffer(steps * adcN * 2)
+                    voltages = decodeFrames(data, adcN, steps)
+                    if reverse:
+                        voltages = voltages[:, ::-1].copy()
+                    channels[:, line, :] = voltages
+                    self.sigBufferRampData((dev.name, line * steps, voltages))
+                    if not dev.isramping():
+                        # stop_ramp clears the serial buffer
+                        break
+                else:
+                    dev.setramping(False)
+                    try:
+                        yield dev.read()
+                    except:
+                        print("Error clearing the serial buffer after buffer_ramp_2d")
+            except KeyboardInterrupt:
+                print('Stopped')
+        finally:
+            dev.resume()
 
         returnValue(channels)
 
@@ -432,8 +596,7 @@ class DAC_ADCServer(DeviceServer):
         if not (82 <= time <= 2686):
             returnValue("Error: invalid conversion time. Must adhere to (82 <= t <= 2686) (t is in microseconds)")
         dev=self.selectedDevice(c)
-        yield dev.write("CONVERT_TIME,%i,%f\r"%(channel,time))
-        ans = yield dev.read()
+        ans = yield dev.command("CONVERT_TIME,%i,%f\r"%(channel,time))
         self.sigConvTimeSet([str(channel),str(ans)])
         returnValue(float(ans))
 
@@ -444,9 +607,7 @@ class DAC_ADCServer(DeviceServer):
         IDN? returns the string.
         """
         dev=self.selectedDevice(c)
-        yield dev.write("*IDN?\r")
-        time.sleep(1)
-        ans = yield dev.read()
+        ans = yield dev.command("*IDN?\r")
         returnValue(ans)
 
     @setting(111,returns='s')
@@ -455,8 +616,7 @@ class DAC_ADCServer(DeviceServer):
         RDY? returns the string "READY" when the DAC-ADC is ready for a new operation.
         """
         dev=self.selectedDevice(c)
-        yield dev.write("*RDY?\r")
-        ans = yield dev.read()
+        ans = yield dev.command("*RDY?\r")
         returnValue(ans)
 
     @setting(112, returns='w')
@@ -475,6 +635,15 @@ class DAC_ADCServer(DeviceServer):
         Discards all elements from input buffer.
         """
         dev=self.selectedDevice(c)
+        dev.hold()
+        try:
+            yield self.stopRamp(dev)
+        finally:
+            dev.resume()
+
+    @inlineCallbacks
+    def stopRamp(self, dev):
+        """Stop a running ramp and discard the rest of its readings."""
         yield dev.write("STOP\r")
         dev.setramping(False)
 
@@ -493,8 +662,7 @@ class DAC_ADCServer(DeviceServer):
         Connect each DAC to each ADC channel.
         """
         dev=self.selectedDevice(c)
-        yield dev.write("DAC_CH_CAL\r")
-        ans = yield dev.read()
+        ans = yield dev.command("DAC_CH_CAL\r")
         returnValue(ans)
 
     @setting(115,returns='s')
@@ -504,8 +672,7 @@ class DAC_ADCServer(DeviceServer):
         Connect each DAC to each ADC channel.
         """
         dev=self.selectedDevice(c)
-        yield dev.write("ADC_ZERO_SC_CAL\r")
-        ans = yield dev.read()
+        ans = yield dev.command("ADC_ZERO_SC_CAL\r")
         returnValue(ans)
 
     @setting(116,returns='s')
@@ -515,8 +682,7 @@ class DAC_ADCServer(DeviceServer):
         Connect a zero scale voltage to each channel.
         """
         dev=self.selectedDevice(c)
-        yield dev.write("ADC_CH_ZERO_SC_CAL\r")
-        ans = yield dev.read()
+        ans = yield dev.command("ADC_CH_ZERO_SC_CAL\r")
         returnValue(ans)
 
     @setting(117,returns='s')
@@ -526,8 +692,7 @@ class DAC_ADCServer(DeviceServer):
         Connect a full scale voltage to each channel.
         """
         dev=self.selectedDevice(c)
-        yield dev.write("ADC_CH_FULL_SC_CAL\r")
-        ans = yield dev.read()
+        ans = yield dev.command("ADC_CH_FULL_SC_CAL\r")
         returnValue(ans)
 
     @setting(118,returns='s')
@@ -536,8 +701,7 @@ class DAC_ADCServer(DeviceServer):
         Initializes DACs
         """
         dev=self.selectedDevice(c)
-        yield dev.write("INITIALIZE\r")
-        ans = yield dev.read()
+        ans = yield dev.command("INITIALIZE\r")
         returnValue(ans)
 
     @setting(119,unit='i',returns='s')
@@ -546,8 +710,7 @@ class DAC_ADCServer(DeviceServer):
         Sets delay unit. 0 = microseconds(default) 1 = miliseconds
         """
         dev=self.selectedDevice(c)
-        yield dev.write("SET_DUNIT,%i\r"%(unit))
-        ans = yield dev.read()
+        ans = yield dev.command("SET_DUNIT,%i\r"%(unit))
         returnValue(ans)
 
     @setting(120,voltage='v',returns='s')
@@ -556,8 +719,7 @@ class DAC_ADCServer(DeviceServer):
         Sets the dac full scale.
         """
         dev=self.selectedDevice(c)
-        yield dev.write("FULL_SCALE,%f\r"%(voltage))
-        ans = yield dev.read()
+        ans = yield dev.command("FULL_SCALE,%f\r"%(voltage))
         returnValue(ans)
 
     @setting(121)
@@ -567,10 +729,7 @@ class DAC_ADCServer(DeviceServer):
         """
         dev=self.selectedDevice(c)
         message = "SET_OSG" + ",%f"*8 + "\r"
-        yield dev.write(message%(tuple(offset_and_gain)))
-        ans = [0]*8
-        for i in range(8):
-            ans[i] = yield dev.read()
+        ans = yield dev.command(message%(tuple(offset_and_gain)), replies=8)
 
         returnValue(ans)
 
@@ -580,10 +739,7 @@ class DAC_ADCServer(DeviceServer):
         Print the current offset and gain values for all DAC channels.
         """
         dev=self.selectedDevice(c)
-        yield dev.write("INQUIRY_OSG\r")
-        ans = [0]*8
-        for i in range(8):
-            ans[i] = yield dev.read()
+        ans = yield dev.command("INQUIRY_OSG\r", replies=8)
 
         returnValue(ans)
 
@@ -594,8 +750,7 @@ class DAC_ADCServer(DeviceServer):
         Returns the serial number of the box.
         """
         dev = self.selectedDevice(c)
-        yield dev.write("SERIAL_NUMBER\r")
-        ans = yield dev.read()
+        ans = yield dev.command("SERIAL_NUMBER\r")
         returnValue(ans)
 
     @setting(124,channel='i',code='i')
@@ -610,8 +765,7 @@ class DAC_ADCServer(DeviceServer):
             returnValue("Error: invalid code. Must be between 0 and 1048576.")
             return
         dev=self.selectedDevice(c)
-        yield dev.write("SET_DAC_CODE,%i,%i\r"%(channel,code))
-        ans = yield dev.read()
+        ans = yield dev.command("SET_DAC_CODE,%i,%i\r"%(channel,code))
         code = ans.lower().partition(' to ')[2][:-1]
         self.sigOutputSet([str(channel),code])
         returnValue(ans)
@@ -624,26 +778,24 @@ class DAC_ADCServer(DeviceServer):
         if not (channel in range(4)):
             returnValue("Error: invalid port number.")
         dev = self.selectedDevice(c)
-        yield dev.write("GET_DAC,%i\r"%(channel))
-        ans = yield dev.read()
+        ans = yield dev.command("GET_DAC,%i\r"%(channel))
         returnValue(float(ans))
 
     @setting(9002)
     def read(self,c):
         dev=self.selectedDevice(c)
-        ret=yield dev.read()
+        ret=yield dev.command(None)
         returnValue(ret)
 
     @setting(9003)
     def write(self,c,phrase):
         dev=self.selectedDevice(c)
-        yield dev.write(phrase)
+        yield dev.command(phrase, replies=0)
 
     @setting(9004)
     def query(self,c,phrase):
         dev=self.selectedDevice(c)
-        yield dev.write(phrase)
-        ret = yield dev.read()
+        ret = yield dev.command(phrase)
         returnValue(ret)
 
     @setting(9005,time='v[s]')
@@ -654,9 +806,10 @@ class DAC_ADCServer(DeviceServer):
     @setting(9100)
     def send_read_requests(self,c):
         dev = self.selectedDevice(c)
-        for port in [0,1,2,3]:
-            yield dev.write("GET_ADC,%i\r"%port)
-            ans = yield dev.read()
+        ports = [0,1,2,3]
+        # all four requests go out in one packet
+        answers = yield defer.gatherResults([dev.command("GET_ADC,%i\r"%port) for port in ports])
+        for port, ans in zip(ports, answers):
             self.sigInputRead([str(port),str(ans)])
 
     def sleep(self,secs):
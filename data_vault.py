@@ -39,7 +39,9 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 import labrad.util
 import labrad.wrappers
 
-from datavault import SessionStore
+from datavault import SessionStore, backend
+from datavault.executor import IOExecutor
+from datavault.search import SearchIndex
 from datavault.server import DataVault
 
 
@@ -79,6 +81,56 @@ def load_settings(cxn, name):
         print('To change this, edit the registry keys and restart the server.')
     returnValue(datadir)
 
+@inlineCallbacks
+def load_storage_settings(cxn, name):
+    """Load the default storage options for new datasets from the registry.
+
+    The keys 'chunk rows', 'compression', 'compression level' and 'shuffle'
+    are read from the Storage directory next to the Repository settings.
+    Missing keys fall back to backend.DEFAULT_STORAGE.
+    """
+    path = ['', 'Servers', name, 'Storage']
+    reg = cxn.registry
+    yield reg.cd(path, True)
+    (dirs, keys) = yield reg.dir()
+    default = backend.DEFAULT_STORAGE
+    opts = {}
+    for key, field in [('chunk rows', 'chunk_rows'),
+                       ('compression', 'compression'),
+                       ('compression level', 'compression_opts'),
+                       ('shuffle', 'shuffle')]:
+        if key in keys:
+            opts[field] = yield reg.get(key)
+        else:
+            opts[field] = getattr(default, field)
+    returnValue(backend.make_storage_options(**opts))
+
+@inlineCallbacks
+def load_file_settings(cxn, name):
+    """Load settings for opening data files from the registry.
+
+    Reads the boolean key 'upgrade csv' (convert csv datasets to HDF5 when
+    they are opened, default False), 'max open files' (size of the open
+    file cache, default backend.MAX_OPEN_FILES) and 'search index' (keep a
+    datavault.search index of dataset metadata, default False; building it
+    reads the metadata of every dataset in the vault) from the Storage
+    directory.
+    """
+    path = ['', 'Servers', name, 'Storage']
+    reg = cxn.registry
+    yield reg.cd(path, True)
+    (dirs, keys) = yield reg.dir()
+    upgrade = False
+    if 'upgrade csv' in keys:
+        upgrade = yield reg.get('upgrade csv')
+    max_open = backend.MAX_OPEN_FILES
+    if 'max open files' in keys:
+        max_open = yield reg.get('max open files')
+    search = False
+    if 'search index' in keys:
+        search = yield reg.get('search index')
+    returnValue((bool(upgrade), int(max_open), bool(search)))
+
 def main(argv=sys.argv):
     @inlineCallbacks
     def start():
@@ -86,9 +138,16 @@ def main(argv=sys.argv):
         cxn = yield labrad.wrappers.connectAsync(
             host=opts['host'], port=int(opts['port']), password=opts['password'])
         datadir = yield load_settings(cxn, opts['name'])
+        storage = yield load_storage_settings(cxn, opts['name'])
+        upgrade_csv, max_open, search = yield load_file_settings(cxn, opts['name'])
         yield cxn.disconnect()
-        session_store = SessionStore(datadir, hub=None)
-        server = DataVault(session_store)
+        backend.FILE_CACHE.setMaxOpen(max_open)
+        executor = IOExecutor()
+        search_index = SearchIndex(datadir, executor=executor) if search else None
+        session_store = SessionStore(datadir, hub=None, executor=executor,
+                                     upgrade_csv=upgrade_csv,
+                                     search_index=search_index)
+        server = DataVault(session_store, storage)
         session_store.hub = server
 
         # Run the server. We do not need to start the reactor, but we will
@@ -1,13 +1,20 @@
 #import base64
 from datetime import datetime
+import json
 import os
 import re
 #import collections
+import time
 import weakref
 
+import numpy as np
+from twisted.internet import defer, reactor
+from twisted.python import failure, log
+
 #from labrad import types as T
 
 from . import backend, errors, util
+from .executor import SynchronousExecutor
 
 
 ## Filename translation.
@@ -77,16 +84,286 @@ def parse_dependent(s):
     return label, legend, units
 
 
+## write-behind buffering of added data
+
+# Rows passed to Dataset.addData are held in memory and written to the
+# backend in one block once any of these limits is reached.
+WRITE_BUFFER_ROWS = 10000
+WRITE_BUFFER_BYTES = 4 * 1024 * 1024
+WRITE_BUFFER_DELAY = 1.0 # seconds before buffered rows are flushed
+
+# Access times of sessions and datasets change on every cd and open; the
+# metadata files are rewritten at most once per METADATA_SAVE_DELAY for
+# these.  Real changes (new datasets, tags, parameters) are saved at once.
+METADATA_SAVE_DELAY = 5.0 # seconds
+
+
+## pushing new rows to streaming listeners
+
+def _join_columns(a, b):
+    """Append column b to column a; string columns are lists."""
+    if isinstance(a, list):
+        return a + list(b)
+    return np.concatenate([a, b])
+
+def preview_columns(cols, max_rows, mode=''):
+    """Reduce columns read for a push to at most about max_rows rows.
+
+    With mode 'minmax' each bin of rows is reduced to its minimum and
+    maximum; this needs numeric columns, so otherwise (or with mode '')
+    every n-th row is kept.  max_rows=0 keeps all rows.
+    """
+    rows = len(cols[0]) if len(cols) else 0
+    if not max_rows or rows <= max_rows:
+        return cols
+    numeric = all(isinstance(col, np.ndarray) and col.dtype.kind in 'biufc'
+                  for col in cols)
+    if mode == 'minmax' and numeric:
+        step = -(-2 * rows // max_rows) # two rows per bin
+        return tuple(backend.minmax_decimate(col, step) for col in cols)
+    step = -(-rows // max_rows)
+    return tuple(col[::step] for col in cols)
+
+
+class Stream(object):
+    """State of a context that has new rows pushed to it; see Dataset.stream."""
+
+    def __init__(self, pos, max_rate=0, max_rows=0, mode='', window=1):
+        self.pos = pos # first row not yet pushed
+        self.max_rate = max_rate # pushes per second, 0 for no limit
+        self.max_rows = max_rows # rows per push before decimating, 0 for no limit
+        self.mode = mode
+        self.window = max(1, window) # pushes that may be unacknowledged
+        self.unacked = 0
+        self.reading = False
+        self.lastPush = None
+        self.delayedPush = None
+
+    def cancel(self):
+        if self.delayedPush is not None:
+            if self.delayedPush.active():
+                self.delayedPush.cancel()
+            self.delayedPush = None
+
+
 ## data-url support for storing parameters
 
 DATA_URL_PREFIX = 'data:application/labrad;base64,'
 
 
+class ListenerIndex(object):
+    """Reverse index from a context to the listener sets it was added to.
+
+    Sessions and datasets keep sets of listening contexts in attributes
+    such as 'listeners'; whenever a context is added to one, it is
+    registered here as (object, attribute name).  When the context
+    expires, it is removed from just those sets instead of from every
+    session and dataset.  The attribute is looked up again on expiry since
+    the sets are replaced after each notification.  Objects are held by
+    weak reference.
+    """
+
+    def __init__(self):
+        self._registrations = {}
+
+    def register(self, key, obj, attr):
+        """Record that context key was added to the set obj.<attr>."""
+        regs = self._registrations.setdefault(key, {})
+        regs[(id(obj), attr)] = (weakref.ref(obj), attr)
+
+    def expire(self, key):
+        """Remove context key from all sets it was registered in."""
+        for ref, attr in self._registrations.pop(key, {}).values():
+            obj = ref()
+            if obj is not None:
+                getattr(obj, attr).discard(key)
+
+
+# The tag index is kept in a subdirectory of the root data directory, so
+# that rewriting it does not change the root directory listing.
+TAG_INDEX_FILE = os.path.join('.index', 'tags.json')
+TAG_INDEX_VERSION = 1
+
+
+class TagIndex(object):
+    """Vault-wide index from tag to the datasets that carry it.
+
+    Tags live in the session.ini file of each directory; this keeps a copy
+    of the dataset tags of every session, inverted to map each tag to a set
+    of (path, dataset name), so datasets can be searched by tag across the
+    whole vault.  Sessions update their entry when they load or change
+    their tags.  The index is saved as JSON to TAG_INDEX_FILE in the data
+    directory, after a delay like session access times.  If that file does
+    not exist, the index is built on first use by reading the session.ini
+    file of every directory.  Loading runs in the I/O executor; updates and
+    searches made meanwhile wait for it.
+    """
+
+    def __init__(self, datadir, executor=None, reactor=reactor):
+        self.datadir = datadir
+        self.filename = os.path.join(datadir, TAG_INDEX_FILE)
+        self.executor = executor if executor is not None else SynchronousExecutor()
+        self.reactor = reactor
+        self._sessions = None # path -> {dataset: set of tags}; None until loaded
+        self._tags = {} # tag -> set of (path, dataset)
+        self._waiting = None # Deferreds waiting for the load in progress
+        self._saveCall = None
+
+    def _load(self, rebuild=False):
+        """Load the index; returns a Deferred that fires once it is loaded."""
+        if self._sessions is not None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        if self._waiting is None:
+            self._waiting = [d]
+            self.executor.submit(self, self._read, rebuild).addBoth(self._loadDone)
+        else:
+            self._waiting.append(d)
+        return d
+
+    def _read(self, rebuild):
+        """Read the saved index, or the tags of every directory if needed.
+
+        Runs in the I/O executor.  Returns a list of (path, dataset tags)
+        and whether the tags were read from the directories.
+        """
+        if not rebuild and os.path.exists(self.filename):
+            with open(self.filename) as f:
+                saved = json.load(f)
+            if saved.get('version') == TAG_INDEX_VERSION:
+                return [(tuple(path), tags) for path, tags in saved['sessions']], False
+        return self._walk(), True
+
+    def _loadDone(self, result):
+        waiting, self._waiting = self._waiting, None
+        if isinstance(result, failure.Failure):
+            log.err(result, 'Loading the tag index failed')
+            for d in waiting:
+                d.errback(result)
+            return
+        entries, rebuilt = result
+        self._sessions = {}
+        self._tags = {}
+        for path, dataset_tags in entries:
+            self._set(path, dataset_tags)
+        if rebuilt:
+            self.saveLater()
+        for d in waiting:
+            d.callback(None)
+
+    def rebuild(self):
+        """Read the tags of every directory in the vault again.
+
+        Returns a Deferred that fires once the index is rebuilt.
+        """
+        if self._waiting is None:
+            self._sessions = None
+        return self._load(rebuild=True)
+
+    def _walk(self):
+        """Read the dataset tags of every session.ini in the vault."""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.datadir):
+            dirnames[:] = [d for d in dirnames if d.endswith('.dir')]
+            if 'session.ini' not in filenames:
+                continue
+            rel = os.path.relpath(dirpath, self.datadir)
+            parts = [] if rel == os.curdir else rel.split(os.sep)
+            path = ('',) + tuple(filename_decode(d[:-4]) for d in parts)
+            S = util.DVSafeConfigParser()
+            S.read(os.path.join(dirpath, 'session.ini'))
+            if S.has_section('Tags'):
+                entries.append((path, util.parse_tags(S.get('Tags', 'datasets', raw=True))))
+        return entries
+
+    def _set(self, path, dataset_tags):
+        old = self._sessions.pop(path, {})
+        for name, tags in old.items():
+            for tag in tags:
+                entries = self._tags[tag]
+                entries.discard((path, name))
+                if not entries:
+                    del self._tags[tag]
+        new = {name: set(tags) for name, tags in dataset_tags.items() if tags}
+        if new:
+            self._sessions[path] = new
+        for name, tags in new.items():
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add((path, name))
+
+    def update(self, path, dataset_tags):
+        """Replace the dataset tags of one session."""
+        path = tuple(path)
+        def update(_):
+            if self._sessions.get(path, {}) != {n: t for n, t in dataset_tags.items() if t}:
+                self._set(path, dataset_tags)
+                self.saveLater()
+        # a failed load is logged by _loadDone
+        self._load().addCallbacks(update, lambda _: None)
+
+    def search(self, tagFilters):
+        """Find datasets matching all tag filters, as sorted (path, name).
+
+        Filters are tags the dataset must have, or tags prefixed with '-'
+        that it must not have, as for Session.listContents.  At least one
+        tag to match is needed.  Returns a Deferred.
+        """
+        include = [t for t in tagFilters if t[:1] != '-']
+        exclude = [t[1:] for t in tagFilters if t[:1] == '-']
+        if not include:
+            raise errors.TagSearchError(tagFilters)
+        def search(_):
+            found = set.intersection(*[self._tags.get(t, set()) for t in include])
+            for tag in exclude:
+                found -= self._tags.get(tag, set())
+            return sorted(found)
+        return self._load().addCallback(search)
+
+    def save(self):
+        """Write the index to disk; returns a Deferred."""
+        if self._saveCall is not None:
+            if self._saveCall.active():
+                self._saveCall.cancel()
+            self._saveCall = None
+        saved = {
+            'version': TAG_INDEX_VERSION,
+            'sessions': [[list(path), {name: sorted(tags) for name, tags in entry.items()}]
+                         for path, entry in sorted(self._sessions.items())],
+        }
+        text = json.dumps(saved, separators=(',', ':'))
+        dirname = os.path.dirname(self.filename)
+        def write():
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            util.write_text(text, self.filename)
+        return self.executor.submit(self, write)
+
+    def saveLater(self):
+        if self._saveCall is None:
+            self._saveCall = self.reactor.callLater(METADATA_SAVE_DELAY, self.save)
+
+    def flushSave(self):
+        """Write a delayed save now, e.g. when the server shuts down."""
+        if self._saveCall is None:
+            return defer.succeed(None)
+        return self.save()
+
+
 class SessionStore(object):
-    def __init__(self, datadir, hub):
+    def __init__(self, datadir, hub, executor=None, upgrade_csv=False,
+                 reactor=reactor, search_index=None):
         self._sessions = weakref.WeakValueDictionary()
         self.datadir = datadir
         self.hub = hub
+        self.reactor = reactor
+        self.listener_index = ListenerIndex()
+        # runs blocking disk I/O; see datavault.executor
+        self.executor = executor if executor is not None else SynchronousExecutor()
+        self.tag_index = TagIndex(datadir, self.executor, reactor)
+        # optional datavault.search.SearchIndex, updated as datasets change
+        self.search_index = search_index
+        # convert csv datasets to HDF5 when they are opened
+        self.upgrade_csv = upgrade_csv
 
     def get_all(self):
         return list(self._sessions.values())
@@ -108,10 +385,123 @@ class SessionStore(object):
         path = tuple(path)
         if path in self._sessions:
             return self._sessions[path]
-        session = Session(self.datadir, path, self.hub, self)
+        session = Session(self.datadir, path, self.hub, self, self.executor)
         self._sessions[path] = session
         return session
 
+    def findDataset(self, path, name):
+        """Get the open Dataset name in session path, or None if it is not open."""
+        session = self._sessions.get(tuple(path))
+        if session is None:
+            return None
+        return session.datasets.get(name)
+
+
+# A listing is only trusted while the directory mtime is unchanged.  File
+# systems (network shares in particular) may store mtimes with coarse
+# resolution, so a listing taken within MTIME_SLACK seconds of the last
+# change is refreshed again on the next use.
+MTIME_SLACK = 2.0
+
+
+class DirectoryIndex(object):
+    """In-memory listing of the subdirectories and datasets of a session.
+
+    The directory is only rescanned when its mtime changes.  Datasets and
+    directories created by this server are added directly, so they do not
+    force a rescan.  Datasets can be looked up by number in O(1).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._dirs = set()
+        self._datasets = set()
+        self._numbers = {}
+        self._sorted = None
+
+    def _stat(self):
+        return os.stat(self.path).st_mtime
+
+    def refresh(self):
+        """Rescan the directory if it has changed since the last scan."""
+        mtime = self._stat()
+        if mtime == self._mtime:
+            return
+        files = os.listdir(self.path)
+        self._dirs = set(filename_decode(f[:-4]) for f in files if f.endswith('.dir'))
+        datasets = set()
+        for f in files:
+            base, _, ext = f.rpartition('.')
+            if ext in ['csv', 'hdf5']:
+                datasets.add(filename_decode(base))
+        self._datasets = set()
+        self._numbers = {}
+        for name in sorted(datasets):
+            self._addDataset(name)
+        self._sorted = None
+        self._mtime = None if time.time() - mtime < MTIME_SLACK else mtime
+
+    def _addDataset(self, name):
+        self._datasets.add(name)
+        try:
+            num = int(name[:5])
+        except ValueError:
+            return
+        self._numbers.setdefault(num, name)
+
+    def _changed(self):
+        # our own change; the listing stays trusted if it was before
+        if self._mtime is not None:
+            self._mtime = self._stat()
+        self._sorted = None
+
+    def addDataset(self, name):
+        """Record a dataset just created by this server.
+
+        Call refresh before creating the files, so that only this change
+        happened since the listing was taken.
+        """
+        self._addDataset(name)
+        self._changed()
+
+    def addDir(self, name):
+        """Record a subdirectory just created by this server; see addDataset."""
+        self._dirs.add(name)
+        self._changed()
+
+    def listing(self):
+        """Get sorted lists of (directories, datasets)."""
+        self.refresh()
+        if self._sorted is None:
+            self._sorted = sorted(self._dirs), sorted(self._datasets)
+        return self._sorted
+
+    def lookup(self, num):
+        """Get the name of the dataset with the given number, or None."""
+        self.refresh()
+        return self._numbers.get(num)
+
+    def rewritten(self, before, after):
+        """Record that a file was replaced between two stats of the directory.
+
+        Metadata files are written atomically by renaming a temporary file
+        over them, which changes the directory mtime without changing the
+        listing.  If nothing else changed meanwhile, the listing stays trusted.
+        """
+        if self._mtime is not None and self._mtime == before:
+            self._mtime = after
+
+
+def rewrite_in_dir(path, write, *args):
+    """Call write(*args), returning the mtime of directory path before and after.
+
+    Used with DirectoryIndex.rewritten for files replaced atomically.
+    """
+    before = os.stat(path).st_mtime
+    write(*args)
+    return before, os.stat(path).st_mtime
+
 
 class Session(object):
     """Stores information about a directory on disk.
@@ -121,30 +511,43 @@ class Session(object):
     file, and manages the datasets in this directory.
     """
 
-    def __init__(self, datadir, path, hub, session_store):
+    def __init__(self, datadir, path, hub, session_store, executor=None):
         """Initialization that happens once when session object is created."""
         self.path = path
         self.hub = hub
+        self.executor = executor if executor is not None else SynchronousExecutor()
+        self.reactor = session_store.reactor
+        self.listener_index = session_store.listener_index
+        self.tag_index = session_store.tag_index
+        self.search_index = session_store.search_index
+        self.upgrade_csv = session_store.upgrade_csv
+        self._saveCall = None
         self.dir = filedir(datadir, path)
         self.infofile = os.path.join(self.dir, 'session.ini')
         self.datasets = weakref.WeakValueDictionary()
 
         if not os.path.exists(self.dir):
+            if len(path) > 1:
+                parent_session = session_store.get(path[:-1])
+                parent_session.index.refresh()
             os.makedirs(self.dir)
 
-            # notify listeners about this new directory
-            parent_session = session_store.get(path[:-1])
-            hub.onNewDir(path[-1], parent_session.listeners)
+            if len(path) > 1:
+                # notify listeners about this new directory
+                parent_session.index.addDir(path[-1])
+                hub.onNewDir(path[-1], parent_session.listeners)
+
+        self.index = DirectoryIndex(self.dir)
 
         if os.path.exists(self.infofile):
             self.load()
+            self.access() # update current access time
         else:
             self.counter = 1
             self.created = self.modified = datetime.now()
             self.session_tags = {}
             self.dataset_tags = {}
-
-        self.access() # update current access time and save
+            self.access(saveNow=True)
         self.listeners = set()
 
     def load(self):
@@ -162,14 +565,23 @@ class Session(object):
 
         # get tags if they're there
         if S.has_section('Tags'):
-            self.session_tags = eval(S.get('Tags', 'sessions', raw=True))
-            self.dataset_tags = eval(S.get('Tags', 'datasets', raw=True))
+            self.session_tags = util.parse_tags(S.get('Tags', 'sessions', raw=True))
+            self.dataset_tags = util.parse_tags(S.get('Tags', 'datasets', raw=True))
         else:
             self.session_tags = {}
             self.dataset_tags = {}
+        self.tag_index.update(self.path, self.dataset_tags)
 
     def save(self):
-        """Save info to the session.ini file."""
+        """Save info to the session.ini file.
+
+        The file is written through the I/O executor; returns a Deferred
+        that fires once it is on disk.  Any delayed save is cancelled.
+        """
+        if self._saveCall is not None:
+            if self._saveCall.active():
+                self._saveCall.cancel()
+            self._saveCall = None
         S = util.DVSafeConfigParser()
 
         sec = 'File System'
@@ -187,62 +599,78 @@ class Session(object):
         S.set(sec, 'sessions', repr(self.session_tags))
         S.set(sec, 'datasets', repr(self.dataset_tags))
 
-        with open(self.infofile, 'w') as f:
-            S.write(f)
+        d = self.executor.submit(self, rewrite_in_dir, self.dir,
+                                 util.write_config, S, self.infofile)
+        d.addCallback(lambda mtimes: self.index.rewritten(*mtimes))
+        return d
 
-    def access(self):
-        """Update last access time and save."""
+    def saveLater(self):
+        """Save within METADATA_SAVE_DELAY, together with any other changes."""
+        if self._saveCall is None:
+            self._saveCall = self.reactor.callLater(METADATA_SAVE_DELAY, self.save)
+
+    def flushSave(self):
+        """Write a delayed save now, e.g. when the server shuts down.
+
+        Returns a Deferred that fires once it is on disk.
+        """
+        if self._saveCall is None:
+            return defer.succeed(None)
+        return self.save()
+
+    def access(self, saveNow=False):
+        """Update last access time.
+
+        The change is saved with the next save, or after a delay.
+        """
         self.accessed = datetime.now()
-        self.save()
+        if saveNow:
+            self.save()
+        else:
+            self.saveLater()
+
+    def addListener(self, context):
+        """Add a context to the listeners for new directories, datasets and tags."""
+        self.listeners.add(context)
+        self.listener_index.register(context, self, 'listeners')
 
     def listContents(self, tagFilters):
         """Get a list of directory names in this directory."""
-        files = os.listdir(self.dir)
-        dirs = [filename_decode(s[:-4]) for s in files if s.endswith('.dir')]
-        csv_datasets = [filename_decode(s[:-4]) for s in files if s.endswith('.ini') and s.lower() != 'session.ini' ]
-        hdf5_datasets = [filename_decode(s[:-5]) for s in files if s.endswith('.hdf5')]
-        datasets = sorted(csv_datasets + hdf5_datasets)
-        # apply tag filters
-        def include(entries, tag, tags):
-            """Include only entries that have the specified tag."""
-            return [e for e in entries
-                    if e in tags and tag in tags[e]]
-        def exclude(entries, tag, tags):
-            """Exclude all entries that have the specified tag."""
-            return [e for e in entries
-                    if e not in tags or tag not in tags[e]]
-        for tag in tagFilters:
-            if tag[:1] == '-':
-                filter = exclude
-                tag = tag[1:]
-            else:
-                filter = include
-            dirs = list(filter(dirs, tag, self.session_tags))
-            datasets = list(filter(datasets, tag, self.dataset_tags))
-        return sorted(dirs), sorted(datasets)
+        dirs, datasets = self.index.listing()
+        # apply tag filters: keep entries that have all the included tags
+        # and none of the excluded ones
+        include = set(t for t in tagFilters if t[:1] != '-')
+        exclude = set(t[1:] for t in tagFilters if t[:1] == '-')
+        if not (include or exclude):
+            return list(dirs), list(datasets)
+        empty = frozenset()
+        def matches(entry, tags):
+            entryTags = tags.get(entry, empty)
+            return include <= entryTags and exclude.isdisjoint(entryTags)
+        dirs = [d for d in dirs if matches(d, self.session_tags)]
+        datasets = [d for d in datasets if matches(d, self.dataset_tags)]
+        return dirs, datasets
 
     def listDatasets(self):
         """Get a list of dataset names in this directory."""
-        files = os.listdir(self.dir)
-        filenames = []
-        for s in files:
-            base, _, ext = s.rpartition('.')
-            if ext in ['csv', 'hdf5']:
-                filenames.append(filename_decode(base))
-        return sorted(filenames)
+        return list(self.index.listing()[1])
 
-    def newDataset(self, title, independents, dependents, extended=False):
+    def newDataset(self, title, independents, dependents, extended=False, storage=None):
         num = self.counter
         self.counter += 1
         self.modified = datetime.now()
 
         name = '%05d - %s' % (num, title)
+        self.index.refresh()
         dataset = Dataset(self, name, title, create=True,
                           independents=independents,
                           dependents=dependents,
-                          extended=extended)
+                          extended=extended,
+                          storage=storage)
         self.datasets[name] = dataset
-        self.access()
+        self.index.addDataset(name)
+        self.access(saveNow=True)
+        dataset.indexLater()
 
         # notify listeners about the new dataset
         self.hub.onNewDataset(name, self.listeners)
@@ -251,11 +679,7 @@ class Session(object):
     def openDataset(self, name):
         # first lookup by number if necessary
         if isinstance(name, int):
-            for oldName in self.listDatasets():
-                num = int(oldName[:5])
-                if name == num:
-                    name = oldName
-                    break
+            name = self.index.lookup(name) or name
         # if it's still a number, we didn't find the set
         if isinstance(name, int):
             raise errors.DatasetNotFoundError(name)
@@ -276,6 +700,28 @@ class Session(object):
 
         return dataset
 
+    def upgradeDataset(self, name):
+        """Convert a csv dataset to HDF5 before it is opened, if upgrade_csv is set.
+
+        The conversion (see backend.migrate_csv_dataset) runs in the I/O
+        executor.  Returns a Deferred that fires once it is done; if it
+        fails, the error is logged and the csv file is used.
+        """
+        if isinstance(name, int):
+            name = self.index.lookup(name) or name
+        if not self.upgrade_csv or isinstance(name, int) or name in self.datasets:
+            return defer.succeed(None)
+        file_base = os.path.join(self.dir, filename_encode(name))
+        def upgrade():
+            # another context may have converted it meanwhile
+            if os.path.exists(file_base + '.csv'):
+                backend.migrate_csv_dataset(file_base)
+        def failed(failure):
+            log.err(failure, 'Upgrading csv dataset {0!r} failed'.format(name))
+        d = self.executor.submit(file_base, upgrade)
+        d.addErrback(failed)
+        return d
+
     def updateTags(self, tags, sessions, datasets):
         def updateTagDict(tags, entries, d):
             updates = []
@@ -311,7 +757,9 @@ class Session(object):
         sessUpdates = updateTagDict(tags, sessions, self.session_tags)
         dataUpdates = updateTagDict(tags, datasets, self.dataset_tags)
 
-        self.access()
+        self.access(saveNow=True)
+        if dataUpdates:
+            self.tag_index.update(self.path, self.dataset_tags)
         if len(sessUpdates) + len(dataUpdates):
             # fire a message about the new tags
             msg = (sessUpdates, dataUpdates)
@@ -328,18 +776,40 @@ class Dataset(object):
     All the actual data or metadata access is proxied through to a
     backend object.
     """
-    def __init__(self, session, name, title=None, create=False, independents=[], dependents=[], extended=False):
+    def __init__(self, session, name, title=None, create=False, independents=[], dependents=[], extended=False, storage=None):
         self.hub = session.hub
+        self.executor = session.executor
+        self.session = session
+        self.listener_index = session.listener_index
+        self.search_index = session.search_index
         self.name = name
         file_base = os.path.join(session.dir, filename_encode(name))
+        self.file_base = file_base
         self.listeners = set() # contexts that want to hear about added data
         self.param_listeners = set()
         self.comment_listeners = set()
+        self.reactor = session.reactor
+        self._saveCall = None
+
+        # rows added but not yet written to the backend
+        self._buffer = []
+        self._bufferedRows = 0
+        self._bufferedBytes = 0
+        self._flushCall = None
+        self._writing = None # rows being written by the executor
+        self._flushWaiters = [] # Deferreds of flushes made during a write
+        self._memStart = None # row number of the first row held in memory
+        # contexts writing to this dataset; the file stays open while any exist
+        self.writers = set()
+        # contexts that have new rows pushed to them, mapped to their Stream
+        self.streams = {}
+        # while finalize is replacing the file, Deferreds of waiting reads
+        self._finalizing = None
 
         if create:
             indep = [self.makeIndependent(i, extended) for i in independents]
             dep = [self.makeDependent(d, extended) for d in dependents]
-            self.data = backend.create_backend(file_base, title, indep, dep, extended)
+            self.data = backend.create_backend(file_base, title, indep, dep, extended, storage)
             self.save()
         else:
             self.data = backend.open_backend(file_base)
@@ -347,7 +817,31 @@ class Dataset(object):
             self.access()
 
     def save(self):
-        self.data.save()
+        """Write buffered rows and save the metadata.
+
+        Returns a Deferred that fires once the metadata is on disk.  Any
+        delayed save is cancelled.
+        """
+        if self._saveCall is not None:
+            if self._saveCall.active():
+                self._saveCall.cancel()
+            self._saveCall = None
+        # a failed write is logged and its rows kept; the metadata is saved anyway
+        d = self.flush()
+        if getattr(self.data, 'infofile', None) is None:
+            # HDF5 metadata is written live; save does no file I/O
+            return d.addBoth(lambda _: self._run('save'))
+        # csv backends are not threadsafe, so _run saves them inline
+        index = self.session.index
+        session_dir = self.session.dir
+        d.addBoth(lambda _: self._run(lambda data: rewrite_in_dir(session_dir, data.save)))
+        d.addCallback(lambda mtimes: index.rewritten(*mtimes))
+        return d
+
+    def saveLater(self):
+        """Save within METADATA_SAVE_DELAY, together with any other changes."""
+        if self._saveCall is None:
+            self._saveCall = self.reactor.callLater(METADATA_SAVE_DELAY, self.save)
 
     def load(self):
         self.data.load()
@@ -357,9 +851,149 @@ class Dataset(object):
         return '.'.join(str(x) for x in v)
 
     def access(self):
-        """Update time of last access for this dataset."""
-        self.data.access()
-        self.save()
+        """Update time of last access for this dataset.
+
+        HDF5 files are written through the I/O executor, after any earlier
+        writes; for csv datasets the ini file is rewritten after a delay.
+        """
+        d = self._io('access')
+        d.addErrback(log.err, 'Updating access time of dataset {0} failed'.format(self.name))
+        self.saveLater()
+
+    def close(self):
+        """Close the backend file, e.g. when the server shuts down.
+
+        Returns a Deferred that fires once buffered rows and any delayed
+        save are written.
+        """
+        for stream in self.streams.values():
+            stream.cancel()
+        self.streams = {}
+        if self._saveCall is not None:
+            d = self.save()
+        else:
+            d = self.flush()
+        def close(_):
+            if self._flushCall is not None:
+                # rows of a failed write cannot be retried once closed
+                if self._flushCall.active():
+                    self._flushCall.cancel()
+                self._flushCall = None
+            if self.writers:
+                self.writers.clear()
+                self.data.unpin()
+            return self.data.close()
+        d.addCallback(close)
+        return d
+
+    def addWriter(self, context):
+        """Pin the backend file open while a context is writing to it."""
+        if context not in self.writers:
+            if not self.writers:
+                self.data.pin()
+            self.writers.add(context)
+
+    def removeWriter(self, context):
+        if context in self.writers:
+            self.writers.remove(context)
+            if not self.writers:
+                self.data.unpin()
+
+    def _io(self, method, *args):
+        """Run a blocking backend method through the I/O executor.
+
+        method is the name of a backend method, or a function that is
+        called with the backend as its first argument.
+
+        Returns a Deferred.  Calls for one dataset run in order.  Backends
+        that are not threadsafe run the call inline on the reactor thread.
+        Calls made while the dataset is being finalized wait for the
+        finalized file.
+        """
+        if self._finalizing is not None:
+            d = defer.Deferred()
+            self._finalizing.append(d)
+            return d.addCallback(lambda _: self._io(method, *args))
+        return self._run(method, *args)
+
+    def _run(self, method, *args):
+        """Like _io, but run the call even while the dataset is finalized.
+
+        Rows buffered before finalize is called are written this way.
+        """
+        data = self.data
+        if callable(method):
+            f, args = method, (data,) + args
+        else:
+            f = getattr(data, method)
+        if not data.threadsafe:
+            return defer.maybeDeferred(f, *args)
+        data.pin()
+        d = self.executor.submit(self, f, *args)
+        def unpin(result):
+            data.unpin()
+            return result
+        d.addBoth(unpin)
+        return d
+
+    @property
+    def finalized(self):
+        return self._finalizing is not None or getattr(self.data, 'readonly', False)
+
+    def checkWritable(self):
+        if self.finalized:
+            raise errors.DatasetFinalizedError(self.name)
+
+    def finalize(self):
+        """Finish this dataset and reopen it read-only.
+
+        Buffered rows and metadata are written, and the HDF5 file is
+        replaced by a finished copy (see backend.finalize_hdf5_file), so
+        that later reads can memory map the rows.  No more data,
+        parameters or comments can be added.  Returns a Deferred that
+        fires once the dataset is reopened.
+        """
+        if self.finalized:
+            return defer.succeed(None)
+        if getattr(self.data, 'infofile', None) is not None:
+            raise errors.FinalizeError(self.name, 'only HDF5 datasets can be finalized')
+        hdf5_file = self.file_base + '.hdf5'
+        part_file = hdf5_file + '.part'
+        index = self.session.index
+        d = self.save()
+        self._finalizing = []
+        data = self.data
+        def write(_):
+            data.pin()
+            w = self.executor.submit(self, rewrite_in_dir, self.session.dir,
+                                     data.finalize, part_file)
+            def unpin(result):
+                data.unpin()
+                return result
+            return w.addBoth(unpin)
+        def reopen(mtimes):
+            index.rewritten(*mtimes)
+            if self.writers:
+                self.writers.clear()
+                data.unpin()
+            data.close()
+            index.rewritten(*rewrite_in_dir(self.session.dir, os.replace,
+                                            part_file, hdf5_file))
+            self.data = backend.open_backend(self.file_base)
+            self.load()
+        def failed(failure):
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            return failure
+        def done(result):
+            waiting, self._finalizing = self._finalizing, None
+            for w in waiting:
+                w.callback(None)
+            return result
+        d.addCallback(write)
+        d.addCallbacks(reopen, failed)
+        d.addBoth(done)
+        return d
 
     def makeIndependent(self, label, extended):
         """Add an independent variable to this dataset."""
@@ -393,42 +1027,236 @@ class Dataset(object):
     def getTransposeType(self):
         return self.data.getTransposeType()
 
+    def withData(self, f, *args):
+        """Call f(backend, *args) through the I/O executor, like a backend read.
+
+        Returns a Deferred that fires with the result.
+        """
+        return self._io(f, *args)
+
+    def indexLater(self):
+        """Update the search index, if any, with the metadata of this dataset."""
+        if self.search_index is not None:
+            self.search_index.datasetChanged(self)
+
     def addParameter(self, name, data, saveNow=True):
-        self.data.addParam(name, data)
-        if saveNow:
-            self.save()
+        """Add a parameter through the I/O executor.
 
-        # notify all listening contexts
-        self.hub.onNewParameter(None, self.param_listeners)
-        self.param_listeners = set()
-        return name
+        Returns a Deferred that fires with the name once it is added.
+        """
+        self.checkWritable()
+        d = self._io('addParam', name, data)
+        return d.addCallback(self._paramsAdded, saveNow, name)
 
     def addParameters(self, params, saveNow=True):
-        for name, data in params:
-            self.data.addParam(name, data)
+        """Add (name, value) parameters; returns a Deferred, see addParameter."""
+        self.checkWritable()
+        def add(data):
+            for name, value in params:
+                data.addParam(name, value)
+        d = self._io(add)
+        return d.addCallback(self._paramsAdded, saveNow)
+
+    def _paramsAdded(self, _, saveNow, result=None):
         if saveNow:
             self.save()
+        self.indexLater()
 
         # notify all listening contexts
         self.hub.onNewParameter(None, self.param_listeners)
         self.param_listeners = set()
+        return result
 
     def getParameter(self, name, case_sensitive=True):
-        return self.data.getParameter(name, case_sensitive)
+        return self._io('getParameter', name, case_sensitive)
 
     def getParamNames(self):
-        return self.data.getParamNames()
+        return self._io('getParamNames')
+
+    def getParameters(self, names=None, case_sensitive=True):
+        return self._io('getParameters', names, case_sensitive)
 
     def addData(self, data):
-        # append the data to the file
-        self.data.addData(data)
+        """Add rows of data.
+
+        Returns a Deferred that fires once the rows are buffered or, if
+        the buffer filled up, written to the backend.
+        """
+        self.checkWritable()
+        if self._memStart is None:
+            self._memStart = len(self.data)
+        # buffer the data; it is written once the buffer is full or old enough
+        self._buffer.append(data)
+        self._bufferedRows += len(data)
+        self._bufferedBytes += data.nbytes
+        if (self._bufferedRows >= WRITE_BUFFER_ROWS or
+                self._bufferedBytes >= WRITE_BUFFER_BYTES):
+            # failures are logged by flush, and the rows stay buffered
+            d = self.flush().addErrback(lambda _: None)
+        else:
+            if self._flushCall is None:
+                self._flushCall = self.reactor.callLater(WRITE_BUFFER_DELAY, self._flushLater)
+            d = defer.succeed(None)
 
         # notify all listening contexts
         self.hub.onDataAvailable(None, self.listeners)
         self.listeners = set()
+        for context in list(self.streams):
+            self._push(context)
+        return d
+
+    def flush(self):
+        """Write any buffered rows to the backend.
+
+        Returns a Deferred that fires once they are written.  One write
+        runs at a time; rows buffered meanwhile are written after it.  If
+        a write fails, the failure is logged and its rows go back to the
+        front of the buffer to be written again later.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        if self._writing is not None:
+            d = defer.Deferred()
+            self._flushWaiters.append(d)
+            return d
+        if not self._buffer:
+            return defer.succeed(None)
+        if len(self._buffer) == 1:
+            data = self._buffer[0]
+        else:
+            data = np.concatenate(self._buffer)
+        self._writing = data
+        self._buffer = []
+        self._bufferedRows = 0
+        self._bufferedBytes = 0
+        def written(result):
+            self._writing = None
+            self._memStart += len(data)
+            return result
+        def failed(err):
+            self._writing = None
+            self._buffer.insert(0, data)
+            self._bufferedRows += len(data)
+            self._bufferedBytes += data.nbytes
+            log.err(err, 'Writing {0} rows to dataset {1} failed'.format(len(data), self.name))
+            if self._flushCall is None:
+                self._flushCall = self.reactor.callLater(WRITE_BUFFER_DELAY, self._flushLater)
+            return err
+        def release(result):
+            waiters, self._flushWaiters = self._flushWaiters, []
+            if not waiters:
+                return result
+            def fire(result):
+                for w in waiters:
+                    if isinstance(result, failure.Failure):
+                        w.errback(result)
+                    else:
+                        w.callback(None)
+            if isinstance(result, failure.Failure):
+                fire(result)
+            else:
+                # the waiters also want the rows buffered during the write
+                self.flush().addBoth(fire)
+            return result
+        d = self._run('addData', data)
+        d.addCallbacks(written, failed)
+        return d.addBoth(release)
+
+    def _flushLater(self):
+        self._flushCall = None
+        # failures are logged by flush, and retried from the buffer
+        self.flush().addErrback(lambda _: None)
+
+    def _memory(self):
+        """Get the rows held in memory, i.e. being written or buffered."""
+        parts = ([self._writing] if self._writing is not None else []) + self._buffer
+        if not parts:
+            return None
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def _memRows(self):
+        rows = self._bufferedRows
+        if self._writing is not None:
+            rows += len(self._writing)
+        return rows
 
     def getData(self, limit, start, transpose=False, simpleOnly=False):
-        return self.data.getData(limit, start, transpose, simpleOnly)
+        """Read rows from the backend.
+
+        Returns a Deferred that fires with (data, next position).  Rows
+        not yet written are read from memory; a read that starts before
+        them waits for them to be written.
+        """
+        if self._memRows() and start >= self._memStart:
+            records = self._memory()[start - self._memStart:]
+            if limit is not None:
+                records = records[:limit]
+            d = defer.maybeDeferred(self.data.formatRows, records, transpose, simpleOnly)
+            return d.addCallback(lambda data: (data, start + len(records)))
+        # readers must see everything that has been added so far; rows of
+        # a failed write are read once they are written
+        d = self.flush()
+        return d.addBoth(lambda _: self._io('getData', limit, start, transpose, simpleOnly))
+
+    def getColumns(self, columns, start, stop, step=1, mode=''):
+        """Read a selection of columns over a range of rows.
+
+        Returns a Deferred that fires with (tuple of columns, end of range).
+        Rows not yet written are read from memory and joined to the rows
+        read from the backend.
+        """
+        if not self._memRows():
+            return self._io('getColumns', columns, start, stop, step, mode)
+        memStart = self._memStart
+        start, stop = backend.slice_range(start, stop, memStart + self._memRows())
+        # the rows may be written, and leave memory, while the backend is read
+        records = self._memory()
+        if start >= memStart:
+            return defer.maybeDeferred(
+                    self._memColumns, records, memStart, columns, start, stop, step, mode)
+        if stop <= memStart:
+            return self._io('getColumns', columns, start, stop, step, mode)
+        if mode == 'minmax':
+            # decimation bins straddle the written rows, so write the rest first
+            d = self.flush()
+            return d.addBoth(lambda _: self._io('getColumns', columns, start, stop, step, mode))
+        # first row of the selection that is held in memory
+        first = start + -(-(memStart - start) // step) * step
+        def join(result):
+            cols, _ = result
+            memCols, _ = self._memColumns(
+                    records, memStart, columns, first, stop, step, mode)
+            return tuple(_join_columns(a, b) for a, b in zip(cols, memCols)), stop
+        d = self._io('getColumns', columns, start, memStart, step, mode)
+        return d.addCallback(join)
+
+    def _memColumns(self, records, memStart, columns, start, stop, step, mode):
+        """Select columns of in-memory records starting at row memStart.
+
+        Works like backend getColumns.
+        """
+        names = records.dtype.names
+        columns = backend.check_selection(columns, len(names), step, mode)
+        records = records[start - memStart:stop - memStart]
+        if mode == 'minmax':
+            cols = []
+            for idx in columns:
+                if records.dtype[names[idx]].hasobject:
+                    raise errors.ReadSelectionError('cannot decimate string column')
+                cols.append(backend.minmax_decimate(records[names[idx]], step))
+            return tuple(cols), stop
+        records = records[::step]
+        return tuple(backend.record_column(records, names[idx]) for idx in columns), stop
+
+    def hasMore(self, pos):
+        if self._memStart is None:
+            return self.data.hasMore(pos)
+        # buffered and in-flight rows come after everything the backend holds
+        return pos < self._memStart + self._memRows()
 
     def keepStreaming(self, context, pos):
         # keepStreaming does something a bit odd and has a confusing name (ERJ)
@@ -445,28 +1273,107 @@ class Dataset(object):
         #
         # If a client reads, but not to the end of the dataset, it is immediately notified that
         # there is more data for it to read, and then removed from the set of notifiers.
-        if self.data.hasMore(pos):
+        if self.hasMore(pos):
             if context in self.listeners:
                 self.listeners.remove(context)
             self.hub.onDataAvailable(None, [context])
         else:
-            self.listeners.add(context)
+            self.addListener(context, 'listeners')
+
+    def addListener(self, context, attr='listeners'):
+        """Add a context to one of the listener sets, e.g. 'param_listeners'."""
+        getattr(self, attr).add(context)
+        self.listener_index.register(context, self, attr)
+
+    def stream(self, context, pos, max_rate=0, max_rows=0, mode='', window=1):
+        """Push rows from pos onward to a context as they are added.
+
+        Rows are sent in the onDataPushed signal, in the same transposed
+        form as getColumns, so listeners need no extra request to read them.
+        At most window pushes are sent before the listener acknowledges
+        them with ackStream, and at most max_rate pushes per second.  Rows
+        that arrive meanwhile are sent together in the next push; if there
+        are more than max_rows of them they are decimated with
+        preview_columns.
+        """
+        if mode not in backend.DECIMATE_MODES:
+            raise errors.ReadSelectionError('unknown mode {0!r}'.format(mode))
+        self.stopStream(context)
+        self.streams[context] = Stream(pos, max_rate, max_rows, mode, window)
+        self._push(context)
+
+    def stopStream(self, context):
+        stream = self.streams.pop(context, None)
+        if stream is not None:
+            stream.cancel()
+
+    def ackStream(self, context):
+        """Acknowledge a push, allowing the next one to be sent."""
+        stream = self.streams.get(context)
+        if stream is not None:
+            stream.unacked = max(0, stream.unacked - 1)
+            self._push(context)
+
+    def _push(self, context):
+        """Send new rows to a streaming context if it may receive them now."""
+        stream = self.streams.get(context)
+        if (stream is None or stream.reading or stream.delayedPush is not None
+                or stream.unacked >= stream.window or not self.hasMore(stream.pos)):
+            return
+        if stream.max_rate and stream.lastPush is not None:
+            wait = stream.lastPush + 1.0 / stream.max_rate - self.reactor.seconds()
+            if wait > 0:
+                def delayed():
+                    stream.delayedPush = None
+                    self._push(context)
+                stream.delayedPush = self.reactor.callLater(wait, delayed)
+                return
+
+        stream.reading = True
+        def send(result):
+            cols, stop = result
+            stream.reading = False
+            if self.streams.get(context) is not stream:
+                return # stopped while reading
+            cols = preview_columns(cols, stream.max_rows, stream.mode)
+            stream.unacked += 1
+            stream.lastPush = self.reactor.seconds()
+            self.hub.onDataPushed((stream.pos, stop, cols), [context])
+            stream.pos = stop
+            # rows added while reading are sent next
+            self._push(context)
+        def failed(failure):
+            # the listener can restart the stream; it no longer matches the data
+            if self.streams.get(context) is stream:
+                del self.streams[context]
+            log.err(failure, 'Pushing data to streaming context failed')
+        # rows not yet written are read from memory; pushing never flushes
+        d = self.getColumns([], stream.pos, None)
+        d.addCallbacks(send, failed)
+        return d
 
     def addComment(self, user, comment):
-        self.data.addComment(user, comment)
-        self.save()
+        """Add a comment through the I/O executor; returns a Deferred."""
+        self.checkWritable()
+        def added(_):
+            self.save()
+            self.indexLater()
 
-        # notify all listening contexts
-        self.hub.onCommentsAvailable(None, self.comment_listeners)
-        self.comment_listeners = set()
+            # notify all listening contexts
+            self.hub.onCommentsAvailable(None, self.comment_listeners)
+            self.comment_listeners = set()
+        return self._io('addComment', user, comment).addCallback(added)
 
     def getComments(self, limit, start):
-        return self.data.getComments(limit, start)
+        return self._io('getComments', limit, start)
 
     def keepStreamingComments(self, context, pos):
-        if pos < self.data.numComments():
-            if context in self.comment_listeners:
-                self.comment_listeners.remove(context)
-            self.hub.onCommentsAvailable(None, [context])
-        else:
-            self.comment_listeners.add(context)
+        """Like keepStreaming, for comments; returns a Deferred."""
+        def check(count):
+            if pos < count:
+                if context in self.comment_listeners:
+                    self.comment_listeners.remove(context)
+                self.hub.onCommentsAvailable(None, [context])
+            else:
+                self.addListener(context, 'comment_listeners')
+        return self._io('numComments').addCallback(check)
@@ -1,9 +1,10 @@
 import base64
 import collections
 import datetime
+import hashlib
+import itertools
 import os
 import re
-import sys
 import time
 
 import h5py
@@ -26,19 +27,173 @@ from . import errors, util
 Independent = collections.namedtuple('Independent', ['label', 'shape', 'datatype', 'unit'])
 Dependent = collections.namedtuple('Dependent', ['label', 'legend', 'shape', 'datatype', 'unit'])
 
+## Storage layout for HDF5 datasets
+
+# chunk_rows = 0 picks a chunk size of roughly CHUNK_BYTES from the row size.
+# compression is '' for none, or an h5py filter name ('gzip' or 'lzf').
+# compression_opts is the gzip level (0-9) and is ignored for other filters.
+StorageOptions = collections.namedtuple('StorageOptions', ['chunk_rows', 'compression', 'compression_opts', 'shuffle'])
+
+CHUNK_BYTES = 64 * 1024 # target chunk size when chunk_rows is not specified
+COMPRESSION_FILTERS = ['', 'gzip', 'lzf']
+DEFAULT_STORAGE = StorageOptions(chunk_rows=0, compression='gzip', compression_opts=4, shuffle=True)
+
+# The /DataVault dataset is over-allocated as it grows so that appending rows
+# does not change the HDF5 extent on every add.  The number of rows actually
+# written is kept in the ROWS_ATTR attribute and the spare capacity is trimmed
+# when the file is closed.
+ROWS_ATTR = 'Rows'
+MIN_CAPACITY = 1024 # smallest allocation when a dataset first grows
+GROWTH_FACTOR = 2
+
+# Finished datasets are rewritten by finalize_hdf5_file with this file
+# attribute set, and are opened read-only from then on.  If the rows need
+# no decoding by HDF5 (no filters and no strings) they are stored
+# contiguously, so that reads can map them straight from the file.
+FINALIZED_ATTR = 'Finalized'
+
+## Column selection for sliced reads
+
+# mode '' returns every step-th row; 'minmax' splits the range into bins of
+# step rows and returns the minimum and maximum of each column in each bin,
+# so that peaks survive downsampling.
+DECIMATE_MODES = ['', 'minmax']
+READ_BLOCK_ROWS = 1024 * 1024 # rows read at a time while decimating or reading filtered rows
+
+# Comments are appended to this dataset next to /DataVault.  Files written
+# by older versions keep their comments in the 'Comments' attribute of
+# /DataVault, which is still read but no longer written.
+COMMENTS_DATASET = 'Comments'
+COMMENT_CHUNK_ROWS = 256
+
 TIME_FORMAT = '%Y-%m-%d, %H:%M:%S'
 PRECISION = 12 # digits of precision to use when saving data
 DATA_FORMAT = '%%.%dG' % PRECISION
-FILE_TIMEOUT_SEC = 60 # how long to keep datafiles open if not accessed
+ROW_INDEX_STRIDE = 1024 # csv rows between entries in the row offset index
+CSV_BLOCK_BYTES = 1024 * 1024 # bytes read at a time when indexing csv files
+MIGRATE_BLOCK_ROWS = 64 * 1024 # csv rows copied at a time by migrate_csv_dataset
+MIGRATED_SUFFIX = '.migrated' # appended to csv and ini files after migration
+MAX_OPEN_FILES = 64 # default number of data files kept open by FILE_CACHE
 DATA_TIMEOUT = 300 # how long to keep data in memory if not accessed
 DATA_URL_PREFIX = 'data:application/labrad;base64,'
 
+def check_selection(columns, ncols, step, mode):
+    """Validate a column selection and return the list of column indices.
+
+    An empty columns list selects every column.
+    """
+    if step < 1:
+        raise errors.ReadSelectionError('step must be at least 1')
+    if mode not in DECIMATE_MODES:
+        raise errors.ReadSelectionError('unknown mode {0!r}'.format(mode))
+    columns = list(columns) if len(columns) else list(range(ncols))
+    for idx in columns:
+        if not 0 <= idx < ncols:
+            raise errors.ReadSelectionError(
+                'no column {0} in dataset with {1} columns'.format(idx, ncols))
+    return columns
+
+def slice_range(start, stop, length):
+    """Clip a start/stop row range to the length of a dataset.
+
+    stop=None reads to the end of the data.
+    """
+    if stop is None or stop > length:
+        stop = length
+    return min(start, stop), stop
+
+def minmax_decimate(data, step):
+    """Reduce each bin of step rows to its minimum and maximum.
+
+    Returns an array with two rows (min, max) per bin; a trailing partial
+    bin is reduced the same way.
+    """
+    data = np.asarray(data)
+    nfull = len(data) // step
+    full = data[:nfull*step].reshape((nfull, step) + data.shape[1:])
+    lo = [full.min(axis=1)]
+    hi = [full.max(axis=1)]
+    rest = data[nfull*step:]
+    if len(rest):
+        lo.append(rest.min(axis=0)[np.newaxis])
+        hi.append(rest.max(axis=0)[np.newaxis])
+    lo = np.concatenate(lo)
+    hi = np.concatenate(hi)
+    out = np.empty((2 * len(lo),) + data.shape[1:], dtype=data.dtype)
+    out[0::2] = lo
+    out[1::2] = hi
+    return out
+
+def records_from_bytes(buf, dtype, rows=None):
+    """Reinterpret a buffer of packed little-endian rows as records of dtype.
+
+    No data is copied; the records are a read-only view of buf.  rows, if
+    given, must match the size of the buffer.  Columns stored as variable
+    length strings have no fixed-size binary form and are not supported.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.hasobject:
+        raise errors.RawDataError('dataset has string columns')
+    dtype = dtype.newbyteorder('<')
+    if len(buf) % dtype.itemsize:
+        raise errors.RawDataError(
+            '{0} bytes is not a whole number of {1}-byte rows'.format(len(buf), dtype.itemsize))
+    if rows and len(buf) != rows * dtype.itemsize:
+        raise errors.RawDataError(
+            'expected {0} rows of {1} bytes, got {2} bytes'.format(rows, dtype.itemsize, len(buf)))
+    return np.frombuffer(buf, dtype=dtype)
+
+def record_column(records, name):
+    """Get one field of a struct array of rows as a column.
+
+    Columns come out as they are read from a file: strings as a list of
+    str, everything else as a contiguous array.
+    """
+    return _as_column(records[name])
+
+def _as_column(col):
+    if col.dtype == object:
+        return [x.decode('utf-8') if isinstance(x, bytes) else str(x)
+                for x in col]
+    return np.ascontiguousarray(col)
+
 def time_to_str(t):
     return t.strftime(TIME_FORMAT)
 
 def time_from_str(s):
     return datetime.datetime.strptime(s, TIME_FORMAT)
 
+def make_storage_options(chunk_rows=0, compression='', compression_opts=0, shuffle=False):
+    """Build a validated StorageOptions tuple."""
+    if compression not in COMPRESSION_FILTERS:
+        raise errors.StorageOptionsError(
+            "compression must be one of {}, not '{}'".format(COMPRESSION_FILTERS, compression))
+    if compression == 'gzip' and not 0 <= compression_opts <= 9:
+        raise errors.StorageOptionsError(
+            "gzip level must be between 0 and 9, not {}".format(compression_opts))
+    return StorageOptions(int(chunk_rows), compression, int(compression_opts), bool(shuffle))
+
+def create_data_vault_dataset(h5file, dtype, storage=None):
+    """Create the resizable /DataVault dataset using the given storage policy.
+
+    Files written before storage options existed used h5py's default chunking
+    without compression; h5py reads those and filtered files transparently.
+    """
+    if storage is None:
+        storage = DEFAULT_STORAGE
+    dtype = np.dtype(dtype)
+    chunk_rows = storage.chunk_rows
+    if chunk_rows <= 0:
+        chunk_rows = max(1, CHUNK_BYTES // max(dtype.itemsize, 1))
+    kw = {}
+    if storage.compression:
+        kw['compression'] = storage.compression
+        if storage.compression == 'gzip':
+            kw['compression_opts'] = storage.compression_opts
+        kw['shuffle'] = storage.shuffle
+    return h5file.create_dataset('DataVault', (0,), dtype=dtype, maxshape=(None,),
+                                 chunks=(chunk_rows,), **kw)
+
 def labrad_urlencode(data):
     if hasattr(T, 'FlatData'):
         # pylabrad 0.95+
@@ -76,38 +231,138 @@ def labrad_urldecode(data_url):
         raise ValueError("Trying to labrad_urldecode data that doesn't start "
                          "with prefix: {}".format(DATA_URL_PREFIX))
 
+class FileCache(object):
+    """Bounded LRU cache of open file handles.
+
+    SelfClosingFiles register here whenever they are used.  Once more than
+    max_open files are open, the least recently used ones are closed;
+    pinned files are never closed by the cache, so the limit may be
+    exceeded while many files are pinned.  Only used from the reactor
+    thread.
+    """
+    def __init__(self, max_open=MAX_OPEN_FILES):
+        self.max_open = max_open
+        self._open = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._open)
+
+    def __contains__(self, f):
+        return f in self._open
+
+    def touch(self, f, hit):
+        """Mark f as most recently used, counting a hit or a miss."""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self._open[f] = None
+        self._open.move_to_end(f)
+        self.evict(keep=f)
+
+    def discard(self, f):
+        self._open.pop(f, None)
+
+    def lookup(self, filename):
+        """Get the open SelfClosingFile for filename, or None."""
+        for f in self._open:
+            if f.open_args and f.open_args[0] == filename:
+                return f
+        return None
+
+    def evict(self, keep=None):
+        """Close least recently used files until at most max_open are open.
+
+        The file keep, which is about to be used, is never closed.
+        """
+        excess = len(self._open) - self.max_open
+        if excess <= 0:
+            return
+        for f in list(self._open):
+            if excess <= 0:
+                break
+            if f._pins or f is keep:
+                continue
+            del self._open[f]
+            self.evictions += 1
+            excess -= 1
+            f._closeFile()
+
+    def setMaxOpen(self, max_open):
+        self.max_open = max_open
+        self.evict()
+
+    def stats(self):
+        """Get (open, max_open, hits, misses, evictions)."""
+        return (len(self._open), self.max_open,
+                self.hits, self.misses, self.evictions)
+
+FILE_CACHE = FileCache()
+
 class SelfClosingFile(object):
     """A container for a file object that manages the underlying file handle.
 
-    The file will be opened on demand when this container is called, then
-    closed automatically if not accessed within a specified timeout.
+    The file will be opened on demand when this container is called, and
+    closed again when it is evicted from a FileCache (FILE_CACHE by default)
+    because too many other files have been used since.
+
+    While pinned, the file stays open and may be used from I/O threads;
+    the cache is only touched from the reactor thread by pin and unpin.
     """
-    def __init__(self, opener=open, open_args=(), open_kw={},
-                 timeout=FILE_TIMEOUT_SEC, touch=True, reactor=reactor):
+    def __init__(self, opener=open, open_args=(), open_kw={}, touch=True,
+                 cache=None):
         self.opener = opener
         self.open_args = open_args
         self.open_kw = open_kw
-        self.timeout = timeout
         self.callbacks = []
-        self.reactor = reactor
+        self.cache = cache if cache is not None else FILE_CACHE
+        self._pins = 0
+        self._closeRequested = False
         if touch:
             self.__call__()
 
     def __call__(self):
         if not hasattr(self, '_file'):
             self._file = self.opener(*self.open_args, **self.open_kw)
-            self._fileTimeoutCall = self.reactor.callLater(
-                    self.timeout, self._fileTimeout)
-        else:
-            self._fileTimeoutCall.reset(self.timeout)
+            self.cache.touch(self, hit=False)
+        elif not self._pins:
+            self.cache.touch(self, hit=True)
         return self._file
 
-    def _fileTimeout(self):
+    def pin(self):
+        """Open the file and keep it open until a matching unpin."""
+        self()
+        self._pins += 1
+
+    def unpin(self):
+        self._pins -= 1
+        if not self._pins:
+            if self._closeRequested:
+                self.close()
+            else:
+                self.cache.evict()
+
+    def _closeFile(self):
         for callback in self.callbacks:
             callback(self)
         self._file.close()
         del self._file
-        del self._fileTimeoutCall
+
+    def close(self):
+        """Close the file now if it is open, running the onClose callbacks.
+
+        If the file is pinned, it is closed when the last pin is released.
+        """
+        if self._pins:
+            self._closeRequested = True
+            return
+        self._closeRequested = False
+        if hasattr(self, '_file'):
+            self.cache.discard(self)
+            self._closeFile()
 
     def size(self):
         return os.fstat(self().fileno()).st_size
@@ -116,6 +371,33 @@ class SelfClosingFile(object):
         """Calls callback *before* the file is closes."""
         self.callbacks.append(callback)
 
+class _OpenFile(object):
+    """Stands in for a SelfClosingFile around a file the caller has open.
+
+    It is never registered in a FileCache, so it may be used from I/O
+    threads.  close runs the onClose callbacks but leaves closing the file
+    to the caller.
+    """
+    def __init__(self, f):
+        self._file = f
+        self.callbacks = []
+
+    def __call__(self):
+        return self._file
+
+    def pin(self):
+        pass
+
+    def unpin(self):
+        pass
+
+    def onClose(self, callback):
+        self.callbacks.append(callback)
+
+    def close(self):
+        for callback in self.callbacks:
+            callback(self)
+
 class IniData(object):
     """Handles dataset metadata stored in INI files.
 
@@ -232,8 +514,7 @@ class IniData(object):
             time = time_to_str(time)
             S.set(sec, 'c{}'.format(i), repr((time, user, comment)))
 
-        with open(self.infofile, 'w') as f:
-            S.write(f)
+        util.write_config(S, self.infofile)
 
     def initialize_info(self, title, indep, dep):
         self.title = title
@@ -251,6 +532,9 @@ class IniData(object):
     def access(self):
         self.accessed = datetime.datetime.now()
 
+    def getTitle(self):
+        return self.title
+
     def getIndependents(self):
         return self.independents
 
@@ -291,6 +575,12 @@ class IniData(object):
     def getParamNames(self):
         return [p['label'] for p in self.parameters]
 
+    def getParameters(self, names=None, case_sensitive=True):
+        """Get (name, value) pairs for the given parameters, or all of them."""
+        if names is None:
+            return [(p['label'], p['data']) for p in self.parameters]
+        return [(name, self.getParameter(name, case_sensitive)) for name in names]
+
     def addComment(self, user, comment):
         self.comments.append((datetime.datetime.now(), user, comment))
 
@@ -310,15 +600,16 @@ class CsvListData(IniData):
     Stores the entire contents of the file in memory as a list or numpy array
     """
 
+    # the in-memory data is expired by reactor timers, so reads and writes
+    # must stay on the reactor thread
+    threadsafe = False
+
     def __init__(self,
                  filename,
-                 file_timeout=FILE_TIMEOUT_SEC,
                  data_timeout=DATA_TIMEOUT,
                  reactor=reactor):
         self.filename = filename
-        self._file = SelfClosingFile(open_args=(filename, 'a+'),
-                                     timeout=file_timeout,
-                                     reactor=reactor)
+        self._file = SelfClosingFile(open_args=(filename, 'a+'))
         self.timeout = data_timeout
         self.infofile = filename[:-4] + '.ini'
         self.reactor = reactor
@@ -327,6 +618,15 @@ class CsvListData(IniData):
     def file(self):
         return self._file()
 
+    def close(self):
+        self._file.close()
+
+    def pin(self):
+        self._file.pin()
+
+    def unpin(self):
+        self._file.unpin()
+
     @property
     def version(self):
         return np.asarray([1,0,0], np.int32)
@@ -380,63 +680,87 @@ class CsvListData(IniData):
             data = self.data[start:start+limit]
         return data, start + len(data)
 
+    def formatRows(self, records, transpose, simpleOnly):
+        """Format rows not yet in the file the way getData returns them."""
+        if transpose:
+            raise RuntimeError("Transpose specified for simple data format: not supported")
+        return [[float(v) for v in row] for row in records.tolist()]
+
+    def getColumns(self, columns, start, stop, step, mode):
+        """Read a selection of columns over a range of rows.
+
+        The csv data is held in memory, so the selection is made with numpy
+        slicing.  Returns (tuple of column arrays, end of the range).
+        """
+        columns = check_selection(columns, self.cols, step, mode)
+        data = np.asarray(self.data, dtype=float)
+        if data.size == 0:
+            data = data.reshape((0, self.cols))
+        start, stop = slice_range(start, stop, len(data))
+        if mode == 'minmax':
+            cols = minmax_decimate(data[start:stop, columns], step).T
+        else:
+            cols = data[start:stop:step, columns].T
+        return tuple(np.ascontiguousarray(col) for col in cols), stop
+
     def hasMore(self, pos):
         return pos < len(self.data)
 
+    def __len__(self):
+        return len(self.data)
+
 class CsvNumpyData(CsvListData):
     """Data backed by a csv-formatted file.
 
-    Stores the entire contents of the file in memory as a list or numpy array
+    Rows are parsed incrementally into a numpy buffer that grows
+    geometrically, so appending to the file only costs the new rows.  A
+    sidecar row index (see CsvRowIndex) gives random access to row ranges
+    without parsing the rest of the file.
     """
 
     def __init__(self, filename, reactor=reactor):
         self.filename = filename
-        self._file = SelfClosingFile(open_args=(filename, 'a+'), reactor=reactor)
+        self._file = SelfClosingFile(open_args=(filename, 'a+'))
         self.infofile = filename[:-4] + '.ini'
+        self.index = CsvRowIndex(filename, filename[:-4] + '.idx')
         self.reactor = reactor
 
     @property
     def file(self):
         return self._file()
 
-    def _get_data(self):
+    @property
+    def data(self):
         """Read data from file on demand.
 
-        The data is scheduled to be cleared from memory unless accessed."""
+        Only rows added to the file since the last access are parsed.  The
+        data is scheduled to be cleared from memory unless accessed."""
         if not hasattr(self, '_data'):
-            try:
-                # if the file is empty, this line can barf in certain versions
-                # of numpy.  Clearly, if the file does not exist on disk, this
-                # will be the case.  Even if the file exists on disk, we must
-                # check its size
-                if self._file.size() > 0:
-                    self.file.seek(0)
-                    self._data = np.loadtxt(self.file, delimiter=',')
-                else:
-                    self._data = np.array([[]])
-                if len(self._data.shape) == 1:
-                    self._data.shape = (1, len(self._data))
-            except ValueError:
-                # no data saved yet
-                # this error is raised by numpy <=1.2
-                self._data = np.array([[]])
-            except IOError:
-                # no data saved yet
-                # this error is raised by numpy 1.3
-                self.file.seek(0)
-                self._data = np.array([[]])
+            self._data = None
+            self._nrows = 0
             self._timeout_call = self.reactor.callLater(DATA_TIMEOUT, self._on_timeout)
         else:
             self._timeout_call.reset(DATA_TIMEOUT)
-        return self._data
-
-    def _set_data(self, data):
-        self._data = data
-
-    data = property(_get_data, _set_data)
+        rows = self.index.readRows(self._nrows, None)
+        if len(rows):
+            needed = self._nrows + len(rows)
+            if self._data is None or needed > len(self._data):
+                capacity = max(needed, MIN_CAPACITY)
+                if self._data is not None:
+                    capacity = max(capacity, len(self._data) * GROWTH_FACTOR)
+                buf = np.empty((capacity, rows.shape[1]))
+                if self._data is not None:
+                    buf[:self._nrows] = self._data[:self._nrows]
+                self._data = buf
+            self._data[self._nrows:needed] = rows
+            self._nrows = needed
+        if not self._nrows:
+            return np.array([[]])
+        return self._data[:self._nrows]
 
     def _on_timeout(self):
         del self._data
+        del self._nrows
         del self._timeout_call
 
     def _saveData(self, data):
@@ -450,22 +774,17 @@ class CsvNumpyData(CsvListData):
         if len(data[0]) != self.cols:
             raise errors.BadDataError(self.cols, len(data[0]))
 
-        # Ordinarily, we are using record arrays, but for numpy savetxt we want a 2-D array
-        record_data = util.from_record_array(data)
-        # append data to in-memory data
-        if self.data.size > 0:
-            self.data = np.vstack((self.data, record_data))
-        else:
-            self.data = record_data
-
-        # append data to file
+        # append data to file; the in-memory data picks it up when next read
         self._saveData(data)
 
     def getData(self, limit, start, transpose, simpleOnly):
         if transpose:
             raise RuntimeError("Transpose specified for simple data format: not supported")
 
-        if limit is None:
+        if limit is not None and not hasattr(self, '_data'):
+            # read just the requested rows rather than loading the file
+            data = self.index.readRows(start, start + limit)
+        elif limit is None:
             data = self.data[start:]
         else:
             data = self.data[start:start+limit]
@@ -473,14 +792,159 @@ class CsvNumpyData(CsvListData):
         nrows = len(data) if data.size > 0 else 0
         return data, start + nrows
 
+    def formatRows(self, records, transpose, simpleOnly):
+        """Format rows not yet in the file the way getData returns them."""
+        if transpose:
+            raise RuntimeError("Transpose specified for simple data format: not supported")
+        return np.array(records.tolist(), dtype=float).reshape((len(records), self.cols))
+
     def hasMore(self, pos):
-        # cheesy hack: if pos == 0, we only need to check whether
-        # the filesize is nonzero
-        if pos == 0:
-            return os.path.getsize(self.filename) > 0
+        return pos < len(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+class CsvRowIndex(object):
+    """Row offset index for a csv data file.
+
+    Records the byte offset of every ROW_INDEX_STRIDE-th row so that a range
+    of rows can be parsed by seeking close to it.  The file is scanned
+    incrementally from the end of the last complete row seen, and the index
+    is stored in a sidecar file (int64: stride, rows, end offset, then the
+    offsets) so that reopening an archived dataset does not rescan it.
+    """
+
+    def __init__(self, filename, indexfile):
+        self.filename = filename
+        self.indexfile = indexfile
+        self.rows = 0 # number of complete rows
+        self.end = 0 # byte offset just past the last complete row
+        self.offsets = [] # offset of row i * ROW_INDEX_STRIDE
+        self._load()
+
+    def _load(self):
+        try:
+            raw = np.fromfile(self.indexfile, dtype='<i8')
+            size = os.path.getsize(self.filename)
+        except (IOError, OSError, ValueError):
+            return
+        if len(raw) < 3 or raw[0] != ROW_INDEX_STRIDE:
+            return
+        rows, end, offsets = int(raw[1]), int(raw[2]), raw[3:]
+        if end > size or len(offsets) != -(-rows // ROW_INDEX_STRIDE):
+            return
+        if end:
+            # the file must still end a row where the index says it does
+            with open(self.filename, 'rb') as f:
+                f.seek(end - 1)
+                if f.read(1) != b'\n':
+                    return
+        self.rows, self.end, self.offsets = rows, end, [int(x) for x in offsets]
+
+    def _save(self):
+        header = [ROW_INDEX_STRIDE, self.rows, self.end]
+        tmp = self.indexfile + '.tmp'
+        try:
+            np.asarray(header + self.offsets, dtype='<i8').tofile(tmp)
+            os.replace(tmp, self.indexfile)
+        except (IOError, OSError):
+            # the index is only a cache; read-only archives just rescan
+            pass
+
+    def update(self):
+        """Index any complete rows appended to the file since the last scan."""
+        try:
+            f = open(self.filename, 'rb')
+        except (IOError, OSError):
+            return
+        entries = len(self.offsets)
+        with f:
+            f.seek(self.end)
+            pos = self.end
+            while True:
+                block = f.read(CSV_BLOCK_BYTES)
+                if not block:
+                    break
+                ends = pos + 1 + np.flatnonzero(np.frombuffer(block, np.uint8) == 10)
+                pos += len(block)
+                if not len(ends):
+                    continue
+                # row self.rows + k starts where row self.rows + k - 1 ended
+                starts = np.concatenate(([self.end], ends[:-1]))
+                first = -self.rows % ROW_INDEX_STRIDE
+                self.offsets.extend(int(x) for x in starts[first::ROW_INDEX_STRIDE])
+                self.rows += len(ends)
+                self.end = int(ends[-1])
+        if len(self.offsets) != entries:
+            self._save()
+
+    def __len__(self):
+        self.update()
+        return self.rows
+
+    def readRows(self, start, stop):
+        """Parse rows start:stop (stop=None for all) into a 2-D float array."""
+        self.update()
+        if stop is None or stop > self.rows:
+            stop = self.rows
+        if start >= stop:
+            return np.empty((0, 0))
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offsets[start // ROW_INDEX_STRIDE])
+            for _ in range(start % ROW_INDEX_STRIDE):
+                f.readline()
+            lines = [f.readline().decode('ascii') for _ in range(stop - start)]
+        return np.loadtxt(lines, delimiter=',', ndmin=2)
+
+def _to_str(s):
+    """Convert a vlen string read by h5py, which may be bytes, to str."""
+    if isinstance(s, bytes):
+        return s.decode('utf-8')
+    return str(s)
+
+def hdf5_row_type(columns):
+    """Build the labrad row type tag for a list of HDF5 dataset columns."""
+    column_types = []
+    for col in columns:
+        base_type = col.datatype
+        if base_type in ['v', 'c']:
+            unit_tag = '[{}]'.format(col.unit)
+        else:
+            unit_tag = ''
+        if len(col.shape) > 1:
+            shape_tag = '*{}'.format(len(col.shape))
+            comment = util.braced(','.join(str(s) for s in col.shape))
+        elif col.shape[0] > 1:
+            shape_tag = '*'
+            comment = util.braced(str(col.shape[0]))
+        else:
+            shape_tag = ''
+            comment = ''
+        column_types.append(shape_tag + base_type + unit_tag + comment)
+    type_tag = '*({})'.format(','.join(column_types))
+    return type_tag
+
+def hdf5_transpose_type(columns):
+    """Build the labrad transposed type tag for a list of HDF5 dataset columns."""
+    column_type = []
+    for col in columns:
+        base_type = col.datatype
+        if base_type in ['v', 'c']:
+            unit_tag = '[{}]'.format(col.unit)
         else:
-            nrows = len(self.data) if self.data.size > 0 else 0
-            return pos < nrows
+            unit_tag = ''
+        if len(col.shape) > 1:
+            shape_tag = '*{}'.format(len(col.shape) + 1)
+            comment = util.braced('N,' + ','.join(str(s) for s in col.shape))
+        elif col.shape[0] > 1:
+            shape_tag = '*2'
+            comment = util.braced('N,' + str(col.shape[0]))
+        else:
+            shape_tag = '*'
+            comment = ''
+        column_type.append(shape_tag + base_type + unit_tag + comment)
+    type_tag = '({})'.format(','.join(column_type))
+    return type_tag
 
 class HDF5MetaData(object):
     """Class to store metadata inside the file itself.
@@ -497,17 +961,68 @@ class HDF5MetaData(object):
         ('Comment', h5py.special_dtype(vlen=str))
     ]
 
+    # column metadata and data type read from the file; None until loaded
+    _columns = None
+    _dtype = None
+    _legacy_comments = None
+    # parameter index and decoded values; None until first used and reset
+    # whenever a parameter is added
+    _params = None
+    _params_lower = None
+    _param_values = None
+
     def load(self):
-        """Load and save do nothing because HDF5 metadata is accessed live"""
-        pass
+        """Read the column metadata into memory.
+
+        The rest of the metadata is accessed live in the file.
+        """
+        self._loadColumns()
 
     def save(self):
         """Load and save do nothing because HDF5 metadata is accessed live"""
         pass
 
+    def _loadColumns(self):
+        """Read the variables once and derive the type tags."""
+        attrs = self.dataset.attrs
+        keys = set(attrs.keys())
+        indep = []
+        for idx in itertools.count():
+            prefix = 'Independent{}.'.format(idx)
+            if prefix + 'label' not in keys:
+                break
+            indep.append(Independent(attrs[prefix + 'label'],
+                                     attrs[prefix + 'shape'],
+                                     attrs[prefix + 'datatype'],
+                                     attrs[prefix + 'unit']))
+        dep = []
+        for idx in itertools.count():
+            prefix = 'Dependent{}.'.format(idx)
+            if prefix + 'label' not in keys:
+                break
+            dep.append(Dependent(attrs[prefix + 'label'],
+                                 attrs[prefix + 'legend'],
+                                 attrs[prefix + 'shape'],
+                                 attrs[prefix + 'datatype'],
+                                 attrs[prefix + 'unit']))
+        cols = indep + dep
+        self._columns = {
+            'independents': indep,
+            'dependents': dep,
+            'row_type': hdf5_row_type(cols),
+            'transpose_type': hdf5_transpose_type(cols),
+        }
+
+    def _getColumns(self):
+        if self._columns is None:
+            self._loadColumns()
+        return self._columns
+
     @property
     def dtype(self):
-        return self.dataset.dtype
+        if self._dtype is None:
+            self._dtype = self.dataset.dtype
+        return self._dtype
 
     def initialize_info(self, title, indep, dep):
         """Initializes the metadata for a newly created dataset."""
@@ -518,6 +1033,8 @@ class HDF5MetaData(object):
         attrs['Access Time'] = t
         attrs['Modification Time'] = t
         attrs['Creation Time'] = t
+        # comments go in the /Comments dataset; the empty attribute is kept
+        # for older versions that expect it
         attrs['Comments'] = np.ndarray((0,), dtype=self.comment_type)
 
         for idx, i in enumerate(indep):
@@ -535,81 +1052,47 @@ class HDF5MetaData(object):
             attrs[prefix + 'datatype'] = d.datatype
             attrs[prefix + 'unit'] = d.unit
 
+        # read back on next use so values have the same types as on open
+        self._columns = None
+        self._dtype = None
+
     def access(self):
         self.dataset.attrs['Access Time'] = time.time()
 
+    def getTitle(self):
+        return _to_str(self.dataset.attrs['Title'])
+
     def getIndependents(self):
-        attrs = self.dataset.attrs
-        rv = []
-        for idx in range(sys.maxsize):
-            prefix = 'Independent{}.'.format(idx)
-            key = prefix + 'label'
-            if key in attrs:
-                label = attrs[prefix + 'label']
-                shape = attrs[prefix + 'shape']
-                datatype = attrs[prefix + 'datatype']
-                unit = attrs[prefix + 'unit']
-                rv.append(Independent(label, shape, datatype, unit))
-            else:
-                return rv
+        return list(self._getColumns()['independents'])
 
     def getDependents(self):
-        attrs = self.dataset.attrs
-        rv = []
-        for idx in range(sys.maxsize):
-            prefix = 'Dependent{}.'.format(idx)
-            key = prefix + 'label'
-            if key in attrs:
-                label = attrs[prefix + 'label']
-                legend = attrs[prefix + 'legend']
-                shape = attrs[prefix + 'shape']
-                datatype = attrs[prefix + 'datatype']
-                unit = attrs[prefix + 'unit']
-                rv.append(Dependent(label, legend, shape, datatype, unit))
-            else:
-                return rv
+        return list(self._getColumns()['dependents'])
 
     def getRowType(self):
-        column_types = []
-        for col in self.getIndependents() + self.getDependents():
-            base_type = col.datatype
-            if base_type in ['v', 'c']:
-                unit_tag = '[{}]'.format(col.unit)
-            else:
-                unit_tag = ''
-            if len(col.shape) > 1:
-                shape_tag = '*{}'.format(len(col.shape))
-                comment = util.braced(','.join(str(s) for s in col.shape))
-            elif col.shape[0] > 1:
-                shape_tag = '*'
-                comment = util.braced(str(col.shape[0]))
-            else:
-                shape_tag = ''
-                comment = ''
-            column_types.append(shape_tag + base_type + unit_tag + comment)
-        type_tag = '*({})'.format(','.join(column_types))
-        return type_tag
+        return self._getColumns()['row_type']
 
     def getTransposeType(self):
-        column_type = []
-        for col in self.getIndependents() + self.getDependents():
-            base_type = col.datatype
-            if base_type in ['v', 'c']:
-                unit_tag = '[{}]'.format(col.unit)
-            else:
-                unit_tag = ''
-            if len(col.shape) > 1:
-                shape_tag = '*{}'.format(len(col.shape) + 1)
-                comment = util.braced('N,' + ','.join(str(s) for s in col.shape))
-            elif col.shape[0] > 1:
-                shape_tag = '*2'
-                comment = util.braced('N,' + str(col.shape[0]))
-            else:
-                shape_tag = '*'
-                comment = ''
-            column_type.append(shape_tag + base_type + unit_tag + comment)
-        type_tag = '({})'.format(','.join(column_type))
-        return type_tag
+        return self._getColumns()['transpose_type']
+
+    def _getParams(self):
+        """Index the parameter attributes by name.
+
+        Maps parameter name to attribute key, in file order, plus a map from
+        lowercase name to the first parameter with that name for
+        case-insensitive lookups.
+        """
+        if self._params is None:
+            params = collections.OrderedDict()
+            lower = {}
+            for k in self.dataset.attrs:
+                if k.startswith('Param.'):
+                    name = str(k[6:])
+                    params[name] = k
+                    lower.setdefault(name.lower(), name)
+            self._params = params
+            self._params_lower = lower
+            self._param_values = {}
+        return self._params
 
     def addParam(self, name, data):
         keyname = 'Param.{}'.format(name)
@@ -617,18 +1100,37 @@ class HDF5MetaData(object):
             raise errors.ParameterInUseError(name)
         value = labrad_urlencode(data)
         self.dataset.attrs[keyname] = value
+        # rebuilt on the next lookup
+        self._params = None
+        self._params_lower = None
+        self._param_values = None
+
+    def _paramValue(self, name):
+        """Decode a parameter by its exact name, caching the result."""
+        values = self._param_values
+        if name not in values:
+            values[name] = labrad_urldecode(self.dataset.attrs[self._params[name]])
+        return values[name]
 
     def getParameter(self, name, case_sensitive=True):
         """Get a parameter from the dataset."""
-        keyname = 'Param.{}'.format(name)
-        if case_sensitive:
-            if keyname in self.dataset.attrs:
-                return labrad_urldecode(self.dataset.attrs[keyname])
-        else:
-            for k in self.dataset.attrs:
-                if k.lower() == keyname.lower():
-                    return labrad_urldecode(self.dataset.attrs[k])
-        raise errors.BadParameterError(name)
+        params = self._getParams()
+        if not case_sensitive:
+            name = self._params_lower.get(name.lower(), name)
+        if name not in params:
+            raise errors.BadParameterError(name)
+        return self._paramValue(name)
+
+    def getParameters(self, names=None, case_sensitive=True):
+        """Get (name, value) pairs for the given parameters, or all of them.
+
+        Decoded values are cached, so repeated requests do not decode the
+        data-urls again.
+        """
+        params = self._getParams()
+        if names is None:
+            return [(name, self._paramValue(name)) for name in params]
+        return [(name, self.getParameter(name, case_sensitive)) for name in names]
 
     def getParamNames(self):
         """Get the names of all dataset parameters.
@@ -636,43 +1138,304 @@ class HDF5MetaData(object):
         Parameter names in the HDF5 file are prefixed with 'Param.' to avoid
         conflicts with the other metadata.
         """
-        names = [str(k[6:]) for k in self.dataset.attrs if k.startswith('Param.')]
-        return names
+        return list(self._getParams())
 
-    def addComment(self, user, comment):
-        """Add a comment to the dataset."""
-        t = time.time()
+    def _legacyComments(self):
+        """Comments stored in the 'Comments' attribute by older versions.
+
+        The attribute is no longer written, so it is read only once.
+        """
+        if self._legacy_comments is None:
+            attrs = self.dataset.attrs
+            if 'Comments' in attrs:
+                self._legacy_comments = attrs['Comments']
+            else:
+                self._legacy_comments = np.ndarray((0,), dtype=self.comment_type)
+        return self._legacy_comments
+
+    def _commentsDataset(self, create=False):
+        """Get the /Comments dataset, or None if there are no new-style comments."""
+        group = self.dataset.parent
+        if COMMENTS_DATASET in group:
+            return group[COMMENTS_DATASET]
+        if create:
+            return group.create_dataset(COMMENTS_DATASET, (0,),
+                                        dtype=self.comment_type,
+                                        maxshape=(None,),
+                                        chunks=(COMMENT_CHUNK_ROWS,))
+        return None
+
+    def addComment(self, user, comment, timestamp=None):
+        """Add a comment to the dataset, timestamped now unless given."""
+        t = time.time() if timestamp is None else timestamp
         new_comment = np.array([(t, user, comment)], dtype=self.comment_type)
-        old_comments = self.dataset.attrs['Comments']
-        data = np.hstack((old_comments, new_comment))
-        self.dataset.attrs.create('Comments', data, dtype=self.comment_type)
+        comments = self._commentsDataset(create=True)
+        n = comments.shape[0]
+        comments.resize((n + 1,))
+        comments[n:n+1] = new_comment
 
     def getComments(self, limit, start):
-        """Get comments in [(datetime, username, comment), ...] format."""
-        if limit is None:
-            raw_comments = self.dataset.attrs['Comments'][start:]
-        else:
-            raw_comments = self.dataset.attrs['Comments'][start:start+limit]
-        comments = [(datetime.datetime.fromtimestamp(c[0]), str(c[1]), str(c[2])) for c in raw_comments]
+        """Get comments in [(datetime, username, comment), ...] format.
+
+        Legacy comments from the attribute come first, followed by those in
+        the /Comments dataset; only the requested slice is read.
+        """
+        legacy = self._legacyComments()
+        nlegacy = len(legacy)
+        stop = self.numComments()
+        if limit is not None:
+            stop = min(stop, start + limit)
+        start = min(start, stop)
+        raw_comments = list(legacy[start:min(stop, nlegacy)])
+        if stop > nlegacy:
+            comments = self._commentsDataset()
+            raw_comments.extend(comments[max(start, nlegacy) - nlegacy:stop - nlegacy])
+        comments = [(datetime.datetime.fromtimestamp(c[0]), _to_str(c[1]), _to_str(c[2]))
+                    for c in raw_comments]
         return comments, start+len(comments)
 
     def numComments(self):
-        return len(self.dataset.attrs['Comments'])
+        comments = self._commentsDataset()
+        n = len(self._legacyComments())
+        if comments is not None:
+            n += comments.shape[0]
+        return n
+
+class HDF5Data(HDF5MetaData):
+    """Row storage shared by the HDF5 dataset formats.
+
+    Rows are appended into an over-allocated /DataVault dataset.  The logical
+    length is len(self); any rows beyond it are spare capacity that readers
+    never see and that is trimmed off when the file is closed.  Files written
+    before the ROWS_ATTR attribute existed use the dataset shape as length.
+    """
+
+    # data access may run in I/O threads while the file is pinned
+    threadsafe = True
+
+    # rows of a finalized file mapped into memory; None until first read,
+    # False if the rows cannot be mapped
+    _map = None
+
+    def __init__(self, fh, readonly=False):
+        self._file = fh
+        self._rows = None
+        self.readonly = readonly
+        if not readonly:
+            fh.onClose(self._trim)
+
+    def pin(self):
+        self._file.pin()
+
+    def unpin(self):
+        self._file.unpin()
+
+    @property
+    def file(self):
+        return self._file()
+
+    @property
+    def dataset(self):
+        return self.file["DataVault"]
+
+    def initialize_info(self, title, indep, dep):
+        HDF5MetaData.initialize_info(self, title, indep, dep)
+        self.dataset.attrs[ROWS_ATTR] = 0
+        self._rows = 0
+
+    def addData(self, data):
+        """Append rows from a numpy struct array, growing capacity geometrically."""
+        new_rows = len(data)
+        old_rows = len(self)
+        rows = old_rows + new_rows
+        dataset = self.dataset
+        capacity = dataset.shape[0]
+        if rows > capacity:
+            dataset.resize((max(rows, capacity * GROWTH_FACTOR, MIN_CAPACITY),))
+        dataset[old_rows:rows] = data
+        dataset.attrs[ROWS_ATTR] = rows
+        self._rows = rows
+
+    def _rowRange(self, limit, start):
+        """Get the (start, stop) slice of at most limit rows within the logical length."""
+        stop = len(self)
+        if limit is not None:
+            stop = min(stop, start + limit)
+        return min(start, stop), stop
+
+    def access(self):
+        if not self.readonly:
+            HDF5MetaData.access(self)
+
+    def _mapped(self):
+        """Get the rows of a finalized file as a read-only memmap, or None.
+
+        Only contiguous datasets without filters or strings can be mapped.
+        Readers of a mapped file share the OS page cache and skip the HDF5
+        library entirely.
+        """
+        if self._map is None:
+            self._map = False
+            dataset = self.dataset
+            if self.readonly and dataset.chunks is None and not dataset.dtype.hasobject:
+                offset = dataset.id.get_offset()
+                if offset is not None:
+                    self._map = np.memmap(self.file.filename, dtype=dataset.dtype,
+                                          mode='r', offset=offset, shape=(len(self),))
+        return self._map if self._map is not False else None
+
+    def _readRows(self, dataset, name, start, stop, step=1):
+        """Read rows start:stop:step of one field, from the memmap if possible."""
+        rows = self._mapped()
+        if rows is not None:
+            return rows[name][start:stop:step]
+        return dataset[start:stop:step, name]
+
+    def _filtered(self, dataset):
+        """Whether rows are read through HDF5 filters, e.g. decompressed."""
+        return self._mapped() is None and (
+            dataset.compression is not None or dataset.shuffle
+            or dataset.fletcher32 or dataset.scaleoffset is not None)
+
+    def _readBlocks(self, dataset, start, stop, block, step=1):
+        """Read rows start:stop:step of all fields as struct rows, block rows at a time."""
+        for lo in range(start, stop, block):
+            yield dataset[lo:min(stop, lo + block):step]
+
+    def getColumns(self, columns, start, stop, step, mode):
+        """Read a selection of columns over a range of rows.
+
+        Rows are selected with an HDF5 hyperslab (start:stop:step) on each
+        requested field, so unselected columns and skipped rows are never
+        read.  In 'minmax' mode the full range of each selected column is
+        read in blocks and reduced bin by bin.  Returns (tuple of column
+        arrays, end of the range).
+        """
+        dataset = self.dataset
+        names = dataset.dtype.names
+        columns = check_selection(columns, len(names), step, mode)
+        start, stop = slice_range(start, stop, len(self))
+        names = [names[idx] for idx in columns]
+        if mode == 'minmax':
+            cols = self._decimateColumns(dataset, names, start, stop, step)
+        else:
+            cols = self._readColumns(dataset, names, start, stop, step)
+        return cols, stop
 
-class ExtendedHDF5Data(HDF5MetaData):
+    def _readColumns(self, dataset, names, start, stop, step=1):
+        """Read rows start:stop:step of several fields of the dataset.
+
+        Each chunk of a filtered dataset is decompressed whenever it is
+        read, whichever fields are selected, so the struct rows are read
+        once in blocks and split into columns.  Unfiltered or mapped rows
+        are read field by field (see _readColumn).
+        """
+        if start == stop or not self._filtered(dataset):
+            return tuple(self._readColumn(dataset, name, start, stop, step)
+                         for name in names)
+        count = len(range(start, stop, step))
+        block = max(1, READ_BLOCK_ROWS // step) * step
+        fields = [dataset.dtype.fields[name][0] for name in names]
+        cols = [np.empty((count,) + field.shape, dtype=field.base) for field in fields]
+        pos = 0
+        for rows in self._readBlocks(dataset, start, stop, block, step):
+            for name, col in zip(names, cols):
+                col[pos:pos + len(rows)] = rows[name]
+            pos += len(rows)
+        return tuple(_as_column(col) for col in cols)
+
+    def _readColumn(self, dataset, name, start, stop, step=1):
+        """Read rows start:stop:step of a single field of the dataset."""
+        if start == stop:
+            field_dtype = dataset.dtype.fields[name][0]
+            if h5py.check_string_dtype(field_dtype) is not None:
+                return []
+            return np.empty((0,) + field_dtype.shape, dtype=field_dtype.base)
+        col = self._readRows(dataset, name, start, stop, step)
+        # Strings are stored as hdf5 vlen objects, which h5py returns as
+        # an object array of bytes.  We don't know how to flatten object
+        # arrays, so vlen columns are decoded into a list of str.
+        if col.dtype == object:
+            if h5py.check_string_dtype(dataset.dtype.fields[name][0]) is None:
+                raise RuntimeError("Found object type array, but not vlen str.  Not supported.  This shouldn't happen")
+            return [x.decode('utf-8') if isinstance(x, bytes) else str(x)
+                    for x in col]
+        return np.ascontiguousarray(col)
+
+    def _decimateColumns(self, dataset, names, start, stop, step):
+        """Min/max decimate rows start:stop of several numeric fields.
+
+        As in _readColumns, filtered rows are read once for all fields.
+        """
+        fields = [dataset.dtype.fields[name][0] for name in names]
+        for field in fields:
+            if h5py.check_string_dtype(field) is not None:
+                raise errors.ReadSelectionError('cannot decimate string column')
+        parts = [[] for _ in names]
+        # whole bins per block
+        block = max(1, READ_BLOCK_ROWS // step) * step
+        if self._filtered(dataset):
+            for rows in self._readBlocks(dataset, start, stop, block):
+                for name, part in zip(names, parts):
+                    part.append(minmax_decimate(rows[name], step))
+        else:
+            for name, part in zip(names, parts):
+                part.extend(minmax_decimate(self._readRows(dataset, name, lo, min(stop, lo + block)), step)
+                            for lo in range(start, stop, block))
+        return tuple(np.concatenate(part) if part
+                     else np.empty((0,) + field.shape, dtype=field.base)
+                     for part, field in zip(parts, fields))
+
+    def _trim(self, fh):
+        """Discard spare capacity before the file is closed."""
+        f = fh._file
+        if 'DataVault' not in f:
+            return
+        dataset = f['DataVault']
+        if ROWS_ATTR in dataset.attrs:
+            rows = int(dataset.attrs[ROWS_ATTR])
+            if dataset.shape[0] > rows:
+                dataset.resize((rows,))
+
+    def close(self):
+        """Close the underlying file, trimming it to its logical length."""
+        self._map = None
+        self._file.close()
+
+    def finalize(self, filename):
+        """Write a finished copy of this dataset to a new file.
+
+        See finalize_hdf5_file.  Buffered rows must be written first; the
+        caller replaces the file with the copy once this one is closed.
+        """
+        finalize_hdf5_file(self.file, filename, len(self))
+
+    def __len__(self):
+        if self._rows is None:
+            attrs = self.dataset.attrs
+            if ROWS_ATTR in attrs:
+                self._rows = int(attrs[ROWS_ATTR])
+            else:
+                self._rows = self.dataset.shape[0]
+        return self._rows
+
+    def hasMore(self, pos):
+        return pos < len(self)
+
+class ExtendedHDF5Data(HDF5Data):
     """Dataset backed by HDF5 file
 
     This supports the extended dataset format which allows each column
     to have a different type and to be arrays themselves.
     """
 
-    def __init__(self, fh):
-        self._file = fh
+    def __init__(self, fh, readonly=False):
+        HDF5Data.__init__(self, fh, readonly)
         if 'Version' not in self.file.attrs:
             self.file.attrs['Version'] = np.asarray([3, 0, 0], dtype=np.int32)
         self.version = np.asarray(self.file.attrs['Version'], np.int32)
 
-    def initialize_info(self, title, indep, dep):
+    def initialize_info(self, title, indep, dep, storage=None):
         """Initialize the columns when creating a new dataset"""
         dtype = []
         for idx, col in enumerate(indep + dep):
@@ -701,75 +1464,47 @@ class ExtendedHDF5Data(HDF5MetaData):
             else:
                 raise RuntimeError("Invalid type tag {}".format(ttag))
 
-        self.file.create_dataset('DataVault', (0,), dtype=dtype, maxshape=(None,))
-        HDF5MetaData.initialize_info(self, title, indep, dep)
+        create_data_vault_dataset(self.file, dtype, storage)
+        HDF5Data.initialize_info(self, title, indep, dep)
 
-    @property
-    def file(self):
-        return self._file()
+    def getData(self, limit, start, transpose, simpleOnly):
+        """Get up to limit rows from a dataset."""
+        self._checkSimple(simpleOnly)
+        if transpose:
+            return self.getDataTranspose(limit, start)
 
-    @property
-    def dataset(self):
-        return self.file["DataVault"]
+        columns, new_pos = self.getDataTranspose(limit, start)
+        row_data = list(zip(*columns))
+        return row_data, new_pos
 
-    def addData(self, data):
-        """Adds one or more rows or data from a numpy struct array."""
-        new_rows = len(data)
-        old_rows = self.dataset.shape[0]
-        self.dataset.resize((old_rows + new_rows,))
-        self.dataset[old_rows:(old_rows + new_rows)] = data
+    def formatRows(self, records, transpose, simpleOnly):
+        """Format rows not yet in the file the way getData returns them."""
+        self._checkSimple(simpleOnly)
+        columns = tuple(record_column(records, name) for name in records.dtype.names)
+        if transpose:
+            return columns
+        return list(zip(*columns))
 
-    def getData(self, limit, start, transpose, simpleOnly):
-        """Get up to limit rows from a dataset."""
+    def _checkSimple(self, simpleOnly):
         if simpleOnly:
             datatype = self.dataset.dtype
             for idx in range(len(datatype)):
                 if datatype[idx] != np.float64:
                     raise errors.DataVersionMismatchError()
-        if transpose:
-            return self.getDataTranspose(limit, start)
-
-        data, new_pos = self._getData(limit, start)
-        row_data = [tuple(row) for row in data]
-        return row_data, new_pos
 
     def getDataTranspose(self, limit, start):
-        struct_data, new_pos = self._getData(limit, start)
-        columns = []
-        for idx in range(len(struct_data.dtype)):
-            col = struct_data['f{}'.format(idx)]
-            # Strings are stored as hdf5 vlen objects.  Numpy can't do
-            # variable length strings, so they get encoded as object
-            # arrays by hdf5.  we don't know how to flatten object
-            # arrays so we special case vlen types here and convert
-            # them to lists.  Also, h5py has a bug where when you
-            # index a dataset with a compound type, it loses the
-            # special dtype information, so we pull it directly from
-            # self.dataset.dtype rather than the data returned by
-            # _getData
-            if self.dataset.dtype[idx] == np.object:
-                base_type = h5py.check_dtype(vlen=self.dataset.dtype[idx])
-                if not base_type or not issubclass(base_type, str):
-                    raise RuntimeError("Found object type array, but not vlen str.  Not supported.  This shouldn't happen")
-                col = [base_type(x) for x in col]
-            columns.append(col)
-        columns = tuple(columns)
-        return columns, new_pos
-
-    def _getData(self, limit, start):
-        if limit is None:
-            struct_data = self.dataset[start:]
-        else:
-            struct_data = self.dataset[start:start+limit]
-        return struct_data, start + struct_data.shape[0]
-
-    def __len__(self):
-        return self.dataset.shape[0]
+        """Get up to limit rows as a tuple of column arrays.
 
-    def hasMore(self, pos):
-        return pos < len(self)
+        Each field is read straight from the file into its own contiguous
+        array, so no intermediate struct array or per-row python objects
+        are created.
+        """
+        start, stop = self._rowRange(limit, start)
+        dataset = self.dataset
+        columns = self._readColumns(dataset, dataset.dtype.names, start, stop)
+        return columns, stop
 
-class SimpleHDF5Data(HDF5MetaData):
+class SimpleHDF5Data(HDF5Data):
     """Basic dataset backed by HDF5 file.
 
     This is a very simple implementation that only supports a single 2-D dataset
@@ -777,60 +1512,46 @@ class SimpleHDF5Data(HDF5MetaData):
     a filesystem-like tree of datasets within one file.  Here, the single dataset
     is stored in /DataVault within the HDF5 file.
     """
-    def __init__(self, fh):
-        self._file = fh
+    def __init__(self, fh, readonly=False):
+        HDF5Data.__init__(self, fh, readonly)
         if 'Version' not in self.file.attrs:
             self.file.attrs['Version'] = np.asarray([2, 0, 0], dtype=np.int32)
         self.version = np.asarray(self.file.attrs['Version'], dtype=np.int32)
 
-    def initialize_info(self, title, indep, dep):
+    def initialize_info(self, title, indep, dep, storage=None):
         ncol = len(indep) + len(dep)
         dtype = [('f{}'.format(idx), np.float64) for idx in range(ncol)]
         if 'DataVault' not in self.file:
-            self.file.create_dataset('DataVault', (0,), dtype=dtype, maxshape=(None,))
-        HDF5MetaData.initialize_info(self, title, indep, dep)
-
-    @property
-    def file(self):
-        return self._file()
-
-    @property
-    def dataset(self):
-        return self.file["DataVault"]
-
-    def addData(self, data):
-        """Adds one or more rows or data from a 2D array of floats."""
-        new_rows = data.shape[0]
-        old_rows = self.dataset.shape[0]
-        #if data.shape[1] != len(self.dataset.dtype):
-        #    raise errors.BadDataError(len(self.dataset.dtype), data.shape[1])
-
-        self.dataset.resize((old_rows + new_rows,))
-        #new_data = np.zeros((new_rows,), dtype=self.dataset.dtype)
-        #for col in range(data.shape[1]):
-        #    field = "f%d" % (col,)
-        #    new_data[field] = data[:,col]
-        self.dataset[old_rows:(old_rows + new_rows)] = data
+            create_data_vault_dataset(self.file, dtype, storage)
+        HDF5Data.initialize_info(self, title, indep, dep)
 
     def getData(self, limit, start, transpose, simpleOnly):
         """Get up to limit rows from a dataset."""
         if transpose:
             raise RuntimeError("Transpose specified for simple data format: not supported")
-        if limit is None:
-            struct_data = self.dataset[start:]
+        start, stop = self._rowRange(limit, start)
+        dataset = self.dataset
+        ncol = len(dataset.dtype)
+        # All columns are float64, so the packed struct rows can be read
+        # straight into a buffer and viewed as a 2-D array without copying.
+        rows = self._mapped()
+        if rows is not None:
+            struct_data = np.array(rows[start:stop])
         else:
-            struct_data = self.dataset[start:start+limit]
-        columns = []
-        for idx in range(len(struct_data.dtype)):
-            columns.append(struct_data['f{}'.format(idx)])
-        data = np.column_stack(columns)
-        return data, start + data.shape[0]
-
-    def __len__(self):
-        return self.dataset.shape[0]
-
-    def hasMore(self, pos):
-        return pos < len(self)
+            struct_data = np.empty((stop - start,), dtype=dataset.dtype)
+            if stop > start:
+                dataset.read_direct(struct_data, np.s_[start:stop])
+        data = struct_data.view(np.float64).reshape((stop - start, ncol))
+        return data, stop
+
+    def formatRows(self, records, transpose, simpleOnly):
+        """Format rows not yet in the file the way getData returns them."""
+        if transpose:
+            raise RuntimeError("Transpose specified for simple data format: not supported")
+        dataset = self.dataset
+        struct_data = np.empty((len(records),), dtype=dataset.dtype)
+        struct_data[:] = records
+        return struct_data.view(np.float64).reshape((len(records), len(dataset.dtype)))
 
 def open_hdf5_file(filename):
     """Factory for HDF5 files.
@@ -838,22 +1559,75 @@ def open_hdf5_file(filename):
     We check the version of the file to construct the proper class.  Currently, only two
     options exist: version 2.0.0 -> legacy format, 3.0.0 -> extended format.
     Version 1 is reserved for CSV files.
+
+    Files are opened for reading first.  Finalized files stay open for
+    reading only, so they take no write lock; other files are reopened for
+    appending, or stay read-only if that fails, e.g. because the file is
+    not writable.
     """
-    fh = SelfClosingFile(h5py.File, open_args=(filename, 'a'))
-    version = fh().attrs['Version']
+    fh = SelfClosingFile(h5py.File, open_args=(filename, 'r'))
+    attrs = fh().attrs
+    readonly = bool(attrs.get(FINALIZED_ATTR, False))
+    version = attrs['Version']
+    if not readonly:
+        fh.close()
+        try:
+            fh = SelfClosingFile(h5py.File, open_args=(filename, 'a'))
+        except (IOError, OSError):
+            fh = SelfClosingFile(h5py.File, open_args=(filename, 'r'))
+            readonly = True
     if version[0] == 2:
-        return SimpleHDF5Data(fh)
+        return SimpleHDF5Data(fh, readonly)
     else:
-        return ExtendedHDF5Data(fh)
+        return ExtendedHDF5Data(fh, readonly)
+
+def _copy_attrs(src, dst):
+    """Copy all attributes of an HDF5 object, keeping their stored types."""
+    for name in src.attrs:
+        dst.attrs.create(name, src.attrs[name], dtype=src.attrs.get_id(name).dtype)
+
+def finalize_hdf5_file(f, filename, rows):
+    """Write a finished copy of the open HDF5 file f to filename.
+
+    The copy holds the first rows rows of /DataVault, without spare
+    capacity, and has FINALIZED_ATTR set.  Unless there are string columns,
+    the rows are rewritten to a contiguous dataset without compression or
+    other filters, which can be memory mapped when reading.  Strings are
+    stored as HDF5 variable length data, which cannot be mapped, so such
+    datasets are copied as is, keeping their chunking and compression.
+    """
+    src = f['DataVault']
+    mappable = not src.dtype.hasobject
+    with h5py.File(filename, 'w') as out:
+        _copy_attrs(f, out)
+        for name in f:
+            if name != 'DataVault':
+                f.copy(f[name], out, name)
+        if mappable:
+            dst = out.create_dataset('DataVault', (rows,), dtype=src.dtype)
+            for lo in range(0, rows, READ_BLOCK_ROWS):
+                hi = min(rows, lo + READ_BLOCK_ROWS)
+                dst[lo:hi] = src[lo:hi]
+            _copy_attrs(src, dst)
+        else:
+            f.copy(src, out, 'DataVault')
+            out['DataVault'].resize((rows,))
+        out['DataVault'].attrs[ROWS_ATTR] = rows
+        out.attrs[FINALIZED_ATTR] = True
 
-def create_backend(filename, title, indep, dep, extended):
+def create_backend(filename, title, indep, dep, extended, storage=None):
+    """Create a new HDF5 dataset.
+
+    storage is a StorageOptions tuple giving the chunking and compression of
+    the data; if None, DEFAULT_STORAGE is used.
+    """
     hdf5_file = filename + '.hdf5'
     fh = SelfClosingFile(h5py.File, open_args=(hdf5_file, 'a'))
     if extended:
         data = ExtendedHDF5Data(fh)
     else:
         data = SimpleHDF5Data(fh)
-    data.initialize_info(title, indep, dep)
+    data.initialize_info(title, indep, dep, storage)
     return data
 
 def open_backend(filename):
@@ -875,3 +1649,118 @@ def open_backend(filename):
         return open_hdf5_file(hdf5_file)
     else: # We should have already checked, this should not happen
         raise errors.DatasetNotFoundError(filename)
+
+def _epoch(t):
+    return time.mktime(t.timetuple())
+
+def migrate_csv_dataset(filename, storage=None, remove=False):
+    """Convert a csv+ini dataset to the SimpleHDF5Data format.
+
+    filename is given without extension.  The title, timestamps, variables,
+    parameters and comments are copied from the ini file; tags live in the
+    session and follow the dataset since its name does not change.  Rows
+    are copied MIGRATE_BLOCK_ROWS at a time.  Before the new file is moved
+    into place, its row count and a SHA-256 of its data are checked against
+    the csv file, parsed again line by line independently of the copy.
+    The new file is not opened through the FILE_CACHE, so migration may run
+    in an I/O thread.  The csv and ini files are then renamed with a MIGRATED_SUFFIX
+    (or deleted if remove is True) so that open_backend finds the HDF5 file.
+
+    Returns (rows, checksum).  Raises errors.MigrationError on failure, in
+    which case the csv dataset is left untouched.
+    """
+    csv_file = filename + '.csv'
+    hdf5_file = filename + '.hdf5'
+    part_file = hdf5_file + '.part'
+    if os.path.exists(hdf5_file):
+        raise errors.MigrationError(filename, 'HDF5 file already exists')
+
+    ini = IniData()
+    ini.infofile = filename + '.ini'
+    try:
+        ini.load()
+        index = CsvRowIndex(csv_file, filename + '.idx')
+        rows = len(index)
+
+        with h5py.File(part_file, 'w') as f:
+            data = SimpleHDF5Data(_OpenFile(f))
+            try:
+                data.initialize_info(ini.title, ini.independents, ini.dependents, storage)
+                for start in range(0, rows, MIGRATE_BLOCK_ROWS):
+                    block = index.readRows(start, start + MIGRATE_BLOCK_ROWS)
+                    if block.shape[1] != ini.cols:
+                        raise errors.BadDataError(ini.cols, block.shape[1])
+                    block = np.ascontiguousarray(block, dtype='<f8')
+                    data.addData(block.view(data.dataset.dtype).reshape(len(block)))
+                for p in ini.parameters:
+                    data.addParam(p['label'], p['data'])
+                for t, user, comment in ini.comments:
+                    data.addComment(user, comment, timestamp=_epoch(t))
+                attrs = data.dataset.attrs
+                attrs['Creation Time'] = _epoch(ini.created)
+                attrs['Modification Time'] = _epoch(ini.modified)
+                attrs['Access Time'] = _epoch(ini.accessed)
+            finally:
+                data.close()
+
+        source_rows, checksum = _csv_checksum(csv_file, ini.cols)
+
+        with h5py.File(part_file, 'r') as f:
+            dataset = f['DataVault']
+            written = int(dataset.attrs[ROWS_ATTR])
+            verify = hashlib.sha256()
+            for start in range(0, written, MIGRATE_BLOCK_ROWS):
+                block = dataset[start:start + MIGRATE_BLOCK_ROWS]
+                verify.update(block.view('<f8').tobytes())
+        if written != source_rows:
+            raise errors.MigrationError(
+                filename, 'wrote {} rows, expected {}'.format(written, source_rows))
+        if verify.digest() != checksum.digest():
+            raise errors.MigrationError(filename, 'checksum mismatch')
+    except errors.MigrationError:
+        _remove_if_exists(part_file)
+        raise
+    except Exception as e:
+        _remove_if_exists(part_file)
+        raise errors.MigrationError(filename, repr(e))
+
+    os.rename(part_file, hdf5_file)
+    for old in [csv_file, ini.infofile]:
+        if remove:
+            os.remove(old)
+        else:
+            os.rename(old, old + MIGRATED_SUFFIX)
+    _remove_if_exists(index.indexfile)
+    return rows, checksum.hexdigest()
+
+def _csv_checksum(csv_file, cols):
+    """Parse every complete line of a csv data file with float.
+
+    Returns the number of rows and a SHA-256 hash of the values as little
+    endian doubles.
+    """
+    checksum = hashlib.sha256()
+    rows = 0
+    block = []
+    with open(csv_file, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break # incomplete last row, which is not copied either
+            values = [float(x) for x in line.split(b',')]
+            if len(values) != cols:
+                raise errors.BadDataError(cols, len(values))
+            block.append(values)
+            if len(block) == MIGRATE_BLOCK_ROWS:
+                checksum.update(np.asarray(block, dtype='<f8').tobytes())
+                rows += len(block)
+                block = []
+    if block:
+        checksum.update(np.asarray(block, dtype='<f8').tobytes())
+        rows += len(block)
+    return rows, checksum
+
+def _remove_if_exists(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
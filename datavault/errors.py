@@ -46,3 +46,43 @@ class DataVersionMismatchError(T.Error):
     code = 11
     def __init__(self):
         self.msg = "Dataset was created with newer API, cannot be read.  Use get_ex"
+
+class StorageOptionsError(T.Error):
+    code = 12
+    def __init__(self, msg):
+        self.msg = "Invalid storage options: {0}".format(msg)
+
+class ReadSelectionError(T.Error):
+    code = 13
+    def __init__(self, msg):
+        self.msg = "Invalid read selection: {0}".format(msg)
+
+class MigrationError(T.Error):
+    code = 14
+    def __init__(self, filename, msg):
+        self.msg = "Could not migrate dataset {0}: {1}".format(filename, msg)
+
+class RawDataError(T.Error):
+    code = 15
+    def __init__(self, msg):
+        self.msg = "Invalid raw data: {0}".format(msg)
+
+class TagSearchError(T.Error):
+    code = 16
+    def __init__(self, tagFilters):
+        self.msg = "Tag search {0} has no tag to match.".format(list(tagFilters))
+
+class SearchQueryError(T.Error):
+    code = 17
+    def __init__(self, msg):
+        self.msg = "Invalid search: {0}".format(msg)
+
+class FinalizeError(T.Error):
+    code = 18
+    def __init__(self, name, msg):
+        self.msg = "Cannot finalize dataset '{0}': {1}".format(name, msg)
+
+class DatasetFinalizedError(T.Error):
+    code = 19
+    def __init__(self, name):
+        self.msg = "Dataset '{0}' is finalized and cannot be changed.".format(name)
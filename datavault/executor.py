@@ -0,0 +1,73 @@
+"""Executors for the blocking disk I/O done by the data vault.
+
+The server submits backend reads and writes through an executor so that
+large transfers do not stall the reactor thread.  Each call is submitted
+with a key (usually a Dataset or Session); calls with the same key run one
+at a time in submission order, while calls with different keys may run
+concurrently.
+"""
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+
+IO_THREADS = 4 # default size of the I/O thread pool
+
+
+class IOExecutor(object):
+    """Runs blocking calls in a bounded thread pool."""
+
+    def __init__(self, max_threads=IO_THREADS, reactor=reactor):
+        self.reactor = reactor
+        self.pool = ThreadPool(minthreads=0, maxthreads=max_threads,
+                               name='datavault-io')
+        self._locks = {}
+        self._started = False
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            self.pool.start()
+            self.reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._started:
+            self._started = False
+            self.pool.stop()
+
+    def submit(self, key, f, *args, **kw):
+        """Run f(*args, **kw) in the pool after earlier calls with this key.
+
+        Must be called from the reactor thread.  Returns a Deferred that
+        fires with the result on the reactor thread.
+        """
+        self.start()
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = defer.DeferredLock()
+        d = lock.run(threads.deferToThreadPool, self.reactor, self.pool,
+                     f, *args, **kw)
+        d.addBoth(self._release, key, lock)
+        return d
+
+    def _release(self, result, key, lock):
+        """Forget the lock for a key once nothing is queued on it."""
+        if not lock.locked and self._locks.get(key) is lock:
+            del self._locks[key]
+        return result
+
+
+class SynchronousExecutor(object):
+    """Runs calls immediately on the calling thread.
+
+    Used when no thread pool is configured, e.g. in tests and tools.
+    """
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def submit(self, key, f, *args, **kw):
+        return defer.maybeDeferred(f, *args, **kw)
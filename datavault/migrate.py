@@ -0,0 +1,98 @@
+"""Convert the csv datasets in a data vault repository to HDF5.
+
+Usage:
+
+    python -m datavault.migrate DATADIR [--workers N] [--remove] [--dry-run]
+
+Every <name>.csv with a matching <name>.ini under DATADIR is converted to
+<name>.hdf5 in the SimpleHDF5Data format with backend.migrate_csv_dataset,
+which verifies the row count and checksum of the copy.  Datasets are
+converted in parallel in worker processes.  The original files are renamed
+with backend.MIGRATED_SUFFIX, or deleted with --remove.
+
+The data vault server should not be writing to the repository while this
+runs.  Alternatively, set the registry key 'upgrade csv' in the server's
+Storage directory to convert datasets as they are opened.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+
+from . import backend, errors
+
+
+def find_csv_datasets(datadir):
+    """Find csv datasets under datadir, as filenames without extension."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(datadir):
+        names = set(filenames)
+        for f in sorted(filenames):
+            base, ext = os.path.splitext(f)
+            if ext == '.csv' and base + '.ini' in names:
+                found.append(os.path.join(dirpath, base))
+    return found
+
+
+def migrate_one(args):
+    """Worker: convert one dataset and report (filename, rows, checksum, error)."""
+    filename, remove = args
+    try:
+        rows, checksum = backend.migrate_csv_dataset(filename, remove=remove)
+    except errors.MigrationError as e:
+        return filename, 0, None, e.msg
+    return filename, rows, checksum, None
+
+
+def migrate_all(datadir, workers=None, remove=False, report=print):
+    """Convert all csv datasets under datadir using a pool of workers.
+
+    Returns the list of (filename, error message) for datasets that failed.
+    """
+    datasets = find_csv_datasets(datadir)
+    report('Found {} csv datasets in {}'.format(len(datasets), datadir))
+    failed = []
+    jobs = [(f, remove) for f in datasets]
+    if workers == 1:
+        results = map(migrate_one, jobs)
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(migrate_one, jobs)
+    try:
+        for filename, rows, checksum, error in results:
+            if error is None:
+                report('ok      {} ({} rows, sha256 {})'.format(filename, rows, checksum))
+            else:
+                report('FAILED  {}'.format(error))
+                failed.append((filename, error))
+    finally:
+        if workers != 1:
+            pool.close()
+            pool.join()
+    report('Converted {} datasets, {} failed'.format(
+        len(datasets) - len(failed), len(failed)))
+    return failed
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description='Convert data vault csv datasets to HDF5.')
+    parser.add_argument('datadir', help='data vault repository directory')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: one per cpu)')
+    parser.add_argument('--remove', action='store_true',
+                        help='delete the csv and ini files after conversion')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only list the datasets that would be converted')
+    args = parser.parse_args(argv)
+    if args.dry_run:
+        for f in find_csv_datasets(args.datadir):
+            print(f)
+        return 0
+    failed = migrate_all(args.datadir, args.workers, args.remove)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
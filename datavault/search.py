@@ -0,0 +1,423 @@
+"""Search index over the titles, variables, parameters and comments of datasets.
+
+The index is an SQLite database, by default .index/search.sqlite in the
+data directory.  It is only kept if the 'search index' registry key is
+set, since building it reads the metadata of every dataset in the vault.
+SearchIndex.scan walks the whole vault and (re)reads the metadata of every
+dataset whose files changed since they were indexed, through the I/O
+executor.  The server runs a scan in the background when it starts, and
+keeps the index up to date afterwards by reindexing datasets when they are
+created or get new parameters or comments (see SearchIndex.datasetChanged).
+
+Queries combine full-text terms, matched against the title, variable names
+and units, parameter names and comments, with conditions on parameter
+values.  Numeric parameters are compared in base units, so a query for
+'bias' > 2 V finds a parameter stored as 2500 mV; values in other units,
+e.g. 2 s, are rejected.
+"""
+
+import os
+import sqlite3
+import threading
+
+import h5py
+import numpy as np
+from twisted.internet import defer, reactor
+from twisted.python import log
+from labrad import units as U
+
+from . import backend, errors, filename_decode, filename_encode, METADATA_SAVE_DELAY
+from .executor import SynchronousExecutor
+
+
+SEARCH_INDEX_FILE = os.path.join('.index', 'search.sqlite')
+
+# stored as the user_version of the database; an index written with another
+# schema is dropped, and rebuilt by the next scan
+SCHEMA_VERSION = 3
+
+# datasets whose metadata a scan reads at the same time
+SCAN_READS = 4
+
+# relative tolerance of '=' comparisons of numeric parameter values
+NUMBER_TOLERANCE = 1e-9
+
+PARAM_OPS = ['=', '!=', '<', '<=', '>', '>=']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    id INTEGER PRIMARY KEY,
+    session TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mtime REAL,
+    text TEXT NOT NULL,
+    comments TEXT NOT NULL,
+    ncomments INTEGER NOT NULL,
+    UNIQUE (session, name)
+);
+CREATE TABLE IF NOT EXISTS params (
+    dataset INTEGER NOT NULL,
+    name TEXT NOT NULL COLLATE NOCASE,
+    value TEXT,
+    number REAL,
+    unit TEXT
+);
+CREATE INDEX IF NOT EXISTS params_by_name ON params (name, number);
+CREATE INDEX IF NOT EXISTS params_by_dataset ON params (dataset);
+"""
+
+
+def _number(value):
+    """Get a parameter value as a float in base units, or None."""
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, U.WithUnit):
+        return float(value.inBaseUnits()._value)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)
+    return None
+
+
+def _base_unit(value):
+    """Get the base units of a parameter value, '' for plain numbers."""
+    if isinstance(value, U.WithUnit):
+        return str(value.unit.base_unit)
+    return ''
+
+
+def _session_key(path):
+    """Store a session path as text that sorts parents before children."""
+    return ''.join('/' + filename_encode(p) for p in path[1:])
+
+def _session_path(key):
+    return ('',) + tuple(filename_decode(p) for p in key.split('/')[1:])
+
+
+def _join_text(parts):
+    return '\n'.join(t for t in parts if t)
+
+
+def dataset_info(data, start=0):
+    """Collect the searchable metadata of a backend object.
+
+    Returns (text, params, comments, ncomments), where text holds the
+    title, variable labels, legends and units and parameter names, params
+    is a list of (name, value as text, numeric value in base units or None,
+    base units), comments
+    holds the users and text of the comments from number start on, and
+    ncomments is the number of comments.
+    """
+    text = [data.getTitle()]
+    for var in data.getIndependents():
+        text.extend([var.label, var.unit])
+    for var in data.getDependents():
+        text.extend([var.label, var.legend, var.unit])
+    params = []
+    for name, value in data.getParameters():
+        text.append(name)
+        params.append((name, str(value), _number(value), _base_unit(value)))
+    comments, ncomments = data.getComments(None, start)
+    comment_text = []
+    for _, user, comment in comments:
+        comment_text.extend([user, comment])
+    return _join_text(text), params, _join_text(comment_text), ncomments
+
+
+def read_ini_info(file_base):
+    """Read the searchable metadata of a csv dataset from its ini file."""
+    data = backend.IniData()
+    data.infofile = file_base + '.ini'
+    data.load()
+    return dataset_info(data)
+
+
+def read_hdf5_info(fh):
+    """Read the searchable metadata of a pinned SelfClosingFile of HDF5 data."""
+    data = backend.HDF5MetaData()
+    data.dataset = fh()['DataVault']
+    return dataset_info(data)
+
+
+def find_datasets(datadir):
+    """Find all datasets under datadir.
+
+    Returns {(session path, name): (file name without extension, mtime)}.
+    """
+    found = {}
+    for dirpath, dirnames, filenames in os.walk(datadir):
+        dirnames[:] = [d for d in dirnames if d.endswith('.dir')]
+        rel = os.path.relpath(dirpath, datadir)
+        parts = [] if rel == os.curdir else rel.split(os.sep)
+        path = ('',) + tuple(filename_decode(d[:-4]) for d in parts)
+        names = set(filenames)
+        for f in filenames:
+            base, ext = os.path.splitext(f)
+            if ext == '.hdf5':
+                files = [f]
+            elif ext == '.csv' and base + '.ini' in names:
+                files = [f, base + '.ini']
+            else:
+                continue
+            file_base = os.path.join(dirpath, base)
+            try:
+                mtime = max(os.stat(os.path.join(dirpath, g)).st_mtime for g in files)
+            except OSError:
+                continue # removed while scanning
+            found[(path, filename_decode(base))] = (file_base, mtime)
+    return found
+
+
+class SearchIndex(object):
+    """SQLite index of dataset metadata for searches across the vault.
+
+    The database may be used from any thread; access is serialized by a
+    lock.  Full-text matching uses an FTS5 table if SQLite supports it,
+    otherwise a LIKE match on the stored text.
+    """
+
+    def __init__(self, datadir, filename=None, executor=None, reactor=reactor):
+        self.datadir = datadir
+        if filename is None:
+            filename = os.path.join(datadir, SEARCH_INDEX_FILE)
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+        self.filename = filename
+        self.executor = executor if executor is not None else SynchronousExecutor()
+        self.reactor = reactor
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        if self._db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self._db.executescript(
+                'DROP TABLE IF EXISTS datasets; DROP TABLE IF EXISTS params; '
+                'DROP TABLE IF EXISTS fulltext; '
+                'PRAGMA user_version = {:d};'.format(SCHEMA_VERSION))
+        self._db.executescript(_SCHEMA)
+        try:
+            self._db.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS fulltext USING fts5(text)')
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        self._db.commit()
+        self._pending = {} # (path, name) -> Dataset to reindex
+        self._pendingCall = None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _put(self, db, key, mtime, info):
+        path, name = key
+        text, params, comments, ncomments = info
+        session = _session_key(path)
+        self._delete(db, session, name)
+        cur = db.execute(
+            'INSERT INTO datasets (session, name, mtime, text, comments, ncomments) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (session, name, mtime, text, comments, ncomments))
+        rowid = cur.lastrowid
+        db.executemany(
+            'INSERT INTO params (dataset, name, value, number, unit) VALUES (?, ?, ?, ?, ?)',
+            [(rowid,) + tuple(param) for param in params])
+        if self.fts:
+            db.execute('INSERT INTO fulltext (rowid, text) VALUES (?, ?)',
+                       (rowid, _join_text([text, comments])))
+
+    def _delete(self, db, session, name):
+        row = db.execute('SELECT id FROM datasets WHERE session = ? AND name = ?',
+                         (session, name)).fetchone()
+        if row is None:
+            return
+        db.execute('DELETE FROM params WHERE dataset = ?', row)
+        db.execute('DELETE FROM datasets WHERE id = ?', row)
+        if self.fts:
+            db.execute('DELETE FROM fulltext WHERE rowid = ?', row)
+
+    def put(self, key, mtime, info):
+        """Store the metadata of dataset key = (session path, name)."""
+        with self._lock:
+            self._put(self._db, key, mtime, info)
+            self._db.commit()
+
+    def indexed(self):
+        """Get {(session path, name): mtime} for all indexed datasets."""
+        with self._lock:
+            rows = self._db.execute('SELECT session, name, mtime FROM datasets').fetchall()
+        return {(_session_path(session), name): mtime for session, name, mtime in rows}
+
+    def scan(self, find=None, workers=SCAN_READS):
+        """Index new and changed datasets, and drop removed ones.
+
+        Call this on the reactor thread.  The vault is walked in the I/O
+        executor, then the metadata of up to workers datasets at a time is
+        read there.  Datasets the server has open, as found by
+        find(session path, name), are read through their own backend.
+        Other HDF5 files are read through backend.FILE_CACHE, using the
+        handle the server has open if there is one; files opened just for
+        the scan are closed again afterwards.  Returns a Deferred that
+        fires with the number of datasets (re)indexed.  Datasets that
+        cannot be read are skipped.
+        """
+        d = self.executor.submit(self, self._stale)
+        def read(stale):
+            sem = defer.DeferredSemaphore(workers)
+            reads = [sem.run(self._scanDataset, key, file_base, mtime, find)
+                     for key, file_base, mtime in stale]
+            return defer.gatherResults(reads).addCallback(sum)
+        return d.addCallback(read)
+
+    def _stale(self):
+        """Drop removed datasets; returns [(key, file base, mtime)] to reindex."""
+        found = find_datasets(self.datadir)
+        known = self.indexed()
+        with self._lock:
+            for path, name in set(known) - set(found):
+                self._delete(self._db, _session_key(path), name)
+            self._db.commit()
+        return [(key, file_base, mtime)
+                for key, (file_base, mtime) in sorted(found.items())
+                if known.get(key) != mtime]
+
+    def _scanDataset(self, key, file_base, mtime, find):
+        """Reindex one dataset; returns a Deferred that fires with 1, or 0 if it failed."""
+        dataset = find(*key) if find is not None else None
+        if dataset is not None:
+            d = dataset.withData(dataset_info)
+        elif os.path.exists(file_base + '.csv'):
+            d = self.executor.submit(key, read_ini_info, file_base)
+        else:
+            d = self._readHDF5(key, file_base + '.hdf5')
+        d.addCallback(lambda info: self.executor.submit(self, self.put, key, mtime, info))
+        return d.addCallbacks(lambda _: 1, lambda _: 0)
+
+    def _readHDF5(self, key, filename):
+        """Read the metadata of an HDF5 file through backend.FILE_CACHE."""
+        fh = backend.FILE_CACHE.lookup(filename)
+        opened = fh is None
+        try:
+            if opened:
+                fh = backend.SelfClosingFile(h5py.File, open_args=(filename, 'r'), touch=False)
+            fh.pin()
+        except Exception:
+            return defer.fail()
+        def release(result):
+            fh.unpin()
+            if opened:
+                # the server may open it for appending later
+                fh.close()
+            return result
+        d = self.executor.submit(key, read_hdf5_info, fh)
+        return d.addBoth(release)
+
+    def datasetChanged(self, dataset):
+        """Reindex an open dataset within METADATA_SAVE_DELAY.
+
+        Called when a dataset is created or gets new parameters or
+        comments; several changes are indexed together.
+        """
+        self._pending[(dataset.session.path, dataset.name)] = dataset
+        if self._pendingCall is None:
+            self._pendingCall = self.reactor.callLater(METADATA_SAVE_DELAY, self.flush)
+
+    def flush(self):
+        """Index pending changes now; returns a Deferred.
+
+        The metadata is read through each dataset's I/O executor.  Comments
+        that are already indexed are not read again.
+        """
+        if self._pendingCall is not None:
+            if self._pendingCall.active():
+                self._pendingCall.cancel()
+            self._pendingCall = None
+        pending, self._pending = self._pending, {}
+        updates = []
+        for key, dataset in pending.items():
+            d = dataset.withData(self._update, key)
+            d.addErrback(log.err, 'Indexing dataset {0!r} failed'.format(key[1]))
+            updates.append(d)
+        return defer.gatherResults(updates)
+
+    def _update(self, data, key):
+        """Reindex the open backend data of dataset key, in an I/O thread."""
+        path, name = key
+        with self._lock:
+            row = self._db.execute(
+                'SELECT comments, ncomments FROM datasets WHERE session = ? AND name = ?',
+                (_session_key(path), name)).fetchone()
+        comments, start = row if row is not None else ('', 0)
+        if start > data.numComments():
+            comments, start = '', 0
+        text, params, new_comments, ncomments = dataset_info(data, start)
+        with self._lock:
+            # no mtime, so the next scan reads the file again
+            self._put(self._db, key, None,
+                      (text, params, _join_text([comments, new_comments]), ncomments))
+            self._db.commit()
+
+    def query(self, text='', params=(), limit=0):
+        """Find datasets matching all the given conditions.
+
+        text is split into words, which must all appear in the metadata.
+        params is a list of (parameter name, op, value) with op one of
+        PARAM_OPS; names are matched ignoring case.  Numbers and values with
+        units are compared numerically in base units, and only with values
+        stored in the same units; anything else is compared as text.  Raises
+        SearchQueryError if a parameter is only stored in other units.  Returns a sorted list of (session path, dataset name).
+        """
+        where = []
+        args = []
+        terms = text.split()
+        if terms:
+            if self.fts:
+                where.append('d.id IN (SELECT rowid FROM fulltext WHERE fulltext MATCH ?)')
+                args.append(' AND '.join('"{}"'.format(t.replace('"', '""')) for t in terms))
+            else:
+                for t in terms:
+                    where.append("(d.text || ' ' || d.comments) LIKE ? ESCAPE '\\'")
+                    escaped = t.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                    args.append('%' + escaped + '%')
+        for name, op, value in params:
+            if op not in PARAM_OPS:
+                raise errors.SearchQueryError('unknown comparison {0!r}'.format(op))
+            number = None if isinstance(value, str) else _number(value)
+            if number is not None:
+                unit = _base_unit(value)
+                self._checkUnits(name, value, unit)
+                if op == '=':
+                    tol = abs(number) * NUMBER_TOLERANCE
+                    cond = 'p.number BETWEEN ? AND ?'
+                    cond_args = [number - tol, number + tol]
+                elif op == '!=':
+                    tol = abs(number) * NUMBER_TOLERANCE
+                    cond = 'p.number NOT BETWEEN ? AND ?'
+                    cond_args = [number - tol, number + tol]
+                else:
+                    cond = 'p.number {} ?'.format(op)
+                    cond_args = [number]
+                cond += ' AND p.unit = ?'
+                cond_args.append(unit)
+            else:
+                cond = 'p.value {} ?'.format(op)
+                cond_args = [str(value)]
+            where.append('EXISTS (SELECT 1 FROM params p WHERE p.dataset = d.id '
+                         'AND p.name = ? AND {})'.format(cond))
+            args.extend([name] + cond_args)
+        if not where:
+            raise errors.SearchQueryError('no search terms given')
+        sql = 'SELECT d.session, d.name FROM datasets d WHERE {} ORDER BY d.session, d.name'.format(
+            ' AND '.join(where))
+        if limit:
+            sql += ' LIMIT {:d}'.format(limit)
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        return [(_session_path(session), name) for session, name in rows]
+
+    def _checkUnits(self, name, value, unit):
+        """Reject a numeric value if the parameter is only stored in other units."""
+        with self._lock:
+            units = set(u for u, in self._db.execute(
+                'SELECT DISTINCT unit FROM params WHERE name = ? AND number IS NOT NULL',
+                (name,)))
+        if units and unit not in units:
+            raise errors.SearchQueryError(
+                'units of {0} do not match parameter {1!r}'.format(value, name))
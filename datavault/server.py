@@ -2,21 +2,24 @@
 
 import collections
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import DeferredList, inlineCallbacks, returnValue
 import twisted.internet.task
+from twisted.python import log
 import numpy as np
 from labrad.server import LabradServer, Signal, setting
 
-from . import errors
+from . import backend, errors
 
 
 class DataVault(LabradServer):
     name = 'Data Vault'
 
-    def __init__(self, session_store):
+    def __init__(self, session_store, storage=None):
         LabradServer.__init__(self)
 
         self.session_store = session_store
+        # default chunking/compression for new datasets
+        self.storage = storage if storage is not None else backend.DEFAULT_STORAGE
 
         # session signals
         self.onNewDir = Signal(543617, 'signal: new dir', 's')
@@ -27,10 +30,28 @@ class DataVault(LabradServer):
         self.onDataAvailable = Signal(543619, 'signal: data available', '')
         self.onNewParameter = Signal(543620, 'signal: new parameter', '')
         self.onCommentsAvailable = Signal(543621, 'signal: comments available', '')
+        self.onDataPushed = Signal(543623, 'signal: data pushed', '?')
 
     def initServer(self):
         # create root session
         _root = self.session_store.get([''])
+        # bring the search index up to date with changes made while we were down
+        index = self.session_store.search_index
+        if index is not None:
+            d = index.scan(self.session_store.findDataset)
+            d.addErrback(log.err, 'Scanning data vault for search index failed')
+
+    def stopServer(self):
+        """Write buffered data and metadata and close open datasets."""
+        closing = []
+        closing.append(self.session_store.tag_index.flushSave())
+        if self.session_store.search_index is not None:
+            closing.append(self.session_store.search_index.flush())
+        for session in self.session_store.get_all():
+            closing.append(session.flushSave())
+            for dataset in list(session.datasets.values()):
+                closing.append(dataset.close())
+        return DeferredList(closing)
 
     def contextKey(self, c):
         """The key used to identify a given context for notifications"""
@@ -41,20 +62,15 @@ class DataVault(LabradServer):
         c['path'] = ['']
         # start listening to the root session
         c['session'] = self.session_store.get([''])
-        c['session'].listeners.add(self.contextKey(c))
+        c['session'].addListener(self.contextKey(c))
 
     def expireContext(self, c):
         """Stop sending any signals to this context."""
         key = self.contextKey(c)
-        def removeFromList(ls):
-            if key in ls:
-                ls.remove(key)
-        for session in self.session_store.get_all():
-            removeFromList(session.listeners)
-            for dataset in list(session.datasets.values()):
-                removeFromList(dataset.listeners)
-                removeFromList(dataset.param_listeners)
-                removeFromList(dataset.comment_listeners)
+        if 'datasetObj' in c:
+            c['datasetObj'].removeWriter(key)
+            c['datasetObj'].stopStream(key)
+        self.session_store.listener_index.expire(key)
 
     def getSession(self, c):
         """Get a session object for the current path."""
@@ -66,6 +82,26 @@ class DataVault(LabradServer):
             raise errors.NoDatasetError()
         return c['datasetObj']
 
+    def setDataset(self, c, dataset, writing):
+        """Make dataset the current dataset for this context."""
+        key = self.contextKey(c)
+        if 'datasetObj' in c:
+            c['datasetObj'].removeWriter(key)
+            c['datasetObj'].stopStream(key)
+        c['dataset'] = dataset.name # not the same as name; has number prefixed
+        c['datasetObj'] = dataset
+        c['filepos'] = 0 # start at the beginning
+        c['commentpos'] = 0
+        c['writing'] = writing
+        if writing:
+            dataset.addWriter(key)
+
+    def getStorage(self, storage):
+        """Get storage options for a new dataset, using the server default if None."""
+        if storage is None:
+            return self.storage
+        return backend.make_storage_options(*storage)
+
     @setting(5, returns=['*s'])
     def dump_existing_sessions(self, c):
         return ['/'.join(session.path)
@@ -122,7 +158,7 @@ class DataVault(LabradServer):
             key = self.contextKey(c)
             c['session'].listeners.remove(key)
             session = self.session_store.get(temp)
-            session.listeners.add(key)
+            session.addListener(key)
             c['session'] = session
             c['path'] = temp
         return c['path']
@@ -147,8 +183,9 @@ class DataVault(LabradServer):
     @setting(9, name='s',
                 independents=['*s', '*(ss)'],
                 dependents=['*s', '*(sss)'],
+                storage='(w{chunk rows}, s{compression}, w{level}, b{shuffle})',
                 returns='(*s{path}, s{name})')
-    def new(self, c, name, independents, dependents):
+    def new(self, c, name, independents, dependents, storage=None):
         """Create a new Dataset.
 
         Independent and dependent variables can be specified either
@@ -159,21 +196,25 @@ class DataVault(LabradServer):
         axis label that can be shared among traces, while legend is
         a legend entry that should be unique for each trace.
         Returns the path and name for this dataset.
+
+        The optional storage cluster sets the HDF5 layout of the data:
+        (chunk rows, compression, level, shuffle).  Chunk rows of 0 picks
+        a chunk size from the row size.  Compression is '', 'gzip' or
+        'lzf', and level is the gzip level (0-9).  If omitted, the server
+        default from the registry is used.
         """
         session = self.getSession(c)
-        dataset = session.newDataset(name or 'untitled', independents, dependents)
-        c['dataset'] = dataset.name # not the same as name; has number prefixed
-        c['datasetObj'] = dataset
-        c['filepos'] = 0 # start at the beginning
-        c['commentpos'] = 0
-        c['writing'] = True
+        dataset = session.newDataset(name or 'untitled', independents, dependents,
+                                     storage=self.getStorage(storage))
+        self.setDataset(c, dataset, writing=True)
         return c['path'], c['dataset']
 
     @setting(1009, name='s', 
              independents='*(s*iss)',
              dependents='*(ss*iss)',
+             storage='(w{chunk rows}, s{compression}, w{level}, b{shuffle})',
              returns=['*ss'])
-    def new_ex(self, c, name, independents, dependents):
+    def new_ex(self, c, name, independents, dependents, storage=None):
         """Create a new extended dataset
 
         Independents are specified as: (label, shape, type, unit)
@@ -199,14 +240,13 @@ class DataVault(LabradServer):
         code.  The name and parameters will be there, but no actual data.
 
         The legacy format requires each column be a scalar v[unit] type.
+
+        storage optionally sets the HDF5 chunking and compression; see new.
         """
         session = self.getSession(c)
-        dataset = session.newDataset(name, independents, dependents, extended=True)
-        c['dataset'] = dataset.name # not the same as name; has number prefixed
-        c['datasetObj'] = dataset
-        c['filepos'] = 0 # start at the beginning
-        c['commentpos'] = 0
-        c['writing'] = True
+        dataset = session.newDataset(name, independents, dependents, extended=True,
+                                     storage=self.getStorage(storage))
+        self.setDataset(c, dataset, writing=True)
         return c['path'], c['dataset']
 
     @setting(10, name=['s', 'w'], append='b', returns='(*s{path}, s{name})')
@@ -217,16 +257,13 @@ class DataVault(LabradServer):
         Returns the path and name for this dataset.
         """
         session = self.getSession(c)
+        yield session.upgradeDataset(name)
         dataset = session.openDataset(name)
-        c['dataset'] = dataset.name # not the same as name; has number prefixed
-        c['datasetObj'] = dataset
-        c['filepos'] = 0
-        c['commentpos'] = 0
-        c['writing'] = append
+        self.setDataset(c, dataset, writing=append)
         key = self.contextKey(c)
         dataset.keepStreaming(key, 0)
-        dataset.keepStreamingComments(key, 0)
-        return c['path'], c['dataset']
+        yield dataset.keepStreamingComments(key, 0)
+        returnValue((c['path'], c['dataset']))
 
     @setting(1010, returns='s')
     def get_version(self, c):
@@ -256,7 +293,7 @@ class DataVault(LabradServer):
         # fromarrays is faster than fromrecords, and when we have a simple 2-D array
         # we can just transpose the array.
         rec_data = np.core.records.fromarrays(data.T, dtype=dataset.data.dtype)
-        dataset.addData(rec_data)
+        return dataset.addData(rec_data)
 
     @setting(1020, data='?', returns='')
     def add_ex(self, c, data):
@@ -273,7 +310,7 @@ class DataVault(LabradServer):
         if not c['writing']:
             raise errors.ReadOnlyError()
         list_data = [tuple(row) for row in data]
-        dataset.addData(np.core.records.fromrecords(list_data, dtype=dataset.data.dtype))
+        return dataset.addData(np.core.records.fromrecords(list_data, dtype=dataset.data.dtype))
 
     @setting(2020, data='?', returns='')
     def add_ex_t(self, c, data):
@@ -286,7 +323,59 @@ class DataVault(LabradServer):
         dataset = self.getDataset(c)
         if not c['writing']:
             raise errors.ReadOnlyError()
-        dataset.addData(np.core.records.fromarrays(data, dtype=dataset.data.dtype))
+        return dataset.addData(np.core.records.fromarrays(data, dtype=dataset.data.dtype))
+
+    @setting(3020, 'add raw', data='y', rows='w', returns='')
+    def add_raw(self, c, data, rows=0):
+        """Add rows to the current dataset from a block of bytes.
+
+        The bytes hold whole rows packed back to back, each row holding the
+        columns in order as little-endian values of the column types:
+        8-byte floats for v, 16-byte complex for c, 4-byte ints for i,
+        8-byte ints for t, and arrays in C order.  This is the numpy record
+        layout of the dataset, so a client can send
+        array.astype(dtype).tobytes().  The block is used as is, with no
+        conversion, which makes this the fastest way to add large amounts
+        of data.
+
+        rows, if nonzero, is checked against the size of the block.  A
+        block that is not a whole number of rows or does not match rows
+        raises RawDataError, as does a dataset with string columns, which
+        have no fixed binary layout.
+        """
+        dataset = self.getDataset(c)
+        if not c['writing']:
+            raise errors.ReadOnlyError()
+        return dataset.addData(backend.records_from_bytes(data, dataset.data.dtype, rows))
+
+    @setting(22, returns='')
+    def flush(self, c):
+        """Write any buffered data for the current dataset to disk.
+
+        Added rows are buffered in memory and written in blocks.  Reads
+        always see buffered rows, so this is only needed to force the
+        data onto disk, e.g. before another program opens the file.
+        """
+        dataset = self.getDataset(c)
+        return dataset.flush()
+
+    @setting(23, 'finalize', returns='')
+    def finalize(self, c):
+        """Finish writing the current dataset and make it read-only.
+
+        Buffered data is written and the HDF5 file is rewritten without
+        spare capacity and marked as finished; unless it has string
+        columns, the rows are also stored contiguously and uncompressed so
+        that reads map them directly from the file.
+        Afterwards the file is only ever opened for reading, so it takes
+        no write lock, and no more data, parameters or comments can be
+        added.  Only HDF5 datasets
+        can be finalized.
+        """
+        dataset = self.getDataset(c)
+        if not c['writing']:
+            raise errors.ReadOnlyError()
+        return dataset.finalize()
 
     @setting(21, limit='w', startOver='b', returns='*2v')
     def get(self, c, limit=None, startOver=False):
@@ -300,10 +389,10 @@ class DataVault(LabradServer):
         """
         dataset = self.getDataset(c)
         c['filepos'] = 0 if startOver else c['filepos']
-        data, c['filepos'] = dataset.getData(limit, c['filepos'], simpleOnly=True)
+        data, c['filepos'] = yield dataset.getData(limit, c['filepos'], simpleOnly=True)
         key = self.contextKey(c)
         dataset.keepStreaming(key, c['filepos'])
-        return data
+        returnValue(data)
 
     @setting(1021, limit='w', startOver='b', returns='?')
     def get_ex(self, c, limit=None, startOver=False):
@@ -316,10 +405,10 @@ class DataVault(LabradServer):
         """
         dataset = self.getDataset(c)
         c['filepos'] = 0 if startOver else c['filepos']
-        data, c['filepos'] = dataset.getData(limit, c['filepos'], transpose=False)
+        data, c['filepos'] = yield dataset.getData(limit, c['filepos'], transpose=False)
         ctx = self.contextKey(c)
         dataset.keepStreaming(ctx, c['filepos'])
-        return data
+        returnValue(data)
 
     @setting(2021, limit='w', startOver='b', returns='?')
     def get_ex_t(self, c, limit=None, startOver=False):
@@ -334,10 +423,64 @@ class DataVault(LabradServer):
         """
         dataset = self.getDataset(c)
         c['filepos'] = 0 if startOver else c['filepos']
-        data, c['filepos'] = dataset.getData(limit, c['filepos'], transpose=True)
+        data, c['filepos'] = yield dataset.getData(limit, c['filepos'], transpose=True)
         ctx = self.contextKey(c)
         dataset.keepStreaming(ctx, c['filepos'])
-        return data
+        returnValue(data)
+
+    @setting(2022, 'get slice', columns='*w', start='w', stop='w', step='w',
+             mode='s', returns='?')
+    def get_slice(self, c, columns=[], start=0, stop=None, step=1, mode=''):
+        """Get a selection of columns over a range of rows.
+
+        Data is returned in transposed form like get_ex_t, with one list per
+        selected column.  columns gives the column indices to return; an
+        empty list returns all of them.  Rows start up to (not including)
+        stop are read, or to the end of the dataset if stop is omitted.
+
+        With mode '' every step-th row is returned.  With mode 'minmax' the
+        rows are split into bins of step rows and each bin is reduced to two
+        rows holding the minimum and maximum of every column, which keeps
+        peaks visible in downsampled plots.  The context's read position is
+        not changed.
+        """
+        dataset = self.getDataset(c)
+        data, _ = yield dataset.getColumns(columns, start, stop, step, mode)
+        returnValue(data)
+
+    @setting(2023, 'stream', enable='b', max_rate='v', max_rows='w', mode='s',
+             window='w', startOver='b', returns='')
+    def stream(self, c, enable=True, max_rate=0, max_rows=0, mode='', window=1,
+               startOver=False):
+        """Push new rows of the current dataset to this context.
+
+        While enabled, rows added to the dataset are sent in the 'data
+        pushed' signal as (start row, end row, columns), with the columns in
+        the same form as get_slice, so no get request is needed to read
+        them.  Streaming starts at the context's read position (or at the
+        first row with startOver) and has its own position from then on.
+
+        max_rate limits the pushes per second (0 for no limit); rows added
+        in between are sent together.  If a push would hold more than
+        max_rows rows (0 for no limit) it is decimated to about max_rows
+        rows, with min/max bins if mode is 'minmax' and by taking every n-th
+        row otherwise.  At most window pushes are sent before the client
+        acknowledges them with stream_ack, so a slow client is sent fewer,
+        larger pushes instead of falling behind.
+        """
+        dataset = self.getDataset(c)
+        key = self.contextKey(c)
+        if not enable:
+            dataset.stopStream(key)
+            return
+        pos = 0 if startOver else c['filepos']
+        dataset.stream(key, pos, max_rate, max_rows, mode, window)
+
+    @setting(2024, 'stream ack', returns='')
+    def stream_ack(self, c):
+        """Acknowledge a 'data pushed' signal so that the next one may be sent."""
+        dataset = self.getDataset(c)
+        dataset.ackStream(self.contextKey(c))
 
     @setting(100, returns='(*(ss){independents}, *(sss){dependents})')
     def variables(self, c):
@@ -391,20 +534,20 @@ class DataVault(LabradServer):
         """Get a list of parameter names."""
         dataset = self.getDataset(c)
         key = self.contextKey(c)
-        dataset.param_listeners.add(key) # send a message when new parameters are added
+        dataset.addListener(key, 'param_listeners') # send a message when new parameters are added
         return dataset.getParamNames()
 
     @setting(121, 'add parameter', name='s', returns='')
     def add_parameter(self, c, name, data):
         """Add a new parameter to the current dataset."""
         dataset = self.getDataset(c)
-        dataset.addParameter(name, data)
+        yield dataset.addParameter(name, data)
 
     @setting(124, 'add parameters', params='?{((s?)(s?)...)}', returns='')
     def add_parameters(self, c, params):
         """Add a new parameter to the current dataset."""
         dataset = self.getDataset(c)
-        dataset.addParameters(params)
+        yield dataset.addParameters(params)
 
 
     @setting(126, 'get name', returns='s')
@@ -429,12 +572,25 @@ class DataVault(LabradServer):
         are not allowed).
         """
         dataset = self.getDataset(c)
-        names = dataset.getParamNames()
-        params = tuple((name, dataset.getParameter(name)) for name in names)
+        params = tuple((yield dataset.getParameters()))
         key = self.contextKey(c)
-        dataset.param_listeners.add(key) # send a message when new parameters are added
+        dataset.addListener(key, 'param_listeners') # send a message when new parameters are added
         if len(params):
-            return params
+            returnValue(params)
+
+    @setting(125, 'get parameter values', names='*s', case_sensitive='b')
+    def get_parameter_values(self, c, names, case_sensitive=True):
+        """Get the values of several parameters in one request.
+
+        Returns a cluster of (name, value) clusters in the order requested.
+        Decoded values are cached by the server until the next parameter is
+        added, so this is the fast way to load many parameters.  If no names
+        are given, nothing is returned.
+        """
+        dataset = self.getDataset(c)
+        params = tuple((yield dataset.getParameters(names, case_sensitive)))
+        if len(params):
+            returnValue(params)
 
     @setting(200, 'add comment', comment=['s'], user=['s'], returns=[''])
     def add_comment(self, c, comment, user='anonymous'):
@@ -448,10 +604,10 @@ class DataVault(LabradServer):
         """Get comments for the current dataset."""
         dataset = self.getDataset(c)
         c['commentpos'] = 0 if startOver else c['commentpos']
-        comments, c['commentpos'] = dataset.getComments(limit, c['commentpos'])
+        comments, c['commentpos'] = yield dataset.getComments(limit, c['commentpos'])
         key = self.contextKey(c)
-        dataset.keepStreamingComments(key, c['commentpos'])
-        return comments
+        yield dataset.keepStreamingComments(key, c['commentpos'])
+        returnValue(comments)
 
     @setting(300, 'update tags', tags=['s', '*s'],
                   dirs=['s', '*s'], datasets=['s', '*s'],
@@ -471,7 +627,8 @@ class DataVault(LabradServer):
         if isinstance(dirs, str):
             dirs = [dirs]
         if datasets is None:
-            datasets = [self.getDataset(c)]
+            self.getDataset(c)
+            datasets = [c['dataset']]
         elif isinstance(datasets, str):
             datasets = [datasets]
         sess = self.getSession(c)
@@ -489,6 +646,60 @@ class DataVault(LabradServer):
             datasets = [datasets]
         return sess.getTags(dirs, datasets)
 
+    @setting(302, 'search tags', tagFilters=['s', '*s'],
+             returns='*(*s{path}, s{dataset})')
+    def search_tags(self, c, tagFilters):
+        """Find datasets anywhere in the vault by their tags.
+
+        Returns (path, dataset name) for every dataset that has all the
+        given tags and none of the tags prefixed with '-', as in dir.  At
+        least one tag to match must be given.  This uses a vault-wide tag
+        index, so it does not open every directory.
+        """
+        if isinstance(tagFilters, str):
+            tagFilters = [tagFilters]
+        found = yield self.session_store.tag_index.search(tagFilters)
+        returnValue([(list(path), name) for path, name in found])
+
+    @setting(303, 'search', text='s', params='?', limit='w',
+             returns='*(*s{path}, s{dataset})')
+    def search(self, c, text='', params=[], limit=0):
+        """Find datasets anywhere in the vault by their metadata.
+
+        text is split into words that must all appear in the title,
+        variable names and units, parameter names or comments.  params is a
+        list of (parameter name, comparison, value) clusters, where the
+        comparison is one of =, !=, <, <=, > and >=.  Numbers and values
+        with units are compared numerically in base units, and only with
+        values stored in the same units; strings are compared as text.  A
+        dataset must match everything given.  Returns up to limit
+        (path, dataset name) pairs, or all of them if limit is 0.
+
+        This uses the search index, which is enabled with the 'search
+        index' registry key and updated in the background when the server
+        starts and as datasets change.
+        """
+        index = self.session_store.search_index
+        if index is None:
+            raise errors.SearchQueryError('the search index is not enabled')
+        params = [tuple(p) for p in params]
+        found = yield index.executor.submit(index, index.query, text, params, limit)
+        returnValue([(list(path), name) for path, name in found])
+
+    @setting(500, 'file cache', max_open='w',
+             returns='(w{open}, w{max open}, w{hits}, w{misses}, w{evictions})')
+    def file_cache(self, c, max_open=None):
+        """Get statistics for the cache of open data files.
+
+        Returns the number of open files, the maximum kept open, and counts
+        of cache hits, misses (files opened) and evictions (files closed to
+        stay under the limit).  If max_open is given, the limit is changed
+        first.  Files of datasets with active writers are never evicted.
+        """
+        if max_open is not None:
+            backend.FILE_CACHE.setMaxOpen(max_open)
+        return backend.FILE_CACHE.stats()
+
 
 class DataVaultMultiHead(DataVault):
     """Data Vault server with additional settings for running multi-headed.
@@ -497,8 +708,8 @@ class DataVaultMultiHead(DataVault):
     instances will be created when we reconnect after losing a connection.
     """
 
-    def __init__(self, host, port, password, hub, session_store):
-        DataVault.__init__(self, session_store)
+    def __init__(self, host, port, password, hub, session_store, storage=None):
+        DataVault.__init__(self, session_store, storage)
         self.host = host
         self.port = port
         self.password = password
@@ -1,5 +1,6 @@
 import datetime
 import h5py
+import mock
 import numpy as np
 import os
 import pytest
@@ -69,6 +70,25 @@ class UtilityMethodsTest(_TestCase):
         self.assertRaises(
                 ValueError, backend.labrad_urldecode, url_string)
 
+    def test_records_from_bytes(self):
+        dtype = np.dtype([('f0', 'i8'), ('f1', '(2,)f8'), ('f2', 'c16')])
+        rows = np.zeros(3, dtype=dtype.newbyteorder('<'))
+        rows['f0'] = [1, 2, 3]
+        rows['f1'] = [[0.5, 1.5], [2.5, 3.5], [4.5, 5.5]]
+        rows['f2'] = [1j, 2, 3 + 3j]
+        buf = rows.tobytes()
+        actual = backend.records_from_bytes(buf, dtype, 3)
+        self.assertTrue(np.array_equal(rows, actual))
+        self.assertFalse(actual.flags.owndata)
+
+        self.assertRaises(
+                errors.RawDataError, backend.records_from_bytes, buf[:-8], dtype)
+        self.assertRaises(
+                errors.RawDataError, backend.records_from_bytes, buf, dtype, 2)
+        str_dtype = np.dtype([('f0', 'f8'), ('f1', h5py.special_dtype(vlen=str))])
+        self.assertRaises(
+                errors.RawDataError, backend.records_from_bytes, b'', str_dtype)
+
 
 class _MockFile(object):
     def __init__(self):
@@ -95,22 +115,25 @@ class SelfClosingFileTest(_TestCase):
     """Tests for the SelfClosingFile."""
 
     def setUp(self):
-        self.close_timeout_sec = 1
+        self.cache = backend.FileCache(max_open=1)
         self.opener = _MockFileOpener()
-        self.clock = task.Clock()
         self.file = backend.SelfClosingFile(opener=self.opener,
-                                            timeout=self.close_timeout_sec,
                                             open_args=('1', '2', '3'),
                                             open_kw={'a':'b', 'c':'d'},
-                                            reactor=self.clock)
+                                            cache=self.cache)
+
+    def open_other_file(self):
+        """Open another file in the cache, evicting self.file if possible."""
+        opener = _MockFileOpener()
+        return backend.SelfClosingFile(opener=opener, cache=self.cache)
 
     def test_file_doesnt_open_if_no_touch(self):
         opener = _MockFileOpener()
         self.file = backend.SelfClosingFile(opener=opener,
-                                            timeout=self.close_timeout_sec,
                                             open_args=('1', '2', '3'),
                                             open_kw={'a':'b', 'c':'d'},
-                                            touch=False)
+                                            touch=False,
+                                            cache=self.cache)
         self.assertTrue(opener.file is None, msg='File was opened on init')
 
     def test_file_opens_on_init(self):
@@ -120,17 +143,62 @@ class SelfClosingFileTest(_TestCase):
         self.assertEqual(
                 self.opener.kwargs, {'a':'b', 'c':'d'}, 'File kwargs not set')
 
-    def test_closes_file_after_timeout(self):
+    def test_closes_file_when_evicted(self):
         self.close_callback_called = False
         def onCloseCallback(self_closing_file):
             self.close_callback_called = True
         self.file.onClose(onCloseCallback)
-        # Advance clock to close the self closing file.
-        self.clock.advance(self.close_timeout_sec)
+        # Open another file to evict the self closing file.
+        self.open_other_file()
         self.assertFalse(self.opener.file.is_open,
-                    msg='File not closed after timeout')
+                    msg='File not closed after eviction')
         self.assertTrue(self.close_callback_called,
                     msg='Registered callback not called!')
+        self.assertEqual(self.cache.stats(), (1, 1, 0, 2, 1))
+
+        # Using the file again reopens it.
+        self.file()
+        self.assertTrue(self.opener.file.is_open, msg='File not reopened')
+
+    def test_least_recently_used_file_is_evicted(self):
+        self.cache.setMaxOpen(2)
+        other = self.open_other_file()
+        self.file()
+        self.open_other_file()
+        self.assertTrue(self.opener.file.is_open,
+                    msg='Recently used file was evicted')
+        self.assertFalse(other in self.cache)
+        self.assertEqual(self.cache.stats(), (2, 2, 1, 3, 1))
+
+    def test_pinned_file_stays_open(self):
+        self.file.pin()
+        self.open_other_file()
+        self.assertTrue(self.opener.file.is_open,
+                    msg='Pinned file closed by eviction')
+        self.assertEqual(len(self.cache), 2)
+        self.file.unpin()
+        self.assertFalse(self.opener.file.is_open,
+                    msg='File not evicted after unpin')
+        self.assertEqual(len(self.cache), 1)
+
+    def test_cache_may_overflow_with_pinned_files(self):
+        self.file.pin()
+        other = self.open_other_file()
+        other.pin()
+        self.assertEqual(len(self.cache), 2)
+        other.unpin()
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue(self.opener.file.is_open)
+
+    def test_close_waits_for_unpin(self):
+        self.file.pin()
+        self.file.close()
+        self.assertTrue(self.opener.file.is_open,
+                    msg='Pinned file closed')
+        self.file.unpin()
+        self.assertFalse(self.opener.file.is_open,
+                    msg='File not closed after unpin')
+        self.assertEqual(len(self.cache), 0)
 
 
 # Dependent and Independent variables used for testing IniData and HDF5MetaData.
@@ -208,6 +276,26 @@ class _MetadataTest(_TestCase):
         self.assertEqual(
                 data.getParameter('param1', case_sensitive=False), param)
 
+    def test_get_parameters(self):
+        data = self.get_data()
+        data.initialize_info('FooTitle', _INDEPENDENTS, _DEPENDENTS)
+        data.addParam('Gain', 3.5)
+        data.addParam('Offset', 'fine')
+        self.assertEqual(data.getParameters(), [('Gain', 3.5), ('Offset', 'fine')])
+        self.assertEqual(
+                data.getParameters(['offset', 'GAIN'], case_sensitive=False),
+                [('offset', 'fine'), ('GAIN', 3.5)])
+        self.assertRaises(
+                errors.BadParameterError, data.getParameters, ['offset'])
+
+        # Decoded values are cached until the next parameter is added.
+        with mock.patch('datavault.backend.labrad_urldecode') as decode:
+            self.assertEqual(data.getParameter('Gain'), 3.5)
+            decode.assert_not_called()
+        data.addParam('Phase', 0.5)
+        self.assertEqual(data.getParamNames(), ['Gain', 'Offset', 'Phase'])
+        self.assertEqual(data.getParameters(['Phase']), [('Phase', 0.5)])
+
     def test_add_param_already_added(self):
         data = self.get_data()
         data.initialize_info('FooTitle', _INDEPENDENTS, _DEPENDENTS)
@@ -401,25 +489,28 @@ c1=('2012-09-25, 03:14:15','fizz','buzz')
                 data.getTransposeType(), '(*v[Ghz],*v[Kelvin],*v[Dollars])')
 
 
-class _MockAttrs(dict):
-    """Mock Attributes class for use in the _MockDataset."""
-    def create(self, name, data, dtype):
-        self[name] = np.asarray(data, dtype=dtype)
-
-
-class _MockDataset(object):
-    """Mock Dataset class to use in the HDF5MetaDataTest."""
-    def __init__(self):
-        self.attrs = _MockAttrs()
-
-
 class HDF5MetaDataTest(_MetadataTest):
 
     def get_data(self):
+        # an in-memory file, so that nothing is written to disk
+        f = h5py.File(_unique_filename(), 'w', driver='core', backing_store=False)
         data = backend.HDF5MetaData()
-        data.dataset = _MockDataset()
+        data.dataset = f.create_dataset(
+                'DataVault', (0,), dtype=[('f0', '<f8')], maxshape=(None,))
         return data
 
+    def test_column_metadata_is_cached(self):
+        data = self.get_data()
+        data.initialize_info('FooTitle', _INDEPENDENTS, _DEPENDENTS)
+        data.load()
+        # Later queries do not touch the file.
+        data.dataset = None
+        self.assertEqual(data.getIndependents(), _INDEPENDENTS)
+        self.assertEqual(data.getDependents(), _DEPENDENTS)
+        self.assertEqual(data.getRowType(), '*(v[Ghz],v[Kelvin],v[Dollars])')
+        self.assertEqual(
+                data.getTransposeType(), '(*v[Ghz],*v[Kelvin],*v[Dollars])')
+
 
 class _BackendDataTestCase(_TestCase):
     def assert_data_in_backend(self, backend_data, expected_data):
@@ -581,12 +672,64 @@ class CsvNumpyDataTest(_BackendDataTest):
         for name in self.files_to_remove:
             _remove_file_if_exists(name)
             _remove_file_if_exists(name[:-4] + '.ini')
+            _remove_file_if_exists(name[:-4] + '.idx')
 
 
     def get_backend_data(self, filename):
         self.files_to_remove.append(filename)
         return backend.CsvNumpyData(filename, reactor=self.clock)
 
+    def _rows(self, first, count):
+        data = np.recarray(
+            (count, ),
+            dtype=[('f0', '<f8'), ('f1', '<f8'), ('f2', '<f8')])
+        for i in range(count):
+            data[i] = (first + i, 2 * (first + i), 3 * (first + i))
+        return data
+
+    def test_incremental_read(self):
+        self.data.addData(self._rows(0, 2))
+        self.assert_arrays_equal(self.data.data, [[0, 0, 0], [1, 2, 3]])
+        buf = self.data._data
+        self.data.addData(self._rows(2, 1))
+        self.assert_arrays_equal(self.data.data[2], [2, 4, 6])
+        # new rows are parsed into the existing buffer
+        self.assertIs(buf, self.data._data)
+        self.assertEqual(len(self.data.data), 3)
+
+    @mock.patch.object(backend, 'ROW_INDEX_STRIDE', 4)
+    def test_row_index_random_access(self):
+        self.data.addData(self._rows(0, 10))
+        self.assertEqual(len(self.data.index), 10)
+        self.assertEqual(len(self.data.index.offsets), 3)
+
+        # Reopen: the sidecar index is loaded instead of rescanning.
+        self.data.save()
+        data = backend.CsvNumpyData(self.filename, reactor=self.clock)
+        data.load()
+        self.assertEqual(data.index.rows, 10)
+        rows, next_pos = data.getData(3, 5, False, None)
+        self.assertEqual(next_pos, 8)
+        self.assert_arrays_equal(rows, [[5, 10, 15], [6, 12, 18], [7, 14, 21]])
+        self.assertFalse(hasattr(data, '_data'))
+
+        # Rows appended later are indexed incrementally.
+        data.addData(self._rows(10, 3))
+        self.assertEqual(len(data.index), 13)
+        self.assert_arrays_equal(
+                data.getData(1, 12, False, None)[0], [[12, 24, 36]])
+
+    @mock.patch.object(backend, 'ROW_INDEX_STRIDE', 4)
+    def test_row_index_ignores_stale_sidecar(self):
+        self.data.addData(self._rows(0, 6))
+        self.assertEqual(len(self.data.index), 6)
+        # Replace the data file with a shorter one.
+        with open(self.filename, 'w') as f:
+            f.write('1, 2, 3\r\n')
+        data = backend.CsvNumpyData(self.filename, reactor=self.clock)
+        self.assertEqual(len(data.index), 1)
+        self.assert_arrays_equal(data.data, [[1, 2, 3]])
+
     def test_empty_data_read(self):
         read_data = self.data.data
         self.assertEqual(read_data.dtype, np.dtype(float))
@@ -614,8 +757,7 @@ class ExtendedHDF5DataTest(_BackendDataTest):
 
     def get_backend_data(self, filename):
         self.files_to_remove.append(filename)
-        fh = backend.SelfClosingFile(
-                h5py.File, open_args=(filename, 'a'), reactor=self.clock)
+        fh = backend.SelfClosingFile(h5py.File, open_args=(filename, 'a'))
         return backend.ExtendedHDF5Data(fh)
 
     def test_empty_data_read(self):
@@ -634,6 +776,93 @@ class ExtendedHDF5DataTest(_BackendDataTest):
         self.assertEqual(next_pos, 2)
         self.assertEqual(len(actual), 3)
         self.assert_arrays_equal(actual, [[1, 4], [2, 5], [3, 6]])
+        for col in actual:
+            self.assertTrue(col.flags['C_CONTIGUOUS'])
+
+    def test_get_data_transpose_range(self):
+        data_to_add = np.recarray(
+            (3, ),
+            dtype=[('f0', '<f8'), ('f1', '<f8'), ('f2', '<f8')])
+        data_to_add[0] = (1, 2, 3)
+        data_to_add[1] = (4, 5, 6)
+        data_to_add[2] = (7, 8, 9)
+        self.data.addData(data_to_add)
+
+        actual, next_pos = self.data.getData(1, 1, True, None)
+        self.assertEqual(next_pos, 2)
+        self.assert_arrays_equal(actual, [[4], [5], [6]])
+
+        actual, next_pos = self.data.getData(None, 3, True, None)
+        self.assertEqual(next_pos, 3)
+        self.assertEqual([len(col) for col in actual], [0, 0, 0])
+
+    def test_get_columns_array_column(self):
+        name = _unique_filename()
+        data = self.get_backend_data(name)
+        independents = [
+                backend.Independent(
+                        label='Time', shape=(1,), datatype='v', unit='s'),
+                backend.Independent(
+                        label='Trace', shape=(2,), datatype='v', unit='V')]
+        data.initialize_info('Foo', independents, [])
+        data_entry = np.recarray(
+            (5, ), dtype=[('f0', '<f8'), ('f1', '<f8', (2,))])
+        for i in range(5):
+            data_entry[i] = (i, [i, -i])
+        data.addData(data_entry)
+
+        (trace,), pos = data.getColumns([1], 0, None, 2, '')
+        self.assertEqual(pos, 5)
+        self.assert_arrays_equal(trace, [[0, 0], [2, -2], [4, -4]])
+
+        (trace,), _ = data.getColumns([1], 0, None, 3, 'minmax')
+        self.assert_arrays_equal(
+                trace, [[0, -2], [2, 0], [3, -4], [4, -3]])
+
+        self.assertRaises(
+                errors.ReadSelectionError, data.getColumns, [0], 0, None, 0, '')
+        self.assertRaises(
+                errors.ReadSelectionError, data.getColumns, [0], 0, None, 1, 'x')
+
+    @mock.patch.object(backend, 'READ_BLOCK_ROWS', 4)
+    def test_filtered_rows_are_read_in_blocks(self):
+        results = []
+        for storage in [backend.DEFAULT_STORAGE, backend.make_storage_options()]:
+            data = self.get_backend_data(_unique_filename())
+            data.initialize_info('Foo', _INDEPENDENTS, _DEPENDENTS, storage)
+            rows = np.zeros((11,), dtype=data.dtype)
+            for idx, field in enumerate(data.dtype.names):
+                rows[field] = np.arange(11) * (idx + 1) * (-1) ** np.arange(11)
+            data.addData(rows)
+            with mock.patch.object(data, '_readRows', wraps=data._readRows) as read:
+                results.append([
+                        data.getDataTranspose(None, 1)[0],
+                        data.getColumns([2, 0], 1, 10, 3, '')[0],
+                        data.getColumns([1, 2], 0, None, 3, 'minmax')[0]])
+                self.assertEqual(storage.compression == 'gzip', not read.called)
+        for filtered, unfiltered in zip(*results):
+            for a, b in zip(filtered, unfiltered):
+                self.assert_arrays_equal(a, b)
+        self.assert_arrays_equal(results[0][1][1], [-1, 4, -7])
+
+    def test_get_data_transpose_strings(self):
+        name = _unique_filename()
+        data = self.get_backend_data(name)
+        independents = [
+                backend.Independent(
+                        label='Time', shape=(1,), datatype='v', unit='s'),
+                backend.Independent(
+                        label='Note', shape=(1,), datatype='s', unit='')]
+        data.initialize_info('Foo', independents, [])
+        data_entry = np.recarray((2, ), dtype=[('f0', '<f8'), ('f1', 'O')])
+        data_entry[0] = (1.0, 'first')
+        data_entry[1] = (2.0, 'second')
+        data.addData(data_entry)
+        (times, notes), _ = data.getData(None, 0, True, None)
+        self.assert_arrays_equal(times, [1.0, 2.0])
+        self.assertEqual(notes, ['first', 'second'])
+        rows, _ = data.getData(None, 0, False, None)
+        self.assertEqual(rows, [(1.0, 'first'), (2.0, 'second')])
 
     def test_initialize_info_bad_vars(self):
         bad_independents = [
@@ -770,6 +999,156 @@ class ExtendedHDF5DataTest(_BackendDataTest):
         added_data, _ = data.getData(None, 0, False, None)
         self.assertEqual(added_data[0][0], "{'a': 0}")
 
+    def test_comments_use_dataset(self):
+        for i in range(2000):
+            self.data.addComment('user', 'step {} of a long sweep'.format(i))
+        self.assertEqual(self.data.numComments(), 2000)
+        self.assertEqual(self.data.file['Comments'].shape, (2000,))
+        self.assertEqual(len(self.data.dataset.attrs['Comments']), 0)
+        comments, next_pos = self.data.getComments(2, 1500)
+        self.assertEqual(next_pos, 1502)
+        self.assertEqual(
+                [c[2] for c in comments],
+                ['step 1500 of a long sweep', 'step 1501 of a long sweep'])
+
+    def test_legacy_comments_attribute(self):
+        legacy = np.array([(0.0, 'old user', 'old comment')],
+                          dtype=backend.HDF5MetaData.comment_type)
+        self.data.dataset.attrs.create(
+                'Comments', legacy, dtype=backend.HDF5MetaData.comment_type)
+        self.data.addComment('new user', 'new comment')
+        self.assertEqual(self.data.numComments(), 2)
+        comments, next_pos = self.data.getComments(None, 0)
+        self.assertEqual(next_pos, 2)
+        self.assertEqual([c[1:] for c in comments],
+                         [('old user', 'old comment'), ('new user', 'new comment')])
+        comments, next_pos = self.data.getComments(None, 1)
+        self.assertEqual([c[1:] for c in comments], [('new user', 'new comment')])
+        self.assertEqual(self.data.getComments(None, 2), ([], 2))
+
+    def test_add_rows_grows_capacity_geometrically(self):
+        row = np.recarray(
+            (1, ),
+            dtype=[('f0', '<f8'), ('f1', '<f8'), ('f2', '<f8')])
+        for i in range(3):
+            row[0] = (i, i, i)
+            self.data.addData(row)
+        self.assertEqual(len(self.data), 3)
+        self.assertEqual(self.data.dataset.shape, (backend.MIN_CAPACITY,))
+        self.assertTrue(self.data.hasMore(2))
+        self.assertFalse(self.data.hasMore(3))
+        read_data, next_pos = self.data.getData(None, 1, False, None)
+        self.assertEqual(next_pos, 3)
+        self.assert_arrays_equal(read_data, [(1, 1, 1), (2, 2, 2)])
+
+    def test_close_trims_capacity(self):
+        row = np.recarray(
+            (1, ),
+            dtype=[('f0', '<f8'), ('f1', '<f8'), ('f2', '<f8')])
+        row[0] = (1, 2, 3)
+        self.data.addData(row)
+        self.data.close()
+        with h5py.File(self.filename, 'r') as f:
+            self.assertEqual(f['DataVault'].shape, (1,))
+        self.assertEqual(len(self.data), 1)
+
+    def test_initialize_default_storage(self):
+        dataset = self.data.dataset
+        self.assertEqual(dataset.chunks, (backend.CHUNK_BYTES // 24,))
+        self.assertEqual(dataset.compression, 'gzip')
+        self.assertTrue(dataset.shuffle)
+
+    def test_initialize_storage_options(self):
+        name = _unique_filename()
+        data = self.get_backend_data(name)
+        storage = backend.make_storage_options(128, 'lzf', 0, False)
+        data.initialize_info('Foo', _INDEPENDENTS, _DEPENDENTS, storage)
+        self.assertEqual(data.dataset.chunks, (128,))
+        self.assertEqual(data.dataset.compression, 'lzf')
+        self.assertFalse(data.dataset.shuffle)
+
+    def test_bad_storage_options(self):
+        self.assertRaises(
+                errors.StorageOptionsError,
+                backend.make_storage_options, 0, 'bzip2', 0, False)
+        self.assertRaises(
+                errors.StorageOptionsError,
+                backend.make_storage_options, 0, 'gzip', 10, False)
+
+    def _finalized(self, storage):
+        name = _unique_filename()
+        data = self.get_backend_data(name)
+        data.initialize_info('Foo', _INDEPENDENTS, _DEPENDENTS, storage)
+        rows = np.zeros((5,), dtype=data.dtype)
+        for idx, field in enumerate(data.dtype.names):
+            rows[field] = np.arange(5) + 10 * idx
+        data.addData(rows)
+        data.addComment('me', 'done')
+        final_name = _unique_filename()
+        self.files_to_remove.append(final_name)
+        data.finalize(final_name)
+        data.close()
+        final = backend.open_hdf5_file(final_name)
+        self.addCleanup(final.close)
+        return final
+
+    def test_finalize_maps_contiguous_rows(self):
+        data = self._finalized(backend.make_storage_options())
+        self.assertTrue(data.readonly)
+        self.assertIsNone(data.dataset.chunks)
+        self.assertIsNotNone(data._mapped())
+        self.assertEqual(5, len(data))
+        self.assertEqual('Foo', data.getTitle())
+        self.assertEqual('done', data.getComments(None, 0)[0][0][2])
+        columns, pos = data.getData(None, 1, True, None)
+        self.assertEqual(5, pos)
+        self.assert_arrays_equal(columns, [[1, 2, 3, 4], [11, 12, 13, 14], [21, 22, 23, 24]])
+        columns, _ = data.getColumns([2], 0, None, 2, 'minmax')
+        self.assert_arrays_equal(columns, [[20, 21, 22, 23, 24, 24]])
+
+    def test_finalize_removes_compression(self):
+        data = self._finalized(backend.DEFAULT_STORAGE)
+        self.assertTrue(data.readonly)
+        self.assertIsNone(data.dataset.compression)
+        self.assertFalse(data.dataset.shuffle)
+        self.assertEqual((5,), data.dataset.shape)
+        self.assertIsNotNone(data._mapped())
+        columns, _ = data.getData(None, 0, True, None)
+        self.assert_arrays_equal(columns[1], [10, 11, 12, 13, 14])
+
+    def test_open_finalized_file_for_reading(self):
+        data = self.get_backend_data(_unique_filename())
+        data.initialize_info('Foo', _INDEPENDENTS, _DEPENDENTS)
+        final_name = _unique_filename()
+        self.files_to_remove.append(final_name)
+        data.finalize(final_name)
+        data.close()
+        with mock.patch('h5py.File', wraps=h5py.File) as open_file:
+            final = backend.open_hdf5_file(final_name)
+        self.addCleanup(final.close)
+        self.assertEqual([mock.call(final_name, 'r')], open_file.call_args_list)
+        self.assertTrue(final.readonly)
+        self.assertEqual('r', final.file.mode)
+
+    def test_open_unwritable_file_read_only(self):
+        name = _unique_filename()
+        data = self.get_backend_data(name)
+        data.initialize_info('Foo', _INDEPENDENTS, _DEPENDENTS)
+        data.close()
+        opened = []
+        h5py_file = h5py.File
+        def open_file(filename, mode):
+            opened.append(mode)
+            if mode == 'a':
+                raise IOError('read-only file system')
+            return h5py_file(filename, mode)
+        with mock.patch('h5py.File', side_effect=open_file):
+            data = backend.open_hdf5_file(name)
+        self.addCleanup(data.close)
+        self.assertEqual(['r', 'a', 'r'], opened)
+        self.assertTrue(data.readonly)
+        self.assertEqual('Foo', data.getTitle())
+
     def test_add_string_array_column(self):
         name = _unique_filename()
         data = self.get_backend_data(name)
@@ -802,8 +1181,7 @@ class SimpleHDF5DataTest(_BackendDataTest):
 
     def get_backend_data(self, filename):
         self.filenames_to_remove.append(filename)
-        fh = backend.SelfClosingFile(
-                h5py.File, open_args=(filename, 'a'), reactor=self.clock)
+        fh = backend.SelfClosingFile(h5py.File, open_args=(filename, 'a'))
         return backend.SimpleHDF5Data(fh)
 
     def test_empty_data_read(self):
@@ -811,5 +1189,77 @@ class SimpleHDF5DataTest(_BackendDataTest):
         self.assertEqual(read_data.dtype, np.dtype(float))
         self.assertEqual(read_data.size, 0)
 
+
+class MigrateCsvDatasetTest(_TestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.datadir, '00001 - Foo')
+        self.clock = task.Clock()
+        data = backend.CsvNumpyData(self.filename + '.csv', reactor=self.clock)
+        data.initialize_info('FooTitle', _INDEPENDENTS, _DEPENDENTS)
+        data.addParam('Gain', 3.5)
+        data.addComment('me', 'a comment')
+        rows = np.recarray(
+            (5, ),
+            dtype=[('f0', '<f8'), ('f1', '<f8'), ('f2', '<f8')])
+        for i in range(5):
+            rows[i] = (i, 0.25 * i, -100 * i)
+        data.addData(rows)
+        data.save()
+        data.close()
+        self.expected = [[i, 0.25 * i, -100 * i] for i in range(5)]
+
+    def tearDown(self):
+        for name in os.listdir(self.datadir):
+            os.unlink(os.path.join(self.datadir, name))
+        os.rmdir(self.datadir)
+
+    def test_migrate(self):
+        rows, checksum = backend.migrate_csv_dataset(self.filename)
+        self.assertEqual(rows, 5)
+        self.assertEqual(
+                sorted(os.listdir(self.datadir)),
+                ['00001 - Foo.csv.migrated', '00001 - Foo.hdf5',
+                 '00001 - Foo.ini.migrated'])
+
+        data = backend.open_backend(self.filename)
+        self.assertIsInstance(data, backend.SimpleHDF5Data)
+        read_data, next_pos = data.getData(None, 0, False, None)
+        self.assertEqual(next_pos, 5)
+        self.assert_arrays_equal(read_data, self.expected)
+        self.assertEqual(data.getIndependents()[0].label, 'FirstVariable')
+        self.assertEqual(data.getDependents()[0].legend, 'OnlyDependent')
+        self.assertEqual(data.getParameter('Gain'), 3.5)
+        self.assertEqual(data.numComments(), 1)
+        data.close()
+
+    def test_migrate_bypasses_file_cache(self):
+        with mock.patch.object(backend.FILE_CACHE, 'touch') as touch:
+            backend.migrate_csv_dataset(self.filename)
+        self.assertFalse(touch.called)
+        self.assertTrue(os.path.exists(self.filename + '.hdf5'))
+
+    def test_migrate_checks_csv_source(self):
+        parse = backend.CsvRowIndex.readRows
+        def misparse(index, start, stop):
+            rows = parse(index, start, stop)
+            rows[-1, -1] += 1
+            return rows
+        with mock.patch.object(backend.CsvRowIndex, 'readRows', misparse):
+            self.assertRaises(
+                    errors.MigrationError, backend.migrate_csv_dataset, self.filename)
+        self.assertFalse(os.path.exists(self.filename + '.hdf5'))
+        self.assertTrue(os.path.exists(self.filename + '.csv'))
+
+    def test_migrate_failure_keeps_csv(self):
+        with open(self.filename + '.csv', 'a') as f:
+            f.write('1, 2\r\n')
+        self.assertRaises(
+                errors.MigrationError, backend.migrate_csv_dataset, self.filename)
+        self.assertFalse(os.path.exists(self.filename + '.hdf5'))
+        self.assertFalse(os.path.exists(self.filename + '.hdf5.part'))
+        self.assertTrue(os.path.exists(self.filename + '.csv'))
+
 if __name__ == '__main__':
     pytest.main(['-v', __file__])
@@ -7,9 +7,12 @@ import unittest
 
 from labrad import types
 
-from twisted.internet import task
+from twisted.internet import defer, task
+from twisted.trial.unittest import SynchronousTestCase
 
-from datavault import Session, Dataset, SessionStore
+import datavault
+from datavault import backend, errors, Session, Dataset, SessionStore
+from datavault.executor import SynchronousExecutor
 
 
 def _unique_dir():
@@ -60,14 +63,17 @@ class TestSessionStore(unittest.TestCase):
         self.assertEqual(new_session, got_session)
 
     def test_get_all_sessions(self):
-        store = SessionStore(self.datadir, self.hub)
+        clock = task.Clock()
+        store = SessionStore(self.datadir, self.hub, reactor=clock)
         # Create a new session.
         foo_session = store.get('foo')
         bar_session = store.get('bar')
+        # Sessions with delayed saves are kept until they are written.
+        clock.advance(datavault.METADATA_SAVE_DELAY)
         self.assertEqual([foo_session, bar_session], store.get_all())
 
 
-class _DatavaultTestCase(unittest.TestCase):
+class _DatavaultTestCase(SynchronousTestCase):
     _TITLE = 'Foo'
     _INDEPENDENTS = [('Current', 'mA'), ('Freq', 'Ghz')]
     _DEPENDENTS = [('Dep 1', 'Voltage', 'V')]
@@ -98,8 +104,10 @@ class _DatavaultTestCase(unittest.TestCase):
                         expected_var.legend, actual_var.legend, msg=msg)
 
     def assertDatasetsEqual(self, expected, actual):
-        expected_entries, expected_num = expected.getData(None, 0)
-        actual_entries, actual_num = actual.getData(None, 0)
+        expected_entries, expected_num = self.successResultOf(
+                expected.getData(None, 0))
+        actual_entries, actual_num = self.successResultOf(
+                actual.getData(None, 0))
         self.assertEqual(expected_num, actual_num)
         self.assertArrayEqual(expected_entries, actual_entries)
         expected_independents = expected.getIndependents()
@@ -112,6 +120,156 @@ class _DatavaultTestCase(unittest.TestCase):
                 expected_dependents, actual_dependents)
 
 
+class DirectoryIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = _unique_dir()
+        # pretend the directory was last changed long ago so that
+        # listings are trusted
+        self.mtime = 1000000000.0
+        os.utime(self.dir, (self.mtime, self.mtime))
+        self.index = datavault.DirectoryIndex(self.dir)
+
+    def tearDown(self):
+        _empty_and_remove_dir(self.dir)
+
+    def touch(self, name):
+        open(os.path.join(self.dir, name), 'w').close()
+        self.mtime += 10
+        os.utime(self.dir, (self.mtime, self.mtime))
+
+    def test_listing(self):
+        self.touch('00002 - b%fc.hdf5')
+        self.touch('00001 - a.csv')
+        self.touch('00001 - a.ini')
+        self.touch('session.ini')
+        os.mkdir(os.path.join(self.dir, 'sub.dir'))
+        self.assertEqual(
+                (['sub'], ['00001 - a', '00002 - b/c']), self.index.listing())
+        self.assertEqual('00002 - b/c', self.index.lookup(2))
+        self.assertEqual(None, self.index.lookup(3))
+
+    def test_rescans_only_when_changed(self):
+        self.touch('00001 - a.hdf5')
+        self.index.listing()
+        with mock.patch('os.listdir') as listdir:
+            self.assertEqual('00001 - a', self.index.lookup(1))
+            self.assertFalse(listdir.called)
+        # a dataset added by another program is seen
+        self.touch('00002 - b.hdf5')
+        self.assertEqual('00002 - b', self.index.lookup(2))
+
+    def test_own_changes_do_not_rescan(self):
+        self.index.listing()
+        self.touch('00001 - a.hdf5')
+        with mock.patch('os.listdir') as listdir:
+            self.index.addDataset('00001 - a')
+            self.assertEqual('00001 - a', self.index.lookup(1))
+            self.assertFalse(listdir.called)
+
+    def test_rewritten_file_does_not_rescan(self):
+        self.index.listing()
+        self.touch('session.ini')
+        self.index.rewritten(self.mtime - 10, self.mtime)
+        with mock.patch('os.listdir') as listdir:
+            self.index.listing()
+            self.assertFalse(listdir.called)
+        # something else changed the directory meanwhile
+        self.touch('00001 - a.hdf5')
+        self.index.rewritten(self.mtime - 5, self.mtime)
+        self.assertEqual('00001 - a', self.index.lookup(1))
+
+    def test_recent_change_is_rescanned(self):
+        self.touch('00001 - a.hdf5')
+        now = os.path.getmtime(self.dir) + 1
+        with mock.patch('time.time', return_value=now):
+            self.index.listing()
+        with mock.patch('os.listdir', return_value=[]) as listdir:
+            self.index.listing()
+            self.assertTrue(listdir.called)
+
+
+class ListenerIndexTest(unittest.TestCase):
+
+    class _Listened(object):
+        def __init__(self):
+            self.listeners = set()
+
+    def test_expire(self):
+        index = datavault.ListenerIndex()
+        a, b = self._Listened(), self._Listened()
+        for obj in [a, b]:
+            obj.listeners.add('ctx')
+            index.register('ctx', obj, 'listeners')
+        b.listeners.add('other')
+        index.register('other', b, 'listeners')
+        # sets replaced after a notification are found again
+        b.listeners = set(['ctx', 'other'])
+        del a
+        index.expire('ctx')
+        self.assertEqual(set(['other']), b.listeners)
+        index.expire('ctx')
+
+
+class TagIndexTest(SynchronousTestCase):
+
+    def setUp(self):
+        self.datadir = _unique_dir()
+        self.clock = task.Clock()
+        store = SessionStore(self.datadir, mock.MagicMock(), reactor=self.clock)
+        root = store.get([''])
+        sub = store.get(['', 'sub'])
+        root.updateTags(['star'], [], ['00001 - a', '00002 - b'])
+        root.updateTags(['trash'], [], ['00002 - b'])
+        sub.updateTags(['star'], [], ['00001 - c'])
+        self.index = store.tag_index
+
+    def tearDown(self):
+        _empty_and_remove_dir(self.datadir)
+
+    def test_search(self):
+        self.assertEqual(
+                [(('',), '00001 - a'), (('',), '00002 - b'), (('', 'sub'), '00001 - c')],
+                self.successResultOf(self.index.search(['star'])))
+        self.assertEqual(
+                [(('',), '00001 - a'), (('', 'sub'), '00001 - c')],
+                self.successResultOf(self.index.search(['star', '-trash'])))
+        self.assertEqual([], self.successResultOf(self.index.search(['nothing'])))
+        self.assertRaises(
+                datavault.errors.TagSearchError, self.index.search, ['-trash'])
+
+    def test_saved_index_is_loaded(self):
+        self.clock.advance(datavault.METADATA_SAVE_DELAY)
+        index = datavault.TagIndex(self.datadir, reactor=self.clock)
+        with mock.patch.object(index, '_walk') as walk:
+            self.assertEqual(3, len(self.successResultOf(index.search(['star']))))
+            self.assertFalse(walk.called)
+
+    def test_missing_index_is_rebuilt(self):
+        index = datavault.TagIndex(self.datadir, reactor=self.clock)
+        self.assertFalse(os.path.exists(index.filename))
+        self.assertEqual(
+                [(('',), '00002 - b')], self.successResultOf(index.search(['trash'])))
+        self.assertEqual(3, len(self.successResultOf(index.search(['star']))))
+
+    def test_search_waits_for_rebuild(self):
+        executor = mock.MagicMock()
+        reads = []
+        def submit(key, f, *args):
+            reads.append(defer.Deferred())
+            return reads[-1].addCallback(lambda _: f(*args))
+        executor.submit.side_effect = submit
+        index = datavault.TagIndex(self.datadir, executor, reactor=self.clock)
+        index.update(['', 'sub'], {'00002 - d': ['star']})
+        found = index.search(['star'])
+        self.assertNoResult(found)
+        self.assertEqual(1, len(reads))
+        reads[0].callback(None)
+        self.assertEqual(
+                [(('',), '00001 - a'), (('',), '00002 - b'), (('', 'sub'), '00002 - d')],
+                self.successResultOf(found))
+
+
 class SessionTest(_DatavaultTestCase):
 
     def setUp(self):
@@ -131,6 +289,28 @@ class SessionTest(_DatavaultTestCase):
         self.assertEqual(len(dirs), 0)
         self.assertEqual(len(datasets), 0)
 
+    def test_access_save_is_delayed(self):
+        self.store.reactor = clock = task.Clock()
+        self._get_session()
+        session = self._get_session()
+        with mock.patch('datavault.util.write_config') as write_config:
+            session.access()
+            self.assertFalse(write_config.called)
+            clock.advance(datavault.METADATA_SAVE_DELAY)
+            self.assertEqual(1, write_config.call_count)
+
+            # a save writes any delayed changes along with it
+            session.access()
+            session.save()
+            self.assertEqual(2, write_config.call_count)
+            self.assertEqual([], clock.getDelayedCalls())
+
+            session.access()
+            self.successResultOf(session.flushSave())
+            self.assertEqual(3, write_config.call_count)
+            self.successResultOf(session.flushSave())
+            self.assertEqual(3, write_config.call_count)
+
     def test_add_new_dataset(self):
         session = self._get_session()
         dataset = session.newDataset(
@@ -143,6 +323,15 @@ class SessionTest(_DatavaultTestCase):
         opened_dataset = session.openDataset('00001 - Foo')
         self.assertDatasetsEqual(dataset, opened_dataset)
 
+    def test_open_dataset_by_number(self):
+        session = self._get_session()
+        session.newDataset(self._TITLE, self._INDEPENDENTS, self._DEPENDENTS)
+        dataset = session.newDataset(
+                'Bar', self._INDEPENDENTS, self._DEPENDENTS)
+        self.assertIs(dataset, session.openDataset(2))
+        self.assertRaises(
+                datavault.errors.DatasetNotFoundError, session.openDataset, 3)
+
     def test_add_child_session(self):
         parent_session = self._get_session(path=['parent'])
         # Add a listener
@@ -157,6 +346,7 @@ class SessionTest(_DatavaultTestCase):
         d1 = s1.newDataset(self._TITLE, self._INDEPENDENTS, self._DEPENDENTS)
         d1.addData(np.array([0]))
         d1.addData(np.array([1]))
+        self.successResultOf(d1.flush())
         s1.save()
         self.assertEqual(['00001 - Foo'], s1.listDatasets())
 
@@ -168,6 +358,49 @@ class SessionTest(_DatavaultTestCase):
         d2 = s2.openDataset(datasets[0])
         self.assertDatasetsEqual(d1, d2)
 
+    def _make_csv_dataset(self, session, extra=''):
+        base = os.path.join(session.dir, '00001 - Foo')
+        data = backend.CsvNumpyData(base + '.csv', reactor=task.Clock())
+        data.initialize_info(
+                'Foo',
+                [backend.Independent(label='x', shape=(1,), datatype='v', unit='ms')],
+                [backend.Dependent(label='y', legend='', shape=(1,), datatype='v', unit='V')])
+        data.addData(np.rec.fromrecords([(1, 2), (2, 3)], names='f0,f1'))
+        data.save()
+        data.close()
+        with open(base + '.csv', 'a') as f:
+            f.write(extra)
+        return base
+
+    def test_upgrade_csv_dataset(self):
+        self.store.upgrade_csv = True
+        session = self._get_session()
+        base = self._make_csv_dataset(session)
+        self.successResultOf(session.upgradeDataset(1))
+        self.assertFalse(os.path.exists(base + '.csv'))
+        dataset = session.openDataset('00001 - Foo')
+        self.assertEqual('2.0.0', dataset.version())
+        dataset.close()
+
+    def test_csv_save_stays_on_reactor_thread(self):
+        session = self._get_session()
+        base = self._make_csv_dataset(session)
+        dataset = session.openDataset('00001 - Foo')
+        dataset.addParameter('gain', 2.0, saveNow=False)
+        with mock.patch.object(session.executor, 'submit') as submit:
+            self.successResultOf(dataset.save())
+            self.assertFalse(submit.called)
+        with open(base + '.ini') as f:
+            self.assertIn('gain', f.read())
+
+    def test_failed_upgrade_keeps_csv(self):
+        self.store.upgrade_csv = True
+        session = self._get_session()
+        base = self._make_csv_dataset(session, extra='1, 2, 3\r\n')
+        self.successResultOf(session.upgradeDataset('00001 - Foo'))
+        self.assertEqual(1, len(self.flushLoggedErrors(errors.MigrationError)))
+        self.assertTrue(os.path.exists(base + '.csv'))
+
     def test_add_new_tags(self):
         session1 = self._get_session()
         dataset1 = session1.newDataset(
@@ -270,6 +503,7 @@ class DatasetTest(_DatavaultTestCase):
         self.hub = mock.MagicMock()
         self.session = mock.MagicMock()
         self.session.hub = self.hub
+        self.session.executor = SynchronousExecutor()
         self.session.dir = _unique_dir()
 
     def tearDown(self):
@@ -372,7 +606,8 @@ class DatasetTest(_DatavaultTestCase):
         dataset.addData(data)
 
         self.hub.onDataAvailable.assert_called_with(None, set(['foo listener']))
-        data_in_dataset, count = dataset.getData(None, 0, simpleOnly=True)
+        data_in_dataset, count = self.successResultOf(
+                dataset.getData(None, 0, simpleOnly=True))
         self.assertEqual(count, 2)
         self.assertArrayEqual([1, 2, 3], data_in_dataset[0])
         self.assertArrayEqual([2, 3, 4], data_in_dataset[1])
@@ -397,7 +632,8 @@ class DatasetTest(_DatavaultTestCase):
 
         self.hub.onDataAvailable.assert_called_with(None, set(['foo listener']))
 
-        data_in_dataset, count = dataset.getData(None, 0, simpleOnly=False)
+        data_in_dataset, count = self.successResultOf(
+                dataset.getData(None, 0, simpleOnly=False))
         self.assertEqual(count, 2)
         self.assertArrayEqual(row_1[0], data_in_dataset[0][0])
         self.assertArrayEqual(row_1[1], data_in_dataset[0][1])
@@ -434,7 +670,8 @@ class DatasetTest(_DatavaultTestCase):
                 title=self._TITLE,
                 extended=True)
 
-        data_in_dataset, count = new_dataset.getData(None, 0, simpleOnly=False)
+        data_in_dataset, count = self.successResultOf(
+                new_dataset.getData(None, 0, simpleOnly=False))
         self.assertEqual(count, 2)
         self.assertArrayEqual(row_1[0], data_in_dataset[0][0])
         self.assertArrayEqual(row_1[1], data_in_dataset[0][1])
@@ -443,6 +680,269 @@ class DatasetTest(_DatavaultTestCase):
         self.assertArrayEqual(row_2[1], data_in_dataset[1][1])
         self.assertArrayEqual(row_2[2], data_in_dataset[1][2])
 
+    def test_add_data_is_buffered(self):
+        dataset = Dataset(
+                self.session,
+                "Foo Name",
+                title=self._TITLE,
+                create=True,
+                independents=self._INDEPENDENTS,
+                dependents=self._DEPENDENTS)
+        clock = task.Clock()
+        dataset.reactor = clock
+
+        data = self._get_records_simple([(1, 2, 3)], dataset.data.dtype)
+        dataset.addData(data)
+        dataset.addData(data)
+        # Nothing is written until the buffer deadline passes.
+        self.assertEqual(0, len(dataset.data))
+        self.assertTrue(dataset.hasMore(1))
+        self.assertFalse(dataset.hasMore(2))
+        clock.advance(datavault.WRITE_BUFFER_DELAY)
+        self.assertEqual(2, len(dataset.data))
+        self.assertEqual([], clock.getDelayedCalls())
+
+    def test_full_buffer_is_flushed(self):
+        dataset = Dataset(
+                self.session,
+                "Foo Name",
+                title=self._TITLE,
+                create=True,
+                independents=self._INDEPENDENTS,
+                dependents=self._DEPENDENTS)
+        dataset.reactor = task.Clock()
+
+        data = self._get_records_simple([(1, 2, 3), (2, 3, 4)], dataset.data.dtype)
+        with mock.patch('datavault.WRITE_BUFFER_ROWS', 3):
+            dataset.addData(data)
+            self.assertEqual(0, len(dataset.data))
+            dataset.addData(data)
+            self.assertEqual(4, len(dataset.data))
+
+    def test_failed_write_keeps_rows(self):
+        dataset = Dataset(
+                self.session,
+                "Foo Name",
+                title=self._TITLE,
+                create=True,
+                independents=self._INDEPENDENTS,
+                dependents=self._DEPENDENTS)
+        clock = task.Clock()
+        dataset.reactor = clock
+
+        data = self._get_records_simple([(1, 2, 3)], dataset.data.dtype)
+        dataset.addData(data)
+        with mock.patch.object(dataset.data, 'addData', side_effect=IOError('disk full')):
+            clock.advance(datavault.WRITE_BUFFER_DELAY)
+        self.assertEqual(1, len(self.flushLoggedErrors(IOError)))
+        self.assertEqual(0, len(dataset.data))
+        self.assertTrue(dataset.hasMore(0))
+        # The rows are written on the next attempt.
+        clock.advance(datavault.WRITE_BUFFER_DELAY)
+        self.assertEqual(1, len(dataset.data))
+        self.assertEqual([], clock.getDelayedCalls())
+
+    def test_read_buffered_rows(self):
+        dataset = Dataset(
+                self.session,
+                "Foo Name",
+                title=self._TITLE,
+                create=True,
+                independents=self._INDEPENDENTS,
+                dependents=self._DEPENDENTS)
+        dataset.reactor = task.Clock()
+
+        data = self._get_records_simple([(1, 2, 3), (2, 3, 4)], dataset.data.dtype)
+        dataset.addData(data)
+        self.successResultOf(dataset.flush())
+        dataset.addData(data)
+        rows, pos = self.successResultOf(dataset.getData(None, 3))
+        self.assertArrayEqual([[2, 3, 4]], rows)
+        self.assertEqual(4, pos)
+        # Rows in memory are read without writing them.
+        self.assertEqual(2, len(dataset.data))
+        # A read from before them waits for them to be written.
+        rows, pos = self.successResultOf(dataset.getData(None, 1))
+        self.assertArrayEqual([[2, 3, 4], [1, 2, 3], [2, 3, 4]], rows)
+        self.assertEqual(4, pos)
+        self.assertEqual(4, len(dataset.data))
+
+    def test_access_save_is_delayed(self):
+        self.session.reactor = clock = task.Clock()
+        dataset = Dataset(
+                self.session,
+                "Foo Name",
+                title=self._TITLE,
+                create=True,
+                independents=self._INDEPENDENTS,
+                dependents=self._DEPENDENTS)
+        dataset.access()
+        dataset.access()
+        self.assertEqual(1, len(clock.getDelayedCalls()))
+        with mock.patch.object(dataset.data, 'save') as save:
+            self.successResultOf(dataset.close())
+            self.assertEqual(1, save.call_count)
+        self.assertEqual([], clock.getDelayedCalls())
+
+    def test_stream_pushes_new_rows(self):
+        self.session.reactor = task.Clock()
+        dataset = Dataset(
+                self.session,
+                "Foo Name",
+                title=self._TITLE,
+                create=True,
+                independents=self._INDEPENDENTS,
+                dependents=self._DEPENDENTS)
+        dtype = dataset.data.dtype
+        dataset.stream('ctx', 0)
+        self.assertFalse(self.hub.onDataPushed.called)
+
+        dataset.addData(self._get_records_simple([(1, 2, 3), (2, 3, 4)], dtype))
+        (start, stop, cols), contexts = self.hub.onDataPushed.call_args[0]
+        self.assertEqual((0, 2, ['ctx']), (start, stop, contexts))
+        self.assertArrayEqual([1, 2], cols[0])
+        self.assertArrayEqual([3, 4], cols[2])
+        # The rows are pushed from the write buffer.
+        self.assertEqual(0, len(dataset.data))
+
+        # Nothing more is pushed until the push is acknowledged.
+        dataset.addData(self._get_records_simple([(3, 4, 5)], dtype))
+        dataset.addData(self._get_records_simple([(4, 5, 6)], dtype))
+        self.assertEqual(1, self.hub.onDataPushed.call_count)
+        dataset.ackStream('ctx')
+        (start, stop, cols), _ = self.hub.onDataPushed.call_args[0]
+        self.assertEqual((2, 4), (start, stop))
+        self.assertArrayEqual([3, 4], cols[0])
+
+        dataset.stopStream('ctx')
+        dataset.ackStream('ctx')
+        dataset.addData(self._get_records_simple([(5, 6, 7)], dtype))
+        self.assertEqual(2, self.hub.onDataPushed.call_count)
+
+    def test_get_columns_joins_buffered_rows(self):
+        dataset = Dataset(
+                self.session,
+                "Foo Name",
+                title=self._TITLE,
+                create=True,
+                independents=self._INDEPENDENTS,
+                dependents=self._DEPENDENTS)
+        dataset.reactor = task.Clock()
+        dtype = dataset.data.dtype
+        dataset.addData(self._get_records_simple([(0, 1, 2), (1, 2, 3), (2, 3, 4)], dtype))
+        self.successResultOf(dataset.flush())
+        dataset.addData(self._get_records_simple([(3, 4, 5), (4, 5, 6)], dtype))
+
+        cols, stop = self.successResultOf(dataset.getColumns([0, 2], 1, None, 2))
+        self.assertEqual(5, stop)
+        self.assertArrayEqual([1, 3], cols[0])
+        self.assertArrayEqual([3, 5], cols[1])
+        cols, stop = self.successResultOf(dataset.getColumns([1], 4, 10))
+        self.assertEqual(5, stop)
+        self.assertArrayEqual([5], cols[0])
+        self.assertEqual(3, len(dataset.data))
+
+    def test_get_columns_during_write(self):
+        dataset = Dataset(
+                self.session,
+                "Foo Name",
+                title=self._TITLE,
+                create=True,
+                independents=self._INDEPENDENTS,
+                dependents=self._DEPENDENTS)
+        dataset.reactor = task.Clock()
+        dtype = dataset.data.dtype
+        def rows(start, stop):
+            return self._get_records_simple([(i, 0, 0) for i in range(start, stop)], dtype)
+        dataset.addData(rows(0, 5))
+        self.successResultOf(dataset.flush())
+
+        # calls wait in the executor until the test runs them
+        calls = []
+        def submit(key, f, *args):
+            d = defer.Deferred()
+            calls.append((f, args, d))
+            return d
+        def run():
+            f, args, d = calls.pop(0)
+            d.callback(f(*args))
+        dataset.executor = mock.MagicMock()
+        dataset.executor.submit.side_effect = submit
+        dataset.addData(rows(5, 10))
+        written = dataset.flush()
+        dataset.addData(rows(10, 15))
+        d = dataset.getColumns([0], 3, None)
+        # the write of rows 5-9 finishes before the backend read of rows 3-4
+        run()
+        self.successResultOf(written)
+        run()
+        cols, stop = self.successResultOf(d)
+        self.assertEqual(15, stop)
+        self.assertArrayEqual(np.arange(3, 15), cols[0])
+
+    def test_metadata_io_is_ordered_with_writes(self):
+        dataset = Dataset(
+                self.session,
+                "Foo Name",
+                title=self._TITLE,
+                create=True,
+                independents=self._INDEPENDENTS,
+                dependents=self._DEPENDENTS)
+        dataset.reactor = task.Clock()
+        calls = []
+        def submit(key, f, *args):
+            d = defer.Deferred()
+            calls.append((f, args, d))
+            return d
+        dataset.executor = mock.MagicMock()
+        dataset.executor.submit.side_effect = submit
+        dataset.addData(self._get_records_simple([(0, 1, 2)], dataset.data.dtype))
+        written = dataset.flush()
+        added = dataset.addParameter('gain', 2.0)
+        commented = dataset.addComment('me', 'note')
+        dataset.access()
+        self.assertEqual(
+                ['addData', 'addParam', 'addComment', 'access'],
+                [f.__name__ for f, _, _ in calls])
+        self.assertNoResult(added)
+        for f, args, d in list(calls):
+            d.callback(f(*args))
+        self.successResultOf(written)
+        self.assertEqual('gain', self.successResultOf(added))
+        self.successResultOf(commented)
+        self.assertEqual(1, self.hub.onNewParameter.call_count)
+        self.assertEqual(1, self.hub.onCommentsAvailable.call_count)
+
+    def test_stream_max_rate_and_preview(self):
+        self.session.reactor = clock = task.Clock()
+        dataset = Dataset(
+                self.session,
+                "Foo Name",
+                title=self._TITLE,
+                create=True,
+                independents=self._INDEPENDENTS,
+                dependents=self._DEPENDENTS)
+        dtype = dataset.data.dtype
+        dataset.stream('ctx', 0, max_rate=2, max_rows=4, mode='minmax', window=10)
+        dataset.addData(self._get_records_simple([(1, 2, 3)], dtype))
+        self.assertEqual(1, self.hub.onDataPushed.call_count)
+
+        # Rows added within 1/max_rate are held back and then sent together.
+        rows = [(i, 0, (-1) ** i * i) for i in range(10)]
+        dataset.addData(self._get_records_simple(rows, dtype))
+        self.assertEqual(1, self.hub.onDataPushed.call_count)
+        clock.advance(0.5)
+        self.assertEqual(2, self.hub.onDataPushed.call_count)
+        (start, stop, cols), _ = self.hub.onDataPushed.call_args[0]
+        self.assertEqual((1, 11), (start, stop))
+        # ten rows in bins of five, each reduced to its min and max
+        self.assertArrayEqual([0, 4, 5, 9], cols[0])
+        self.assertArrayEqual([-3, 4, -9, 8], cols[2])
+
+        self.assertRaises(
+                datavault.errors.ReadSelectionError,
+                dataset.stream, 'ctx', 0, mode='foo')
+
     def test_add_one_parameter(self):
         dataset = Dataset(
                 self.session,
@@ -457,8 +957,9 @@ class DatasetTest(_DatavaultTestCase):
 
         self.hub.onNewParameter.assert_called_with(None, set(['listener']))
 
-        self.assertEqual(['param 1'], dataset.getParamNames())
-        self.assertEqual('data for param', dataset.getParameter('param 1'))
+        self.assertEqual(['param 1'], self.successResultOf(dataset.getParamNames()))
+        self.assertEqual(
+                'data for param', self.successResultOf(dataset.getParameter('param 1')))
 
     def test_add_two_parameters(self):
         dataset = Dataset(
@@ -472,9 +973,39 @@ class DatasetTest(_DatavaultTestCase):
         dataset.param_listeners.add('listener')
         dataset.addParameters([('param 2', 'data 2'), ('param 3', 'data 3')])
         self.hub.onNewParameter.assert_called_with(None, set(['listener']))
-        self.assertEqual(['param 2', 'param 3'], dataset.getParamNames())
-        self.assertEqual('data 2', dataset.getParameter('param 2'))
-        self.assertEqual('data 3', dataset.getParameter('param 3'))
+        self.assertEqual(
+                ['param 2', 'param 3'], self.successResultOf(dataset.getParamNames()))
+        self.assertEqual('data 2', self.successResultOf(dataset.getParameter('param 2')))
+        self.assertEqual('data 3', self.successResultOf(dataset.getParameter('param 3')))
+
+    def test_finalize(self):
+        dataset = Dataset(
+                self.session,
+                "Foo Name",
+                title=self._TITLE,
+                create=True,
+                independents=self._INDEPENDENTS,
+                dependents=self._DEPENDENTS,
+                storage=backend.make_storage_options())
+        dataset.addWriter('writer')
+        rows = [[0, 1, 2], [3, 4, 5]]
+        dataset.addData(self._get_records_simple(rows, dataset.data.dtype))
+        self.successResultOf(dataset.finalize())
+
+        self.assertTrue(dataset.finalized)
+        self.assertEqual(set(), dataset.writers)
+        self.assertFalse(os.path.exists(dataset.file_base + '.hdf5.part'))
+        self.assertIsNotNone(dataset.data._mapped())
+        data, count = self.successResultOf(dataset.getData(None, 0))
+        self.assertEqual(2, count)
+        self.assertArrayEqual(rows, data)
+        self.assertRaises(errors.DatasetFinalizedError, dataset.addData,
+                          self._get_records_simple(rows, dataset.data.dtype))
+        self.assertRaises(errors.DatasetFinalizedError, dataset.addComment, 'me', 'late')
+
+        # reopened datasets stay read-only
+        dataset.close()
+        self.assertTrue(Dataset(self.session, "Foo Name").finalized)
 
     def test_add_comment(self):
         dataset = Dataset(
@@ -490,7 +1021,7 @@ class DatasetTest(_DatavaultTestCase):
 
         self.hub.onCommentsAvailable.assert_called_with(None, set(['listener']))
 
-        retreived_comment, count = dataset.getComments(None, 0)
+        retreived_comment, count = self.successResultOf(dataset.getComments(None, 0))
         self.assertEqual(1, count)
         self.assertEqual('user 1', retreived_comment[0][1])
         self.assertEqual('comment 1', retreived_comment[0][2])
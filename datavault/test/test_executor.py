@@ -0,0 +1,97 @@
+import pytest
+
+from twisted.python.failure import Failure
+from twisted.trial.unittest import SynchronousTestCase
+
+from datavault.executor import IOExecutor, SynchronousExecutor
+
+
+class _FakeReactor(object):
+    """Reactor stub that delivers results from the pool immediately."""
+
+    def callFromThread(self, f, *args, **kw):
+        f(*args, **kw)
+
+    def addSystemEventTrigger(self, *args):
+        pass
+
+
+class _FakePool(object):
+    """Thread pool stub that holds jobs until the test runs them."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kw):
+        self.jobs.append((onResult, f, args, kw))
+
+    def run_next(self):
+        onResult, f, args, kw = self.jobs.pop(0)
+        try:
+            result = f(*args, **kw)
+        except Exception:
+            onResult(False, Failure())
+        else:
+            onResult(True, result)
+
+
+class IOExecutorTest(SynchronousTestCase):
+
+    def setUp(self):
+        self.executor = IOExecutor(reactor=_FakeReactor())
+        self.pool = self.executor.pool = _FakePool()
+
+    def test_same_key_runs_in_order(self):
+        d1 = self.executor.submit('key', lambda: 1)
+        d2 = self.executor.submit('key', lambda: 2)
+        # the second call waits until the first one finishes
+        self.assertEqual(1, len(self.pool.jobs))
+        self.pool.run_next()
+        self.assertEqual(1, self.successResultOf(d1))
+        self.assertNoResult(d2)
+        self.pool.run_next()
+        self.assertEqual(2, self.successResultOf(d2))
+        self.assertEqual({}, self.executor._locks)
+
+    def test_different_keys_run_concurrently(self):
+        d1 = self.executor.submit('a', lambda: 1)
+        d2 = self.executor.submit('b', lambda: 2)
+        self.assertEqual(2, len(self.pool.jobs))
+        self.pool.jobs.reverse()
+        self.pool.run_next()
+        self.assertEqual(2, self.successResultOf(d2))
+        self.assertNoResult(d1)
+
+    def test_errors_are_returned(self):
+        def fail():
+            raise ValueError('boom')
+        d1 = self.executor.submit('key', fail)
+        d2 = self.executor.submit('key', lambda: 5)
+        self.pool.run_next()
+        self.failureResultOf(d1, ValueError)
+        # later calls with the same key still run
+        self.pool.run_next()
+        self.assertEqual(5, self.successResultOf(d2))
+
+
+class SynchronousExecutorTest(SynchronousTestCase):
+
+    def test_runs_inline(self):
+        d = SynchronousExecutor().submit('key', lambda x: x + 1, 1)
+        self.assertEqual(2, self.successResultOf(d))
+
+    def test_errors_are_returned(self):
+        def fail():
+            raise ValueError('boom')
+        d = SynchronousExecutor().submit('key', fail)
+        self.failureResultOf(d, ValueError)
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,62 @@
+import numpy as np
+import os
+import pytest
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import task
+
+from datavault import backend, migrate
+
+
+_INDEPENDENTS = [backend.Independent(
+        label='x', shape=(1,), datatype='v', unit='s')]
+_DEPENDENTS = [backend.Dependent(
+        label='y', legend='y', shape=(1,), datatype='v', unit='V')]
+
+
+class MigrateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.clock = task.Clock()
+        os.mkdir(os.path.join(self.datadir, 'sub.dir'))
+        self.datasets = [
+                self.make_dataset(os.path.join(self.datadir, '00001 - a')),
+                self.make_dataset(os.path.join(self.datadir, 'sub.dir', '00001 - b'))]
+        # a csv file without ini is not a dataset
+        open(os.path.join(self.datadir, 'stray.csv'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def make_dataset(self, filename):
+        data = backend.CsvNumpyData(filename + '.csv', reactor=self.clock)
+        data.initialize_info('Foo', _INDEPENDENTS, _DEPENDENTS)
+        rows = np.recarray((3, ), dtype=[('f0', '<f8'), ('f1', '<f8')])
+        for i in range(3):
+            rows[i] = (i, 2 * i)
+        data.addData(rows)
+        data.save()
+        data.close()
+        return filename
+
+    def test_find_csv_datasets(self):
+        self.assertEqual(
+                sorted(self.datasets),
+                sorted(migrate.find_csv_datasets(self.datadir)))
+
+    def test_migrate_all(self):
+        messages = []
+        failed = migrate.migrate_all(
+                self.datadir, workers=2, report=messages.append)
+        self.assertEqual(failed, [])
+        self.assertEqual(messages[-1], 'Converted 2 datasets, 0 failed')
+        for filename in self.datasets:
+            self.assertTrue(os.path.exists(filename + '.hdf5'))
+        self.assertEqual([], migrate.find_csv_datasets(self.datadir))
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
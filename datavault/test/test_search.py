@@ -0,0 +1,148 @@
+import mock
+import numpy as np
+import os
+import pytest
+import shutil
+import tempfile
+
+import h5py
+from labrad import units as U
+from twisted.internet import task
+from twisted.trial.unittest import SynchronousTestCase
+
+import datavault
+from datavault import backend, errors, search, SessionStore
+
+
+_INDEPENDENTS = [backend.Independent(
+        label='gate', shape=(1,), datatype='v', unit='V')]
+_DEPENDENTS = [backend.Dependent(
+        label='current', legend='drain', shape=(1,), datatype='v', unit='nA')]
+
+
+class SearchIndexTest(SynchronousTestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.clock = task.Clock()
+        self.index = search.SearchIndex(self.datadir, reactor=self.clock)
+        self.addCleanup(self.index.close)
+        os.mkdir(os.path.join(self.datadir, 'sub.dir'))
+
+        a = self.make_hdf5('00001 - hysteresis loop')
+        a.addParam('bias', U.Value(2500, 'mV'))
+        a.addParam('sample', 'B7')
+        a.addComment('me', 'sweeping up and down')
+        a.close()
+        b = self.make_hdf5('00002 - hysteresis again', 'sub.dir')
+        b.addParam('Bias', U.Value(1, 'V'))
+        b.addParam('sample', 'B8')
+        b.close()
+        csv = backend.CsvNumpyData(
+                os.path.join(self.datadir, '00003 - noise.csv'), reactor=self.clock)
+        csv.initialize_info('noise', _INDEPENDENTS, _DEPENDENTS)
+        csv.addParam('bias', 3.0)
+        csv.save()
+        csv.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def make_hdf5(self, name, subdir=''):
+        filename = os.path.join(self.datadir, subdir, name)
+        return backend.create_backend(
+                filename, name[8:], _INDEPENDENTS, _DEPENDENTS, False)
+
+    def test_scan_and_query(self):
+        self.assertEqual(3, self.successResultOf(self.index.scan(workers=2)))
+        self.assertEqual(
+                [(('',), '00001 - hysteresis loop'),
+                 (('', 'sub'), '00002 - hysteresis again')],
+                self.index.query('hysteresis'))
+        self.assertEqual(
+                [(('',), '00001 - hysteresis loop')],
+                self.index.query('Hysteresis sweeping'))
+        # units are compared in base units; names ignore case
+        self.assertEqual(
+                [(('',), '00001 - hysteresis loop')],
+                self.index.query(params=[('BIAS', '>', U.Value(2, 'V'))]))
+        self.assertEqual(
+                [(('',), '00003 - noise')],
+                self.index.query(params=[('bias', '>', 2)]))
+        self.assertEqual(
+                [(('',), '00001 - hysteresis loop')],
+                self.index.query(params=[('bias', '=', U.Value(2.5, 'V'))]))
+        self.assertEqual(
+                [(('', 'sub'), '00002 - hysteresis again')],
+                self.index.query('hysteresis', [('sample', '=', 'B8')]))
+        self.assertEqual(1, len(self.index.query('drain', limit=1)))
+
+        self.assertRaises(errors.SearchQueryError, self.index.query)
+        self.assertRaises(
+                errors.SearchQueryError,
+                self.index.query, params=[('bias', '~', 1)])
+        self.assertRaises(
+                errors.SearchQueryError,
+                self.index.query, params=[('bias', '>', U.Value(2, 's'))])
+
+    def test_rescan_only_reads_changes(self):
+        self.successResultOf(self.index.scan())
+        with mock.patch('datavault.search.read_hdf5_info') as read:
+            self.assertEqual(0, self.successResultOf(self.index.scan()))
+            self.assertFalse(read.called)
+        os.unlink(os.path.join(self.datadir, '00003 - noise.csv'))
+        self.successResultOf(self.index.scan())
+        self.assertEqual([], self.index.query('noise'))
+
+    def test_scan_reads_through_the_file_cache(self):
+        name = os.path.join(self.datadir, '00001 - hysteresis loop.hdf5')
+        other = os.path.join(self.datadir, 'sub.dir', '00002 - hysteresis again.hdf5')
+        cached = backend.SelfClosingFile(h5py.File, open_args=(name, 'a'))
+        self.addCleanup(cached.close)
+        with mock.patch('h5py.File', wraps=h5py.File) as open_file:
+            self.assertEqual(3, self.successResultOf(self.index.scan()))
+        # the open file is used, and the other file is opened just to be read
+        self.assertEqual([mock.call(other, 'r')], open_file.call_args_list)
+        self.assertIn(cached, backend.FILE_CACHE)
+        self.assertIsNone(backend.FILE_CACHE.lookup(other))
+
+    def test_scan_reads_open_datasets(self):
+        store = SessionStore(self.datadir, mock.MagicMock(), reactor=self.clock,
+                             search_index=self.index)
+        dataset = store.get(['']).openDataset('00001 - hysteresis loop')
+        with mock.patch.object(dataset, 'withData', wraps=dataset.withData) as withData:
+            self.assertEqual(3, self.successResultOf(self.index.scan(store.findDataset)))
+        withData.assert_called_once_with(search.dataset_info)
+        self.assertEqual(
+                [(('',), '00001 - hysteresis loop')],
+                self.index.query('sweeping'))
+
+    def test_changed_datasets_are_reindexed(self):
+        store = SessionStore(self.datadir, mock.MagicMock(), reactor=self.clock,
+                             search_index=self.index)
+        session = store.get([''])
+        dataset = session.newDataset('fresh', [('x', 'V')], [('y', 'z', 'A')])
+        dataset.addParameter('gain', 10)
+        self.clock.advance(datavault.METADATA_SAVE_DELAY)
+        self.assertEqual(
+                [(('',), '00001 - fresh')],
+                self.index.query('fresh', [('gain', '>=', 10)]))
+
+    def test_only_new_comments_are_read(self):
+        store = SessionStore(self.datadir, mock.MagicMock(), reactor=self.clock,
+                             search_index=self.index)
+        session = store.get([''])
+        dataset = session.newDataset('fresh', [('x', 'V')], [('y', 'z', 'A')])
+        dataset.addComment('me', 'first note')
+        self.clock.advance(datavault.METADATA_SAVE_DELAY)
+        dataset.addComment('you', 'second note')
+        data = dataset.data
+        with mock.patch.object(data, 'getComments', wraps=data.getComments) as get:
+            self.clock.advance(datavault.METADATA_SAVE_DELAY)
+            get.assert_called_once_with(None, 1)
+        self.assertEqual(
+                [(('',), '00001 - fresh')],
+                self.index.query('first second you'))
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -6,10 +6,12 @@ import tempfile
 import unittest
 
 from twisted.internet import reactor, task
+from twisted.trial.unittest import SynchronousTestCase
 
 from labrad.server import LabradServer, Signal, setting
 from labrad import server
 
+import datavault
 from datavault import backend, errors, server, SessionStore
 
 
@@ -43,13 +45,14 @@ class MockContext(dict):
         self.ID = name
 
 
-class DataVaultTest(unittest.TestCase):
+class DataVaultTest(SynchronousTestCase):
     '''Tests for the datavault server.'''
 
     def setUp(self):
         self.datadir = _unique_dir_name()
         self.hub = mock.MagicMock()
-        self.store = SessionStore(self.datadir, self.hub)
+        self.clock = task.Clock()
+        self.store = SessionStore(self.datadir, self.hub, reactor=self.clock)
         self.datavault = server.DataVault(self.store)
         self.set_default_labrad_server_mocks(self.datavault)
 
@@ -155,6 +158,15 @@ class DataVaultTest(unittest.TestCase):
         self.assertEqual(
                 '(*v[ms],*v[eV])', self.datavault.transpose_type(self.context))
 
+    def test_create_dataset_with_storage_options(self):
+        self.datavault.initContext(self.context)
+        self.datavault.new(
+                self.context, 'foo', [('x', 'ms')], [('y', 'E', 'eV')],
+                (256, 'lzf', 0, True))
+        dataset = self.datavault.getDataset(self.context)
+        self.assertEqual((256,), dataset.data.dataset.chunks)
+        self.assertEqual('lzf', dataset.data.dataset.compression)
+
     def test_expire_context(self):
         # Create the root session.
         self.datavault.initContext(self.context)
@@ -163,7 +175,7 @@ class DataVaultTest(unittest.TestCase):
                 self.context, 'foo', [('x', 'ms')], [('y', 'E', 'eV')])
         dataset = self.datavault.getDataset(self.context)
         # Add the context as a listener to the dataset.
-        dataset.listeners.add(self.context.ID)
+        dataset.addListener(self.context.ID)
         # Now expire the context
         self.datavault.expireContext(self.context)
 
@@ -174,6 +186,15 @@ class DataVaultTest(unittest.TestCase):
         # Check the dataset doesn't have anymore listeners.
         self.assertEqual(set([]), dataset.listeners)
 
+    def test_expire_context_only_touches_own_registrations(self):
+        self.datavault.initContext(self.context)
+        other = MockContext('other-context')
+        self.datavault.initContext(other)
+        with mock.patch.object(self.store, 'get_all') as get_all:
+            self.datavault.expireContext(self.context)
+            self.assertFalse(get_all.called)
+        self.assertEqual(set(['other-context']), self.store.get(['']).listeners)
+
     def test_get_dataset_not_yet_created(self):
         self.datavault.initContext(self.context)
         self.assertRaises(
@@ -225,6 +246,8 @@ class DataVaultTest(unittest.TestCase):
         self.datavault.initContext(self.context)
         self.datavault.cd(self.context, path='first', create=True)
         self.datavault.cd(self.context, path=['second', 'third'], create=True)
+        # Sessions with delayed saves are kept until they are written.
+        self.clock.advance(datavault.METADATA_SAVE_DELAY)
         all_sessions = self.datavault.dump_existing_sessions(self.context)
         self.assertEqual(['/first/second/third'], all_sessions)
 
@@ -239,27 +262,175 @@ class DataVaultTest(unittest.TestCase):
         # Add two rows of data.
         self.datavault.add(self.context, [(.1, .2, .3), (.4, .5, .6)])
         # Check that the data is there.
-        data = self.datavault.get(self.context)
+        data = self.successResultOf(
+                self.datavault.get(self.context))
         self.assertArrayEqual([[.1, .2, .3], [.4, .5, .6]], data)
-        more_data = self.datavault.get(self.context)
+        more_data = self.successResultOf(
+                self.datavault.get(self.context))
         self.assertArrayEqual([], more_data)
 
         # Check that data can be fetched incrementally.
-        row_1 = self.datavault.get(self.context, limit=1, startOver=True)
-        row_2 = self.datavault.get(self.context, limit=1)
+        row_1 = self.successResultOf(
+                self.datavault.get(self.context, limit=1, startOver=True))
+        row_2 = self.successResultOf(
+                self.datavault.get(self.context, limit=1))
         self.assertArrayEqual([[.1, .2, .3]], row_1)
         self.assertArrayEqual([[.4, .5, .6]], row_2)
 
         # Check that the data can be fetched in extended format.
-        data_ex = self.datavault.get_ex(self.context, startOver=True)
+        data_ex = self.successResultOf(
+                self.datavault.get_ex(self.context, startOver=True))
         self.assertArrayEqual([[.1, .2, .3], [.4, .5, .6]], data_ex)
 
         # Check that the data can not be fetched in extended transpose format.
+        self.failureResultOf(
+                self.datavault.get_ex_t(self.context, startOver=True),
+                RuntimeError)
+
+    def test_flush(self):
+        self.datavault.initContext(self.context)
+        self.datavault.new(
+                self.context, 'foo', [('x', 'ms')], [('y', 'E', 'eV')])
+        self.datavault.add(self.context, [(.1, .2)])
+        dataset = self.datavault.getDataset(self.context)
+        self.assertEqual(0, len(dataset.data))
+        self.datavault.flush(self.context)
+        self.assertEqual(1, len(dataset.data))
+
+    def test_writer_pins_file(self):
+        self.datavault.initContext(self.context)
+        self.datavault.new(self.context, 'foo', [('x', 'ms')], [('y', 'E', 'eV')])
+        dataset = self.datavault.getDataset(self.context)
+        self.assertEqual(1, dataset.data._file._pins)
+
+        # Opening another dataset releases the pin.
+        self.datavault.new(self.context, 'bar', [('x', 'ms')], [('y', 'E', 'eV')])
+        self.assertEqual(0, dataset.data._file._pins)
+        self.datavault.open(self.context, dataset.name)
+        self.assertEqual(0, dataset.data._file._pins)
+
+    def test_file_cache(self):
+        max_open = backend.FILE_CACHE.max_open
+        self.addCleanup(backend.FILE_CACHE.setMaxOpen, max_open)
+        self.datavault.initContext(self.context)
+        self.datavault.new(self.context, 'foo', [('x', 'ms')], [('y', 'E', 'eV')])
+        stats = self.datavault.file_cache(self.context, 10)
+        self.assertEqual(5, len(stats))
+        self.assertEqual(10, stats[1])
+        self.assertTrue(stats[0] >= 1)
+
+    def test_get_slice(self):
+        self.datavault.initContext(self.context)
+        self.datavault.new(
+                self.context, 'foo', [('x', 'ms')],
+                [('y', 'E', 'eV'), ('z', 'B', 'eV')])
+        self.datavault.add(
+                self.context, [[i, 10 * i, -i] for i in range(10)])
+
+        # Strided read of a subset of the columns.
+        x, z = self.successResultOf(
+                self.datavault.get_slice(self.context, [0, 2], 1, 8, 3))
+        self.assertArrayEqual([1, 4, 7], x)
+        self.assertArrayEqual([-1, -4, -7], z)
+
+        # Min/max decimation keeps the extremes of each bin.
+        y, = self.successResultOf(
+                self.datavault.get_slice(
+                        self.context, [1], 0, None, 4, 'minmax'))
+        self.assertArrayEqual([0, 30, 40, 70, 80, 90], y)
+
+        # The read position of the context is unchanged.
+        data = self.successResultOf(self.datavault.get(self.context))
+        self.assertEqual(10, len(data))
+
+        self.failureResultOf(
+                self.datavault.get_slice(self.context, [3]),
+                errors.ReadSelectionError)
+
+    def test_get_slice_leaves_listeners(self):
+        self.datavault.initContext(self.context)
+        self.datavault.new(self.context, 'foo', [('x', 'ms')], [('y', 'E', 'eV')])
+        self.datavault.add(self.context, [[i, i] for i in range(10)])
+        self.successResultOf(self.datavault.get(self.context, 4))
+        dataset = self.datavault.getDataset(self.context)
+        listeners = set(dataset.listeners)
+        self.hub.onDataAvailable.reset_mock()
+
+        self.successResultOf(self.datavault.get_slice(self.context, [0], 0, 10))
+        self.assertEqual(4, self.context['filepos'])
+        self.assertEqual(listeners, dataset.listeners)
+        self.assertFalse(self.hub.onDataAvailable.called)
+
+    def test_get_parameter_values(self):
+        self.datavault.initContext(self.context)
+        self.datavault.new(self.context, 'foo', [('x', 'ms')], [('y', 'E', 'eV')])
+        self.datavault.add_parameters(
+                self.context, (('Gain', 3.5), ('Offset', 'none'), ('Phase', 1)))
+        self.assertEqual(
+                (('phase', 1), ('Gain', 3.5)),
+                self.successResultOf(self.datavault.get_parameter_values(
+                        self.context, ['phase', 'Gain'], False)))
+        self.assertEqual(
+                (('Gain', 3.5), ('Offset', 'none'), ('Phase', 1)),
+                self.successResultOf(self.datavault.get_parameters(self.context)))
+        self.assertIsNone(self.successResultOf(
+                self.datavault.get_parameter_values(self.context, [])))
+        self.failureResultOf(
+                self.datavault.get_parameter_values(self.context, ['phase']),
+                errors.BadParameterError)
+
+    def test_stream(self):
+        self.datavault.initContext(self.context)
+        self.datavault.new(self.context, 'foo', [('x', 'ms')], [('y', 'E', 'eV')])
+        self.datavault.add(self.context, [(0, 1)])
+        push = self.hub.onDataPushed
+
+        # Streaming starts at the read position of the context.
+        self.datavault.stream(self.context, True)
+        (start, stop, (x, y)), _ = push.call_args[0]
+        self.assertEqual((0, 1), (start, stop))
+        self.assertArrayEqual([1], y)
+
+        self.datavault.add(self.context, [(1, 2)])
+        self.assertEqual(1, push.call_count)
+        self.datavault.stream_ack(self.context)
+        self.assertEqual(2, push.call_count)
+
+        self.datavault.stream(self.context, False)
+        self.datavault.add(self.context, [(2, 3)])
+        self.datavault.stream_ack(self.context)
+        self.assertEqual(2, push.call_count)
+
+        # Streams end with the context.
+        self.datavault.stream(self.context, True, startOver=True)
+        dataset = self.datavault.getDataset(self.context)
+        self.assertIn(self.context.ID, dataset.streams)
+        self.datavault.expireContext(self.context)
+        self.assertEqual({}, dataset.streams)
+
+    def test_add_raw(self):
+        self.datavault.initContext(self.context)
+        self.datavault.new(self.context, 'foo', [('x', 'ms')], [('y', 'E', 'eV')])
+        rows = np.array([[0, 1.5], [1, 2.5], [2, 3.5]], dtype='<f8')
+        self.datavault.add_raw(self.context, rows.tobytes(), 3)
+        data = self.successResultOf(self.datavault.get(self.context))
+        self.assertArrayEqual(rows, data)
+
         self.assertRaises(
-                RuntimeError,
-                self.datavault.get_ex_t,
-                self.context,
-                startOver=True)
+                errors.RawDataError,
+                self.datavault.add_raw, self.context, rows.tobytes()[:-1])
+        self.assertRaises(
+                errors.RawDataError,
+                self.datavault.add_raw, self.context, rows.tobytes(), 2)
+
+    def test_search_tags(self):
+        self.datavault.initContext(self.context)
+        self.datavault.cd(self.context, ['', 'first'], True)
+        self.datavault.new(self.context, 'foo', [('x', 'ms')], [('y', 'E', 'eV')])
+        self.datavault.update_tags(self.context, 'star', [])
+        self.assertEqual(
+                [(['', 'first'], '00001 - foo')],
+                self.successResultOf(self.datavault.search_tags(self.context, 'star')))
 
     def test_add_extended_data(self):
         self.datavault.initContext(self.context)
@@ -275,21 +446,26 @@ class DataVaultTest(unittest.TestCase):
         self.datavault.add_ex(self.context, [data_row_1, data_row_2])
 
         # Check that the data is there.
-        data = self.datavault.get_ex(self.context)
+        data = self.successResultOf(
+                self.datavault.get_ex(self.context))
         self.assertDataRowEqual(data_row_1, data[0])
         self.assertDataRowEqual(data_row_2, data[1])
 
-        more_data = self.datavault.get_ex(self.context)
+        more_data = self.successResultOf(
+                self.datavault.get_ex(self.context))
         self.assertArrayEqual([], more_data)
 
         # Check that data can be fetched incrementally.
-        row_1 = self.datavault.get_ex(self.context, limit=1, startOver=True)
-        row_2 = self.datavault.get_ex(self.context, limit=1)
+        row_1 = self.successResultOf(
+                self.datavault.get_ex(self.context, limit=1, startOver=True))
+        row_2 = self.successResultOf(
+                self.datavault.get_ex(self.context, limit=1))
         self.assertDataRowEqual(data_row_1, row_1[0])
         self.assertDataRowEqual(data_row_2, row_2[0])
 
         # Check that the data can be fetched in transpose format.
-        data_t = self.datavault.get_ex_t(self.context, startOver=True)
+        data_t = self.successResultOf(
+                self.datavault.get_ex_t(self.context, startOver=True))
         expected_x = [[[.1, .5], [.5, .9]], [[.3, .4], [.4, .8]]]
         expected_y = [2, 3]
         expected_z =  [[[.1j, 2j]], [[.3j, 5j]]]
@@ -298,10 +474,9 @@ class DataVaultTest(unittest.TestCase):
         self.assertArrayEqual(expected_z, data_t[2])
 
         # Extended data format cannot be read as simple data.
-        self.assertRaises(
-                errors.DataVersionMismatchError,
-                self.datavault.get,
-                self.context)
+        self.failureResultOf(
+                self.datavault.get(self.context),
+                errors.DataVersionMismatchError)
 
     def test_add_extended_data_transpose(self):
         self.datavault.initContext(self.context)
@@ -320,30 +495,34 @@ class DataVaultTest(unittest.TestCase):
         # Check that the data is there as non-transposed data.
         data_row_1 = ([[.1, .5], [.5, .9]], 2, [[.1j, 2j]])
         data_row_2 = ([[.3, .4], [.4, .8]], 3, [[.3j, 5j]])
-        data = self.datavault.get_ex(self.context)
+        data = self.successResultOf(
+                self.datavault.get_ex(self.context))
         self.assertDataRowEqual(data_row_1, data[0])
         self.assertDataRowEqual(data_row_2, data[1])
 
-        more_data = self.datavault.get_ex(self.context)
+        more_data = self.successResultOf(
+                self.datavault.get_ex(self.context))
         self.assertArrayEqual([], more_data)
 
         # Check that data can be fetched incrementally.
-        row_1 = self.datavault.get_ex(self.context, limit=1, startOver=True)
-        row_2 = self.datavault.get_ex(self.context, limit=1)
+        row_1 = self.successResultOf(
+                self.datavault.get_ex(self.context, limit=1, startOver=True))
+        row_2 = self.successResultOf(
+                self.datavault.get_ex(self.context, limit=1))
         self.assertDataRowEqual(data_row_1, row_1[0])
         self.assertDataRowEqual(data_row_2, row_2[0])
 
         # Check that the data can be fetched in transpose format.
-        data_t = self.datavault.get_ex_t(self.context, startOver=True)
+        data_t = self.successResultOf(
+                self.datavault.get_ex_t(self.context, startOver=True))
         self.assertArrayEqual(x, data_t[0])
         self.assertArrayEqual(y, data_t[1])
         self.assertArrayEqual(z, data_t[2])
 
         # Extended data format cannot be read as simple data.
-        self.assertRaises(
-                errors.DataVersionMismatchError,
-                self.datavault.get,
-                self.context)
+        self.failureResultOf(
+                self.datavault.get(self.context),
+                errors.DataVersionMismatchError)
 
 if __name__ == '__main__':
     pytest.main(['-v', __file__])
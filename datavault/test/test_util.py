@@ -1,5 +1,7 @@
 import io
+import os
 import pytest
+import tempfile
 import unittest
 
 import numpy as np
@@ -27,6 +29,30 @@ class Testutil(unittest.TestCase):
                 expected, actual, msg=('DVSafeConfigParser not writing with '
                                        'custom line ending'))
 
+    def test_write_config(self):
+        parser = util.DVSafeConfigParser()
+        parser.add_section('foo')
+        parser.set('foo', 'alpha', '1')
+        dirname = tempfile.mkdtemp()
+        filename = os.path.join(dirname, 'foo.ini')
+        try:
+            util.write_config(parser, filename)
+            util.write_config(parser, filename)
+            self.assertEqual(['foo.ini'], os.listdir(dirname))
+            with open(filename) as f:
+                self.assertEqual('[foo]\nalpha = 1\n\n', f.read())
+        finally:
+            os.unlink(filename)
+            os.rmdir(dirname)
+
+    def test_parse_tags(self):
+        self.assertEqual(
+                {'a': set(['x', 'y']), 'b': set(), 'c': set(['z'])},
+                util.parse_tags("{'a': {'x', 'y'}, 'b': set(), 'c': set(['z'])}"))
+        self.assertEqual({}, util.parse_tags('{}'))
+        self.assertRaises(
+                ValueError, util.parse_tags, "{'a': __import__('os').getcwd()}")
+
     def test_to_record_array(self):
         data = np.array([[0, 1, 2], [3, 4, 5]], dtype=complex)
         actual = util.to_record_array(data)
@@ -1,4 +1,6 @@
+import ast
 import configparser as cp
+import os
 
 import numpy as np
 
@@ -28,6 +30,50 @@ class DVSafeConfigParser(cp.SafeConfigParser):
             fp.write(newline)
 
 
+def write_config(config, filename):
+    """Write a config parser to the named file.
+
+    The file is written to a temporary file next to it, which is then
+    renamed over it, so readers never see a partially written file.
+    """
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'w') as f:
+        config.write(f)
+    os.replace(tmpname, filename)
+
+
+def write_text(text, filename):
+    """Write a string to the named file, replacing it atomically like write_config."""
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'w') as f:
+        f.write(text)
+    os.replace(tmpname, filename)
+
+
+def parse_tags(s):
+    """Parse a tag dictionary, {name: set of tags}, as saved in session.ini.
+
+    The dictionary is written with repr, so it contains only string,
+    list, tuple, dict and set literals, except that empty sets (and sets
+    written by Python 2) appear as calls to set().  This evaluates just
+    those forms rather than calling eval on the file contents.
+    """
+    def value(node):
+        if isinstance(node, ast.Call):
+            if (isinstance(node.func, ast.Name) and node.func.id == 'set'
+                    and not node.keywords and len(node.args) <= 1):
+                return set(value(node.args[0])) if node.args else set()
+            raise ValueError('unexpected call in tags: {}'.format(ast.dump(node)))
+        if isinstance(node, ast.Dict):
+            return {value(k): value(v) for k, v in zip(node.keys, node.values)}
+        if isinstance(node, (ast.Set, ast.List, ast.Tuple)):
+            items = [value(e) for e in node.elts]
+            return set(items) if isinstance(node, ast.Set) else items
+        return ast.literal_eval(node)
+    tags = value(ast.parse(s.strip(), mode='eval').body)
+    return {name: set(entry_tags) for name, entry_tags in tags.items()}
+
+
 def to_record_array(data):
     """Take a 2-D array of numpy data and return a 1-D array of records."""
     return np.core.records.fromarrays(data.T)
@@ -17,7 +17,7 @@
 ### BEGIN NODE INFO
 [info]
 name = Serial Server
-version = 1.4
+version = 1.5
 description =
 instancename = %LABRADNODE% Serial Server
 
@@ -41,7 +41,7 @@ from serial.tools import list_ports
 from serial import Serial
 from serial.serialutil import SerialException
 
-from time import sleep
+from time import sleep, time
 import sys
 if sys.version_info > (3,):
     long = int
@@ -382,6 +382,32 @@ class SerialServer(LabradServer):
         recd = yield self.readSome(c, count)
         return recd
 
+    @setting(57, 'Read Exactly', count=['w: Read this many bytes'],
+             timeout=['v[s]: Longest time to wait (max: 5min)'],
+             returns=['y: Received data as bytes'])
+    def read_exactly(self, c, count, timeout):
+        """Reads count bytes, or as many as arrive before the timeout.
+
+        The bytes are collected in a worker thread, so a long read takes a
+        single request instead of polling In Waiting.  Other requests in
+        the same context wait until it returns.
+        """
+        ser = self.getPort(c)
+        deadline = time() + min(timeout['s'], 300)
+
+        def doRead():
+            recd = bytearray()
+            while len(recd) < count:
+                r = ser.read(count - len(recd))
+                if r:
+                    recd += r
+                elif time() >= deadline:
+                    break
+                else:
+                    sleep(0.002)
+            return bytes(recd)
+        return threads.deferToThread(doRead)
+
     @setting(56, 'readBuffer', returns=['?: Received data'])
     def readBuffer(self, c):
         """Reads all the data from the input buffer."""
@@ -0,0 +1,255 @@
+import mock
+import numpy as np
+import pytest
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import SynchronousTestCase
+
+import dac_adc
+
+
+def legacy_decode(data, adcN, steps):
+    """The per-sample decoding buffer_ramp used before decodeFrames."""
+    voltages = []
+    for x in range(0, len(data) - 1, 2):
+        decimal = 256 * data[x] + data[x + 1]
+        voltages.append(decimal * 20.0 / 65536 - 10.0)
+    channels = [[] for y in range(adcN)]
+    for x in range(0, steps * adcN, adcN):
+        for y in range(adcN):
+            try:
+                channels[y].append(voltages[x + y])
+            except IndexError:
+                channels[y].append(0)
+    return channels
+
+
+class DecodeTest(SynchronousTestCase):
+
+    # 0 V is 0x8000; the codes either side of it and the ends of the range
+    CODES = [0x0000, 0x7FFF, 0x8000, 0xFFFF, 0x0001, 0x8001]
+
+    def data(self, codes):
+        return np.asarray(codes, dtype='>u2').tobytes()
+
+    def test_edge_codes(self):
+        data = self.data(self.CODES)
+        self.assertEqual(legacy_decode(data, 2, 3), dac_adc.decodeFrames(data, 2, 3).tolist())
+        self.assertEqual([-10.0, -20.0 / 65536, 0.0, 10.0 - 20.0 / 65536],
+                         dac_adc.decodeFrames(data, 1, 4)[0].tolist())
+
+    def test_stopped_ramp(self):
+        # the last sample is cut off, leaving an odd byte
+        data = self.data(self.CODES)[:-1]
+        self.assertEqual(legacy_decode(data, 3, 3), dac_adc.decodeFrames(data, 3, 3).tolist())
+
+    def test_decode_buffer_lists(self):
+        channels = dac_adc.decodeBuffer(self.data(self.CODES), 2, 3)
+        self.assertEqual(legacy_decode(self.data(self.CODES), 2, 3), channels)
+        self.assertIsInstance(channels[0], list)
+        self.assertIsInstance(channels[0][0], float)
+
+
+class FakeResult(dict):
+    """Answers of a serial server packet, by key or as attributes."""
+    __getattr__ = dict.__getitem__
+
+
+class FakePacket(object):
+    """Records the requests of a serial server packet until it is sent.
+
+    Writes are recorded as ('write', code), any other request as (setting
+    name, key of its answer).
+    """
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.requests = []
+
+    def write(self, code):
+        self.requests.append(('write', code))
+        return self
+
+    def __getattr__(self, name):
+        def request(*args, **kw):
+            self.requests.append((name, kw.get('key', name)))
+            return self
+        return request
+
+    def send(self):
+        d = defer.Deferred()
+        self.serial.sent.append((self.requests, d))
+        return d
+
+
+class FakeSerial(object):
+    """Serial server stand-in that keeps sent packets for the test to answer."""
+
+    def __init__(self):
+        self.sent = []
+
+    def packet(self, context=None):
+        return FakePacket(self)
+
+    def answer(self, *values):
+        """Answer the oldest unanswered packet, one value per request but writes."""
+        requests, d = self.sent.pop(0)
+        keys = [key for request, key in requests if request != 'write']
+        d.callback(FakeResult(zip(keys, values)))
+
+
+class CommandQueueTest(SynchronousTestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        patcher = mock.patch.object(dac_adc, 'reactor', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.serial = FakeSerial()
+        # the state connect sets up, without opening a port
+        self.dev = dac_adc.DAC_ADCWrapper.__new__(dac_adc.DAC_ADCWrapper)
+        self.dev.name = 'box'
+        self.dev.server = self.serial
+        self.dev.ctx = None
+        self.dev.ramping = False
+        self.dev._pending = []
+        self.dev._sendCall = None
+        self.dev._holds = 0
+
+    def test_commands_are_batched_in_order(self):
+        first = self.dev.command('SET,0,1.000000\r')
+        second = self.dev.command('*IDN?\r', replies=2)
+        self.assertEqual([], self.serial.sent)
+        self.clock.advance(0)
+        self.assertEqual(1, len(self.serial.sent))
+        requests, _ = self.serial.sent[0]
+        self.assertEqual(
+                [('write', 'SET,0,1.000000\r'), ('read_line', '0.0'),
+                 ('write', '*IDN?\r'), ('read_line', '1.0'), ('read_line', '1.1')],
+                requests)
+        self.serial.answer('DAC 0 UPDATED TO 1.0000V', 'DAC-ADC', 'AD5764')
+        self.assertEqual('DAC 0 UPDATED TO 1.0000V', self.successResultOf(first))
+        self.assertEqual(['DAC-ADC', 'AD5764'], self.successResultOf(second))
+
+    def test_replies_reach_their_callers(self):
+        first = self.dev.command('GET_ADC,0\r')
+        self.clock.advance(0)
+        second = self.dev.command('GET_ADC,1\r')
+        self.clock.advance(0)
+        # the second packet is sent without waiting for the first reply
+        self.assertEqual(2, len(self.serial.sent))
+        self.serial.answer('0.5')
+        self.serial.answer('-0.25')
+        self.assertEqual('0.5', self.successResultOf(first))
+        self.assertEqual('-0.25', self.successResultOf(second))
+
+    def test_failed_packet_fails_its_commands(self):
+        first = self.dev.command('GET_ADC,0\r')
+        second = self.dev.command('GET_ADC,1\r')
+        self.clock.advance(0)
+        _, d = self.serial.sent.pop(0)
+        d.errback(IOError('port closed'))
+        self.failureResultOf(first, IOError)
+        self.failureResultOf(second, IOError)
+
+    def test_raw_read_and_write_are_queued(self):
+        server = dac_adc.DAC_ADCServer.__new__(dac_adc.DAC_ADCServer)
+        server.selectedDevice = lambda c: self.dev
+        reading = self.dev.command('GET_ADC,0\r')
+        written = server.write({}, 'NOP\r')
+        line = server.read({})
+        self.clock.advance(0)
+        requests, _ = self.serial.sent[0]
+        self.assertEqual(
+                [('write', 'GET_ADC,0\r'), ('read_line', '0.0'),
+                 ('write', 'NOP\r'), ('read_line', '2.0')],
+                requests)
+        self.serial.answer('0.5', 'NOP')
+        self.assertEqual('0.5', self.successResultOf(reading))
+        self.successResultOf(written)
+        self.assertEqual('NOP', self.successResultOf(line))
+
+    def test_commands_wait_for_buffer_ramp(self):
+        server = dac_adc.DAC_ADCServer.__new__(dac_adc.DAC_ADCServer)
+        server.selectedDevice = lambda c: self.dev
+        server.sigBufferRampStarted = mock.MagicMock()
+        ramp = server.buffer_ramp({}, [0], [0], [0.0], [5.0], 2, 100)
+        reading = self.dev.command('GET_ADC,1\r')
+        self.clock.advance(0)
+        requests, _ = self.serial.sent[0]
+        self.assertEqual('write', requests[0][0])
+        self.assertTrue(requests[0][1].startswith('BUFFER_RAMP,'))
+        self.serial.answer()
+        # the ramp data is read while the command waits
+        requests, _ = self.serial.sent[0]
+        self.assertEqual([('read_exactly', 'read_exactly')], requests)
+        self.serial.answer(b'\x80\x00\xc0\x00')
+        self.serial.answer('BUFFER_RAMP_FINISHED')
+        np.testing.assert_allclose([[0, 5]], self.successResultOf(ramp))
+        self.assertEqual([], self.serial.sent)
+        self.assertNoResult(reading)
+        self.clock.advance(0)
+        requests, _ = self.serial.sent[0]
+        self.assertEqual([('write', 'GET_ADC,1\r'), ('read_line', '0.0')], requests)
+        self.serial.answer('1.5')
+        self.assertEqual('1.5', self.successResultOf(reading))
+
+
+class BufferRamp2DTest(SynchronousTestCase):
+
+    def setUp(self):
+        self.serial = FakeSerial()
+        self.dev = mock.MagicMock()
+        self.dev.name = 'box'
+        self.dev.packet.side_effect = self.serial.packet
+        self.dev.isramping.return_value = True
+        self.dev.write.side_effect = lambda code: defer.succeed(None)
+        self.dev.in_waiting.side_effect = lambda: defer.succeed(0)
+        self.dev.read.side_effect = lambda: defer.succeed('')
+        # two steps of one channel per line: codes 0x8000 (0 V) and 0xc000 (5 V)
+        self.dev.readBuffer.side_effect = lambda n: defer.succeed(b'\x80\x00\xc0\x00')
+        self.server = dac_adc.DAC_ADCServer.__new__(dac_adc.DAC_ADCServer)
+        self.server.selectedDevice = lambda c: self.dev
+        self.server.sleep = lambda secs: defer.succeed(None)
+        for signal in ['sigOutputSet', 'sigBufferRampStarted', 'sigBufferRampData']:
+            setattr(self.server, signal, mock.MagicMock())
+
+    def ramp(self, lines):
+        return self.server.buffer_ramp_2d(
+                {}, [2], [[v] for v in range(lines)], [0], [0], [0.0], [5.0], 2, 100)
+
+    def test_replies_are_checked(self):
+        d = self.ramp(2)
+        requests, _ = self.serial.sent[0]
+        self.assertEqual(
+                [('write', 'SET,2,0.000000\r'), ('read_line', 'set0'),
+                 ('write', dac_adc.bufferRampCommand([0], [0], [0.0], [5.0], 2, 100, 1))],
+                requests)
+        self.serial.answer('DAC 2 UPDATED TO 0.0000V')
+        requests, _ = self.serial.sent[0]
+        self.assertEqual(('read_line', 'finished'), requests[0])
+        self.serial.answer('BUFFER_RAMP_FINISHED', 'DAC 2 UPDATED TO 1.0000V')
+        channels = self.successResultOf(d)
+        np.testing.assert_allclose([[[0, 5], [0, 5]]], channels)
+        self.server.sigOutputSet.assert_called_with(['2', '1.0000'])
+        self.dev.resume.assert_called_once_with()
+
+    def test_unacknowledged_set_stops_the_ramp(self):
+        d = self.ramp(2)
+        self.serial.answer('DAC 2 UPDATED TO 0.0000V')
+        self.serial.answer('BUFFER_RAMP_FINISHED', 'NOPE')
+        self.failureResultOf(d, Exception)
+        self.dev.write.assert_called_once_with('STOP\r')
+        self.dev.setramping.assert_called_with(False)
+        self.dev.resume.assert_called_once_with()
+
+    def test_unfinished_line_stops_the_ramp(self):
+        d = self.ramp(2)
+        self.serial.answer('DAC 2 UPDATED TO 0.0000V')
+        self.serial.answer('', 'DAC 2 UPDATED TO 1.0000V')
+        self.failureResultOf(d, Exception)
+        self.dev.write.assert_called_once_with('STOP\r')
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])